@@ -0,0 +1,368 @@
+'''
+Full-screen terminal dashboard for the launcher (curses).
+
+Replaces the input() menu when the launcher runs in a terminal: a panel
+with every session's tunnel state, health check round trip, relay traffic
+per second and viewer process is redrawn every refresh seconds, with the
+latest log messages (viewer crashes, tunnel drops...) below it.  The menu
+commands are the same single keys (l, 1-6, w, s, u, t, c, v, q); 'c' asks
+for the port on the bottom line.  Commands run on a worker thread so the
+panel keeps updating while e.g. a tunnel is opened, and what they print is
+shown in the output pane.
+
+The loop sleeps in getch() until a key arrives or the next redraw is due,
+and never redraws more than max_fps times a second, so an idle dashboard
+costs a wake-up per refresh interval.  Every few seconds the whole screen
+is repainted, in case a helper program wrote over it.  Without curses
+(Windows without the windows-curses package) or a terminal, the launcher
+keeps the text menu.
+'''
+import collections
+import concurrent.futures
+import io
+import logging
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import curses
+except ImportError:
+    curses = None
+
+from relay import format_bytes
+
+
+KEYS = ('l', 'w', 's', 'u', 't', 'v', '1', '2', '3', '4', '5', '6')
+#seconds between full repaints
+REPAINT_INTERVAL = 5.0
+HELP = ('l sessions  1-6 open  w windows  s sound  u upload  t tunnels  '
+        'c close  v version  q quit')
+
+
+def available():
+    '''True if curses can drive this terminal.'''
+    return curses is not None and sys.stdin.isatty() and sys.stdout.isatty()
+
+
+##-------------------------------------------------------------------------
+## Session table from the launcher's in-memory state
+##-------------------------------------------------------------------------
+def session_rows(launcher, window=15.0):
+    '''
+    A dict per session (tunnel, viewer or health record) with name, port,
+    tunnel, rtt, rate_in, rate_out (None without a relay) and viewer.  Only
+    reads counters and poll()s processes the launcher started.
+    '''
+    rows = collections.OrderedDict()
+
+    def row(name):
+        if name not in rows:
+            rows[name] = {'name': name, 'port': None, 'tunnel': '-', 'rtt': None,
+                          'health': None, 'rate_in': None, 'rate_out': None,
+                          'viewer': '-'}
+        return rows[name]
+
+    with launcher.tunnel_lock:
+        tunnels = sorted(launcher.ports_in_use.items())
+    supervisor = launcher.tunnel_supervisor
+    for port, tunnel in tunnels:
+        entry = row(tunnel.session_name)
+        entry['port'] = port
+        entry['tunnel'] = 'up' if tunnel.is_alive() else 'DOWN'
+        if supervisor is not None and tunnel.session_name in supervisor.stats:
+            reconnects = supervisor.stats[tunnel.session_name].reconnects
+            if reconnects:
+                entry['tunnel'] += f' ({reconnects}x)'
+
+    if launcher.health_checker is not None:
+        with launcher.health_checker.lock:
+            health = list(launcher.health_checker.health.items())
+        for name, session in health:
+            entry = row(name)
+            entry['rtt'] = session.latency if session.failures == 0 else None
+            entry['health'] = session.state
+
+    if launcher.relay_manager is not None:
+        with launcher.relay_manager.lock:
+            relays = list(launcher.relay_manager.relays.items())
+        for name, relay in relays:
+            if name in rows and not relay.closed:
+                rows[name]['rate_in'], rows[name]['rate_out'] = relay.stats.rate(window)
+
+    if launcher.viewer_supervisor is not None:
+        with launcher.viewer_supervisor.lock:
+            viewers = list(launcher.viewer_supervisor.viewers.items())
+        for name, record in viewers:
+            entry = row(name)
+            state = record.state
+            if state == 'running' and record.proc is not None \
+                    and record.proc.poll() is not None:
+                state = 'exited'
+            if record.restarts:
+                state += f' ({record.restarts}x)'
+            entry['viewer'] = state
+            if entry['port'] is None:
+                entry['port'] = record.port
+
+    if 'soundplay' in rows:
+        sound = launcher.sound
+        running = sound is not None and sound.proc is not None and sound.proc.poll() is None
+        rows['soundplay']['viewer'] = 'playing' if running else 'stopped'
+
+    return sorted(rows.values(), key=lambda r: (r['port'] is None, r['port'] or 0, r['name']))
+
+
+##-------------------------------------------------------------------------
+## Log records and printed output for the panes
+##-------------------------------------------------------------------------
+class PaneHandler(logging.Handler):
+    '''Keeps the last lines logged (info and up) for the messages pane.
+    '''
+    def __init__(self, lines=200):
+        super().__init__(logging.INFO)
+        self.lines = collections.deque(maxlen=lines)
+        self.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s',
+                                            datefmt='%H:%M:%S'))
+
+    def emit(self, record):
+        try:
+            text = self.format(record)
+        except Exception:
+            return
+        for line in text.split('\n'):
+            self.lines.append((record.levelno, line))
+
+
+class PaneWriter(io.TextIOBase):
+    '''Stands in for sys.stdout: printed lines go to the output pane.
+    '''
+    def __init__(self, lines=200):
+        self.lines = collections.deque(maxlen=lines)
+        self.partial = ''
+        self.lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self.lock:
+            parts = (self.partial + text).split('\n')
+            self.partial = parts.pop()
+            self.lines.extend(parts)
+        return len(text)
+
+
+##-------------------------------------------------------------------------
+## Dashboard
+##-------------------------------------------------------------------------
+class Dashboard(object):
+
+    def __init__(self, launcher, refresh=1.0, max_fps=10, version=''):
+        self.launcher = launcher
+        self.log = launcher.log
+        self.refresh = refresh
+        self.min_interval = 1.0 / max_fps
+        self.version = version
+        self.quit = False
+        self.prompt = None
+        self.dirty = True
+        self.busy = None
+        self.draws = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.messages = PaneHandler()
+        self.output = PaneWriter()
+
+
+    ##-------------------------------------------------------------------------
+    ## Run until 'q' (or Control-C)
+    ##-------------------------------------------------------------------------
+    def run(self):
+        #the console handler would write over the screen: show the messages
+        # in their pane instead while the dashboard is up
+        consoles = [h for h in self.log.handlers
+                    if type(h) is logging.StreamHandler]
+        for handler in consoles:
+            self.log.removeHandler(handler)
+        self.log.addHandler(self.messages)
+        stdout = sys.stdout
+        sys.stdout = self.output
+        try:
+            curses.wrapper(self.loop)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sys.stdout = stdout
+            self.log.removeHandler(self.messages)
+            for handler in consoles:
+                self.log.addHandler(handler)
+            self.executor.shutdown(wait=False)
+
+
+    def loop(self, screen):
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        screen.keypad(True)
+        if curses.has_colors():
+            curses.use_default_colors()
+            curses.init_pair(1, curses.COLOR_RED, -1)
+            curses.init_pair(2, curses.COLOR_YELLOW, -1)
+            curses.init_pair(3, curses.COLOR_GREEN, -1)
+
+        last_draw = last_repaint = 0.0
+        while not self.quit:
+            now = time.monotonic()
+            due = last_draw + (self.min_interval if self.dirty else self.refresh)
+            if now >= due:
+                if now - last_repaint >= REPAINT_INTERVAL:
+                    screen.redrawwin()
+                    last_repaint = now
+                self.draw(screen)
+                last_draw, self.dirty = now, False
+                due = now + self.refresh
+            #sleep until a key arrives or the next redraw is due
+            screen.timeout(max(int((due - now) * 1000), 10))
+            key = screen.getch()
+            if key != -1:
+                self.handle_key(key)
+
+
+    ##-------------------------------------------------------------------------
+    ## Keys
+    ##-------------------------------------------------------------------------
+    def handle_key(self, key):
+        self.dirty = True
+        if key == curses.KEY_RESIZE:
+            return
+        if self.prompt is not None:
+            if key in (10, 13, curses.KEY_ENTER):
+                port, self.prompt = self.prompt, None
+                if port:
+                    self.submit(f'c {port}')
+            elif key == 27:
+                self.prompt = None
+            elif key in (curses.KEY_BACKSPACE, 127, 8):
+                self.prompt = self.prompt[:-1]
+            elif 48 <= key <= 57 and len(self.prompt) < 5:
+                self.prompt += chr(key)
+            return
+
+        char = chr(key).lower() if 0 < key < 256 else ''
+        if char == 'q':
+            self.launcher.run_command('q')
+            self.quit = True
+        elif char == 'c':
+            self.prompt = ''
+        elif char in KEYS:
+            self.submit(char)
+
+
+    def submit(self, cmd):
+        if self.busy is not None:
+            self.output.write(f"Still running '{self.busy}', try again when it finishes\n")
+            return
+        self.busy = cmd
+        self.executor.submit(self.execute, cmd)
+
+
+    def execute(self, cmd):
+        try:
+            self.launcher.run_command(cmd)
+        except Exception as error:
+            self.log.error(f"Command '{cmd}' failed: {error}")
+            self.log.debug(traceback.format_exc())
+        finally:
+            self.busy = None
+            self.dirty = True
+
+
+    ##-------------------------------------------------------------------------
+    ## Drawing
+    ##-------------------------------------------------------------------------
+    def put(self, screen, y, x, text, attr=0):
+        height, width = screen.getmaxyx()
+        if y < 0 or y >= height or x >= width:
+            return
+        try:
+            screen.addnstr(y, x, text, width - x - (1 if y == height - 1 else 0), attr)
+        except curses.error:
+            pass
+
+
+    def color(self, pair, attr=0):
+        return (curses.color_pair(pair) | attr) if curses.has_colors() else attr
+
+
+    def draw(self, screen):
+        self.draws += 1
+        launcher = self.launcher
+        height, width = screen.getmaxyx()
+        screen.erase()
+
+        title = f" Lick Remote Observing (v{self.version})"
+        if launcher.tel:
+            title += f"  {launcher.tel} {launcher.instrument or ''} on {launcher.vncserver or ''}"
+        if launcher.start_time:
+            up = int(time.perf_counter() - launcher.start_time)
+            title += f"  up {up // 3600}:{up // 60 % 60:02d}:{up % 60:02d}"
+        self.put(screen, 0, 0, title.ljust(width), curses.A_REVERSE)
+        y = 1
+        result = launcher.version_result
+        if result is not None and result.status == 'behind':
+            self.put(screen, y, 1, f"Update available: v{result.remote}", self.color(2, curses.A_BOLD))
+            y += 1
+
+        #sessions
+        y += 1
+        self.put(screen, y, 1, f"{'Session':18s} {'Port':>6s}  {'Tunnel':12s} {'RTT':>8s}  "
+                               f"{'In/s':>9s} {'Out/s':>9s}  Viewer", curses.A_BOLD)
+        y += 1
+        for row in session_rows(launcher):
+            rtt = f"{row['rtt']*1000:.1f}ms" if row['rtt'] is not None else '-'
+            if row['health'] in ['degraded', 'dead']:
+                rtt = row['health'] if row['rtt'] is None else rtt + '!'
+            rate_in = f"{format_bytes(row['rate_in'])}" if row['rate_in'] is not None else '-'
+            rate_out = f"{format_bytes(row['rate_out'])}" if row['rate_out'] is not None else '-'
+            port = str(row['port']) if row['port'] is not None else '-'
+            line = (f"{row['name'][:18]:18s} {port:>6s}  {row['tunnel']:12s} {rtt:>8s}  "
+                    f"{rate_in:>9s} {rate_out:>9s}  {row['viewer']}")
+            bad = row['tunnel'].startswith('DOWN') or row['health'] == 'dead' or \
+                  row['viewer'].split(' ')[0] in ['crashed', 'failed', 'exited', 'stopped']
+            degraded = row['health'] == 'degraded'
+            attr = self.color(1, curses.A_BOLD) if bad else self.color(2) if degraded else 0
+            self.put(screen, y, 1, line, attr)
+            y += 1
+
+        #command output and messages share the rest, messages get the bottom
+        bottom = height - 2
+        room = bottom - y - 1
+        with self.output.lock:
+            output = list(self.output.lines)
+        output = [line for line in output if line.strip()]
+        messages = list(self.messages.lines)
+        out_rows = min(len(output), max(room // 2, room - len(messages))) if output else 0
+        msg_rows = room - out_rows - (1 if out_rows else 0)
+        if out_rows > 0:
+            y += 1
+            for line in output[-out_rows:]:
+                self.put(screen, y, 1, line)
+                y += 1
+        y = max(y + 1, bottom - msg_rows)
+        for level, line in messages[-msg_rows:] if msg_rows > 0 else []:
+            attr = self.color(1, curses.A_BOLD) if level >= logging.ERROR else \
+                   self.color(2) if level >= logging.WARNING else 0
+            self.put(screen, y, 1, line, attr)
+            y += 1
+
+        #footer
+        if self.prompt is not None:
+            footer = f" Close ssh tunnel on local port: {self.prompt}_   (Enter, Esc to cancel)"
+        elif self.busy is not None:
+            footer = f" Running '{self.busy}'...   {HELP}"
+        else:
+            footer = f" {HELP}"
+        self.put(screen, height - 1, 0, footer.ljust(width), curses.A_REVERSE)
+        screen.refresh()
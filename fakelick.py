@@ -0,0 +1,704 @@
+'''
+Offline stand-ins for the Lick servers, for end-to-end tests and startup
+benchmarks of the launcher without access to shimmy or noir.
+
+FakeLick starts a stub RFB server for every scripted VNC session (it sends
+the "RFB 003.008" banner like Xvnc) and a stub soundplay server, and writes
+fake programs into a temporary directory that goes first on the launcher's
+PATH:
+
+  ssh        runs remote commands from a script (whoami, hostname,
+             vncstatus, netstat, echo, true, exit, head -c, cat, and
+             cat >> file, which appends to the uploads), acts as a
+             ControlMaster on a unix socket (-M, -O forward/cancel/check)
+             and forwards ports (-L) to the stub servers.  handshake
+             seconds are added to every connection that does not ride on a
+             master, like the round trips of a real login.
+  scp        copies uploads into the harness directory
+  vncviewer  connects to the forwarded port, reads the RFB banner, records
+             that it is ready and exits 1 when the connection is lost
+  soundplay  connects to the forwarded soundplay port and stays connected
+
+The launcher itself runs unchanged as a subprocess (see launch()), with
+HTTPS_PROXY pointed at a closed port so the version check fails at once
+instead of going to GitHub.
+
+Run this file directly to benchmark cold start, time until all viewers are
+ready, reconnect after a killed tunnel and shutdown:
+  python fakelick.py --runs 5 --handshake 0.1
+'''
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+RFB_BANNER = b'RFB 003.008\n'
+SOUND_PORT = 9798
+
+DESKTOPS = ['Kast blue', 'Kast red', 'Kast Guider Camera',
+            'Kast Spare 1', 'Kast Spare 2', 'Kast Spare 3']
+
+PROGRAM = '''#!{python}
+import sys
+sys.path.insert(0, {repo!r})
+import fakelick
+fakelick.{function}({directory!r}, sys.argv[1:])
+'''
+
+
+class StubServer(object):
+    '''
+    A server on an ephemeral local port that sends the RFB banner (kind
+    'rfb') or nothing (kind 'sound') on connect and discards what it reads.
+    '''
+    def __init__(self, kind='rfb'):
+        self.kind = kind
+        self.connections = 0
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+    def handle(self, conn):
+        with conn:
+            try:
+                if self.kind == 'rfb':
+                    conn.sendall(RFB_BANNER)
+                while conn.recv(65536):
+                    pass
+            except OSError:
+                pass
+
+
+    def close(self):
+        self.server.close()
+
+
+class LauncherRun(object):
+    '''A launcher subprocess with its console output collected.
+    '''
+    def __init__(self, command, env, cwd):
+        self.started = time.time()
+        self.proc = subprocess.Popen(command, env=env, cwd=cwd,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+        self.chunks = []
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
+
+
+    def read(self):
+        fd = self.proc.stdout.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return
+            with self.lock:
+                self.chunks.append(chunk.decode(errors='replace'))
+
+
+    @property
+    def output(self):
+        with self.lock:
+            return ''.join(self.chunks)
+
+
+    def wait_for_output(self, text, timeout=30, start=0):
+        '''Seconds since launch when text appeared after offset start.'''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if text in self.output[start:]:
+                return time.time() - self.started
+            if self.proc.poll() is not None:
+                raise RuntimeError(f'launcher exited with {self.proc.returncode}:\n'
+                                   + self.output[-3000:])
+            time.sleep(0.01)
+        raise TimeoutError(f"no '{text}' after {timeout}s:\n" + self.output[-3000:])
+
+
+    def send(self, command, wait_for_prompt=True, timeout=30):
+        start = len(self.output)
+        self.proc.stdin.write(command.encode() + b'\n')
+        self.proc.stdin.flush()
+        if wait_for_prompt:
+            self.wait_for_output('> ', timeout, start)
+        return self.output[start:]
+
+
+    def quit(self, timeout=30):
+        '''Send q and return the seconds until the launcher exited.'''
+        start = time.time()
+        self.send('q', wait_for_prompt=False)
+        self.proc.wait(timeout)
+        elapsed = time.time() - start
+        self.reader.join(timeout)
+        return elapsed
+
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class FakeLick(object):
+
+    def __init__(self, desktops=DESKTOPS[:3], handshake=0.0, sound=True,
+                 user='user', hostname='shimmy'):
+        self.desktops = desktops
+        self.handshake = handshake
+        self.sound = sound
+        self.user = user
+        self.hostname = hostname
+        self.directory = None
+        self.stubs = {}
+        self.runs = []
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix='fakelick-')
+        for name in ['procs', 'viewers', 'uploads']:
+            os.mkdir(os.path.join(self.directory, name))
+
+        sessions = []
+        for i, desktop in enumerate(self.desktops):
+            display = i + 1
+            self.stubs[5900 + display] = StubServer('rfb')
+            sessions.append([display, desktop])
+        if self.sound:
+            self.stubs[SOUND_PORT] = StubServer('sound')
+
+        state = {'user': self.user, 'hostname': self.hostname,
+                 'handshake': self.handshake, 'sessions': sessions,
+                 'ports': {str(p): s.port for p, s in self.stubs.items()}}
+        with open(os.path.join(self.directory, 'state.json'), 'w') as FO:
+            json.dump(state, FO)
+
+        for name, function in [('ssh', 'fake_ssh'), ('scp', 'fake_scp'),
+                               ('vncviewer', 'fake_vncviewer'),
+                               ('soundplay', 'fake_soundplay')]:
+            path = os.path.join(self.directory, name)
+            with open(path, 'w') as FO:
+                FO.write(PROGRAM.format(python=sys.executable, repo=REPO,
+                                        function=function,
+                                        directory=self.directory))
+            os.chmod(path, 0o755)
+        return self
+
+
+    def stop(self):
+        for run in self.runs:
+            run.kill()
+        for info in self.ssh_processes():
+            try:
+                os.kill(info['pid'], signal.SIGKILL)
+            except OSError:
+                pass
+        for stub in self.stubs.values():
+            stub.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+    ##-------------------------------------------------------------------------
+    ## Run the launcher against the fake servers
+    ##-------------------------------------------------------------------------
+    def write_config(self, **settings):
+        config = {'vncviewer': os.path.join(self.directory, 'vncviewer'),
+                  'soundplayer': os.path.relpath(os.path.join(self.directory, 'soundplay'),
+                                                 os.path.join(REPO, 'soundplayer')),
+                  'aplay': 'true',
+                  'nosound': not self.sound,
+                  'local_port_start': 15901}
+        config.update(settings)
+        filename = os.path.join(self.directory, 'config.yaml')
+        with open(filename, 'w') as FO:
+            yaml.safe_dump(config, FO)
+        return filename
+
+
+    def launch(self, account='shane', args=(), **settings):
+        config = self.write_config(**settings)
+        env = dict(os.environ)
+        env['PATH'] = self.directory + os.pathsep + env.get('PATH', '')
+        #keep the version check off the network
+        for name in ['HTTPS_PROXY', 'https_proxy']:
+            env[name] = 'http://127.0.0.1:9'
+        env.pop('NO_PROXY', None)
+        env.pop('no_proxy', None)
+        command = [sys.executable, '-W', 'ignore',
+                   os.path.join(REPO, 'lick_vnc_launcher.py'), account,
+                   '-c', config] + list(args)
+        run = LauncherRun(command, env, self.directory)
+        self.runs.append(run)
+        return run
+
+
+    ##-------------------------------------------------------------------------
+    ## What the fake programs recorded
+    ##-------------------------------------------------------------------------
+    def viewers_ready(self):
+        '''Dict of local port to the time its viewer read the banner.'''
+        ready = {}
+        folder = os.path.join(self.directory, 'viewers')
+        for name in os.listdir(folder):
+            try:
+                with open(os.path.join(folder, name)) as FO:
+                    ready[int(name)] = json.load(FO)['ready']
+            except (OSError, ValueError):
+                pass
+        return ready
+
+
+    def wait_for_viewers(self, count=None, since=0, timeout=30):
+        '''Wait until count viewers were ready after since; returns the time.'''
+        count = len(self.desktops) if count is None else count
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            times = [t for t in self.viewers_ready().values() if t >= since]
+            if len(times) >= count:
+                return max(times)
+            time.sleep(0.01)
+        raise TimeoutError(f'{len(times)} of {count} viewers ready after {timeout}s')
+
+
+    def ssh_processes(self):
+        '''The running fake ssh processes: dicts of pid, role and ports.'''
+        processes = []
+        if self.directory is None:
+            return processes
+        folder = os.path.join(self.directory, 'procs')
+        for name in os.listdir(folder):
+            try:
+                with open(os.path.join(folder, name)) as FO:
+                    info = json.load(FO)
+                os.kill(info['pid'], 0)
+            except (OSError, ValueError):
+                continue
+            processes.append(info)
+        return processes
+
+
+    def kill_tunnel(self, local_port):
+        '''SIGKILL the ssh process forwarding local_port; returns its role.'''
+        for info in self.ssh_processes():
+            if local_port in info['ports']:
+                os.kill(info['pid'], signal.SIGKILL)
+                return info['role']
+        raise RuntimeError(f'no ssh process forwards port {local_port}')
+
+
+    def uploads(self):
+        return os.listdir(os.path.join(self.directory, 'uploads'))
+
+
+    def move_desktop(self, display, new_display):
+        '''
+        Move a desktop to another display, as after an Xvnc restart.  The
+        old display keeps answering, so viewers already on it stay up.
+        '''
+        state = load_state(self.directory)
+        for session in state['sessions']:
+            if session[0] == display:
+                session[0] = new_display
+        state['ports'][str(5900 + new_display)] = state['ports'][str(5900 + display)]
+        with open(os.path.join(self.directory, 'state.json'), 'w') as FO:
+            json.dump(state, FO)
+
+
+def port_state(port, timeout=1.0):
+    '''True if port sends an RFB banner, False if it refuses connections.'''
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    except OSError:
+        return False
+    with sock:
+        try:
+            return sock.recv(len(RFB_BANNER)) == RFB_BANNER
+        except OSError:
+            return False
+
+
+##-------------------------------------------------------------------------
+## The fake programs (run from the scripts FakeLick writes)
+##-------------------------------------------------------------------------
+def load_state(directory):
+    with open(os.path.join(directory, 'state.json')) as FO:
+        return json.load(FO)
+
+
+def parse_ssh_args(args):
+    '''
+    Split an ssh command line into options, server and remote command.
+    Like OpenSSH, options may also follow the server name.
+    '''
+    options = {'L': [], 'o': {}, 'flags': set()}
+    server = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ['-l', '-i', '-L', '-O', '-p', '-c']:
+            if arg == '-L':
+                options['L'].append(args[i+1])
+            else:
+                options[arg[1]] = args[i+1]
+            i += 2
+        elif arg.startswith('-o'):
+            key, _, value = arg[2:].partition('=')
+            options['o'][key] = value
+            i += 1
+        elif arg.startswith('-'):
+            options['flags'].update(arg[1:])
+            i += 1
+        elif server is None:
+            server = arg
+            i += 1
+        else:
+            return options, server, ' '.join(args[i:])
+    return options, server, None
+
+
+def control_path(options):
+    path = options['o'].get('ControlPath', None)
+    return None if path in [None, 'none'] else path
+
+
+def on_master(options):
+    path = control_path(options)
+    if path is None or options['o'].get('ControlMaster', 'no') != 'no':
+        return False
+    return os.path.exists(path)
+
+
+def record_process(directory, role, ports):
+    with open(os.path.join(directory, 'procs', f'{os.getpid()}.json'), 'w') as FO:
+        json.dump({'pid': os.getpid(), 'role': role, 'ports': ports}, FO)
+
+
+def forward_connection(conn, port):
+    try:
+        upstream = socket.create_connection(('127.0.0.1', port), timeout=5)
+    except OSError:
+        conn.close()
+        return
+    upstream.settimeout(None)
+
+    def pump(source, destination):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                destination.sendall(data)
+        except OSError:
+            pass
+        for sock in [source, destination]:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    threading.Thread(target=pump, args=(upstream, conn), daemon=True).start()
+    pump(conn, upstream)
+
+
+class Forwards(object):
+    '''The -L listeners of one fake ssh process.
+    '''
+    def __init__(self, state):
+        self.state = state
+        self.listeners = {}
+
+
+    def add(self, spec):
+        local, host, remote = spec.split(':')
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listener.bind(('127.0.0.1', int(local)))
+        except OSError:
+            listener.close()
+            #the messages OpenSSH prints
+            sys.stderr.write(f'bind [127.0.0.1]:{local}: Address already in use\n'
+                             f'channel_setup_fwd_listener_tcpip: cannot listen '
+                             f'to port: {local}\n')
+            sys.stderr.flush()
+            return False
+        listener.listen(16)
+        self.listeners[int(local)] = listener
+        target = self.state['ports'].get(remote, None)
+        threading.Thread(target=self.accept, args=(listener, target),
+                         daemon=True).start()
+        return True
+
+
+    def accept(self, listener, target):
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                return
+            if target is None:
+                #channel open failed: connect refused on the server
+                conn.close()
+                continue
+            threading.Thread(target=forward_connection, args=(conn, target),
+                             daemon=True).start()
+
+
+    def cancel(self, spec):
+        listener = self.listeners.pop(int(spec.split(':')[0]), None)
+        if listener is not None:
+            listener.close()
+
+
+def serve_master(directory, state, path):
+    forwards = Forwards(state)
+    record_process(directory, 'master', [])
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+    while True:
+        conn, addr = server.accept()
+        with conn:
+            request = json.loads(conn.makefile().readline())
+            ok = True
+            for spec in request['forwards']:
+                if request['op'] == 'forward':
+                    ok = forwards.add(spec) and ok
+                elif request['op'] == 'cancel':
+                    forwards.cancel(spec)
+            record_process(directory, 'master', sorted(forwards.listeners))
+            conn.sendall(b'ok\n' if ok else b'error\n')
+
+
+def run_remote(state, command, directory):
+    '''Run a remote command line from the script; returns the exit status.'''
+    out = sys.stdout.buffer
+    status = 0
+    for part in command.split(';'):
+        words = part.split()
+        if len(words) == 0:
+            continue
+        name = words[0]
+        if name == 'echo':
+            out.write((' '.join(words[1:]) + '\n').encode())
+        elif name == 'true' or name == 'setenv':
+            status = 0
+        elif name == 'false':
+            status = 1
+        elif name == 'exit':
+            return int(words[1]) if len(words) > 1 else status
+        elif name == 'whoami':
+            out.write(f"{state['user']}\n".encode())
+        elif name == 'hostname':
+            out.write(f"{state['hostname']}\n".encode())
+        elif name == 'vncstatus':
+            out.write(b'#display - desktop\n')
+            for display, desktop in state['sessions']:
+                out.write(f'{display} - kast{display} {desktop}\n'.encode())
+        elif name == 'netstat':
+            #the probe greps the output for the port, failing when it is absent
+            if str(SOUND_PORT) in state['ports']:
+                out.write(f'tcp 0 0 0.0.0.0:{SOUND_PORT} 0.0.0.0:* LISTEN\n'.encode())
+                status = 0
+            else:
+                status = 1
+        elif name == 'head' and '-c' in words:
+            size = int(words[words.index('-c') + 1])
+            out.write(os.urandom(size))
+        elif name == 'cat' and len(words) == 3 and words[1] == '>>':
+            name = os.path.basename(words[2])
+            with open(os.path.join(directory, 'uploads', name), 'ab') as FO:
+                shutil.copyfileobj(sys.stdin.buffer, FO)
+        elif name == 'cat' and len(words) == 1:
+            out.flush()
+            os.execvp('cat', ['cat'])
+        else:
+            sys.stderr.write(f'{name}: Command not found.\n')
+            status = 127
+        out.flush()
+    return status
+
+
+def fake_ssh(directory, args):
+    state = load_state(directory)
+    options, server, command = parse_ssh_args(args)
+    path = control_path(options)
+
+    if 'O' in options:
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+        except (OSError, TypeError):
+            sys.stderr.write(f'Control socket connect({path}): No such file or directory\n')
+            sys.exit(255)
+        request = {'op': options['O'], 'forwards': options['L']}
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        reply = sock.makefile().readline().strip()
+        sys.exit(0 if reply == 'ok' else 255)
+
+    if not on_master(options):
+        time.sleep(state['handshake'])
+
+    if 'M' in options['flags'] and path is not None:
+        serve_master(directory, state, path)
+
+    if 'N' in options['flags']:
+        forwards = Forwards(state)
+        for spec in options['L']:
+            if not forwards.add(spec) and \
+                    options['o'].get('ExitOnForwardFailure', 'no') == 'yes':
+                sys.exit(255)
+        record_process(directory, 'tunnel', sorted(forwards.listeners))
+        while True:
+            time.sleep(1000)
+
+    sys.exit(run_remote(state, command or '', directory))
+
+
+def fake_scp(directory, args):
+    state = load_state(directory)
+    options, server, rest = parse_ssh_args(args)
+    if not on_master(options):
+        time.sleep(state['handshake'])
+    source, destination = args[-2], args[-1]
+    name = os.path.basename(destination.split(':', 1)[-1])
+    shutil.copy(source, os.path.join(directory, 'uploads', name))
+
+
+def connect_and_hold(address, banner):
+    port = int(re.split(r':+', address)[-1])
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+        if banner and sock.recv(len(RFB_BANNER)) != RFB_BANNER:
+            sys.exit(1)
+    except OSError:
+        sys.exit(1)
+    return port, sock
+
+
+def fake_vncviewer(directory, args):
+    port, sock = connect_and_hold(args[-1], banner=True)
+    ready = os.path.join(directory, 'viewers', str(port))
+    with open(ready + '.tmp', 'w') as FO:
+        json.dump({'ready': time.time(), 'pid': os.getpid()}, FO)
+    os.replace(ready + '.tmp', ready)
+    sock.settimeout(None)
+    try:
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+    #a real viewer exits with an error when the server goes away
+    sys.exit(1)
+
+
+def fake_soundplay(directory, args):
+    port, sock = connect_and_hold(args[args.index('-s') + 1], banner=False)
+    sock.settimeout(None)
+    try:
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+    sys.exit(1)
+
+
+##-------------------------------------------------------------------------
+## Benchmark startup, reconnect and shutdown
+##-------------------------------------------------------------------------
+def benchmark_run(lick, **settings):
+    '''
+    One launcher run; returns a dict of seconds for startup (menu shown),
+    viewers (all viewers read the banner), reconnect (a killed tunnel
+    forwards again) and shutdown (q to exit).
+    '''
+    run = lick.launch(**settings)
+    try:
+        result = {'startup': run.wait_for_output('MENU')}
+        result['viewers'] = lick.wait_for_viewers(since=run.started) - run.started
+
+        port = sorted(lick.viewers_ready())[0]
+        killed = time.time()
+        lick.kill_tunnel(port)
+        deadline = killed + 60
+        while port_state(port) and time.time() < deadline:
+            time.sleep(0.01)
+        while not port_state(port) and time.time() < deadline:
+            time.sleep(0.01)
+        result['reconnect'] = time.time() - killed
+
+        result['shutdown'] = run.quit()
+    finally:
+        run.kill()
+    for name in os.listdir(os.path.join(lick.directory, 'viewers')):
+        os.remove(os.path.join(lick.directory, 'viewers', name))
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the launcher against fake Lick servers.")
+    parser.add_argument("--runs", type=int, dest="runs", default=3, help="Launcher runs.")
+    parser.add_argument("--sessions", type=int, dest="sessions", default=3,
+                        help="VNC sessions on the fake server (1-6).")
+    parser.add_argument("--handshake", type=float, dest="handshake", default=0.0,
+                        help="Seconds added to every new ssh connection.")
+    parser.add_argument("--tunnel-mode", type=str, dest="tunnel_mode", default='shared',
+                        help="tunnel_mode config: shared or separate.")
+    parser.add_argument("--no-multiplex", dest="multiplex", default=True, action="store_false",
+                        help="Set ssh_multiplex False.")
+    parser.add_argument("--nosound", dest="sound", default=True, action="store_false",
+                        help="No soundplay tunnel.")
+    args = parser.parse_args()
+
+    settings = {'tunnel_mode': args.tunnel_mode, 'ssh_multiplex': args.multiplex}
+    results = []
+    with FakeLick(DESKTOPS[:args.sessions], args.handshake, args.sound) as lick:
+        for i in range(args.runs):
+            result = benchmark_run(lick, **settings)
+            print(f"  run {i+1}: " + ', '.join(f"{k} {v:.2f}s" for k, v in result.items()))
+            results.append(result)
+
+    print(f"\n  {'':10s} | {'median':>8s} | {'min':>8s} | {'max':>8s}")
+    for key in ['startup', 'viewers', 'reconnect', 'shutdown']:
+        values = [r[key] for r in results]
+        print(f"  {key:10s} | {statistics.median(values):7.2f}s | "
+              f"{min(values):7.2f}s | {max(values):7.2f}s")
@@ -0,0 +1,313 @@
+'''
+Active health checks through the local end of each ssh tunnel.
+
+A forwarded port always accepts connections locally, even when the remote
+Xvnc is hung or the forward behind it is half dead.  Instead, the VNC
+tunnels are checked by reading the RFB protocol banner ("RFB 003.008\n")
+that every VNC server sends as soon as a client connects, and the time to
+the banner is kept as a latency sample.  The soundplay server sends nothing
+on connect, so its tunnel is alive if the connection stays open; it is
+only checked while the local soundplay process runs, since nothing else
+uses that tunnel.
+
+HealthChecker runs these checks on a schedule for every tunnel in the
+launcher's ports_in_use, marks sessions ok, degraded or dead, and asks the
+launcher to rebuild the tunnel of a dead session.
+
+Run this file directly to check one or more local ports by hand.
+'''
+import argparse
+import collections
+import concurrent.futures
+import re
+import socket
+import threading
+import time
+import traceback
+
+
+RFB_BANNER = re.compile(rb'^RFB (\d{3})\.(\d{3})\n$')
+RFB_BANNER_LENGTH = 12
+
+
+class HealthError(Exception):
+    pass
+
+
+##-------------------------------------------------------------------------
+## Read and validate the RFB banner
+##-------------------------------------------------------------------------
+def rfb_banner(port, host='127.0.0.1', timeout=3.0):
+    '''
+    Connect to host:port and read the RFB server banner.  Returns the
+    protocol version (e.g. '3.8') and the seconds from connecting to the
+    full banner; raises HealthError if it is missing or malformed.
+    '''
+    start = time.perf_counter()
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except OSError as error:
+        raise HealthError(f'connect failed: {error}')
+    try:
+        data = b''
+        while len(data) < RFB_BANNER_LENGTH:
+            try:
+                chunk = sock.recv(RFB_BANNER_LENGTH - len(data))
+            except socket.timeout:
+                raise HealthError(f'no RFB banner after {timeout}s')
+            except OSError as error:
+                raise HealthError(f'read failed: {error}')
+            if not chunk:
+                raise HealthError('connection closed before RFB banner')
+            data += chunk
+    finally:
+        sock.close()
+    latency = time.perf_counter() - start
+
+    match = RFB_BANNER.match(data)
+    if match is None:
+        raise HealthError(f'bad RFB banner {data!r}')
+    version = f'{int(match.group(1))}.{int(match.group(2))}'
+    return version, latency
+
+
+##-------------------------------------------------------------------------
+## Liveness of a server that sends nothing on connect (soundplay)
+##-------------------------------------------------------------------------
+def stream_alive(port, host='127.0.0.1', timeout=3.0, hold=0.5):
+    '''
+    Connect to host:port and check the connection is still open after hold
+    seconds.  An ssh forward whose remote end is gone accepts the local
+    connection and then closes it straight away.  Returns the seconds to
+    connect; raises HealthError if the connection fails or is closed.
+    '''
+    start = time.perf_counter()
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except OSError as error:
+        raise HealthError(f'connect failed: {error}')
+    latency = time.perf_counter() - start
+    try:
+        sock.settimeout(hold)
+        try:
+            data = sock.recv(1024)
+        except socket.timeout:
+            return latency
+        except OSError as error:
+            raise HealthError(f'read failed: {error}')
+        if not data:
+            raise HealthError('connection closed by remote end')
+        return latency
+    finally:
+        sock.close()
+
+
+class SessionHealth(object):
+    '''An object to contain the health history of one session's tunnel.
+    '''
+    def __init__(self, samples=100):
+        self.state = 'unknown'
+        self.latency = None
+        self.samples = collections.deque(maxlen=samples)
+        self.version = None
+        self.failures = 0
+        self.checks = 0
+        self.error = None
+        self.checked = None
+        self.rebuilds = 0
+
+    def __str__(self):
+        if self.state == 'ok' or (self.state == 'degraded' and self.failures == 0):
+            return f"{self.state} {self.latency*1000:.1f}ms"
+        if self.error:
+            return f"{self.state}: {self.error}"
+        return self.state
+
+
+class HealthChecker(object):
+
+    def __init__(self, launcher, interval=15.0, timeout=3.0, slow=1.0,
+                 max_failures=3, rebuild=True):
+        self.launcher = launcher
+        self.log = launcher.log
+        self.interval = interval
+        self.timeout = timeout
+        self.slow = slow
+        self.max_failures = max_failures
+        self.rebuild = rebuild
+        self.health = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.timeout + 5)
+            self.thread = None
+
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                self.log.error('Health checker error, see log for details')
+                self.log.debug(traceback.format_exc())
+
+
+    def session_health(self, session_name):
+        with self.lock:
+            if session_name not in self.health:
+                self.health[session_name] = SessionHealth()
+            return self.health[session_name]
+
+
+    ##-------------------------------------------------------------------------
+    ## Check one tunnel
+    ##-------------------------------------------------------------------------
+    def probe(self, tunnel):
+        '''
+        Return (version, latency) for the tunnel's local port, version is
+        None for soundplay.  Raises HealthError.
+        '''
+        if tunnel.session_name == 'soundplay':
+            return None, stream_alive(tunnel.local_port, timeout=self.timeout)
+        return rfb_banner(tunnel.local_port, timeout=self.timeout)
+
+
+    def soundplay_running(self):
+        #poll() of the launcher's soundplay process, no connection needed
+        sound = self.launcher.sound
+        return sound is not None and sound.proc is not None \
+               and sound.proc.poll() is None
+
+
+    ##-------------------------------------------------------------------------
+    ## One pass over all tunnels
+    ##-------------------------------------------------------------------------
+    def check(self):
+        '''
+        Probe every ready tunnel whose ssh process is running (dead
+        processes are the tunnel supervisor's job) and update its health.
+        The soundplay tunnel is skipped while soundplay is not running.
+        '''
+        with self.launcher.tunnel_lock:
+            tunnels = [t for t in self.launcher.ports_in_use.values()
+                       if t.ready and t.is_alive()]
+        if any(t.session_name == 'soundplay' for t in tunnels) \
+                and not self.soundplay_running():
+            tunnels = [t for t in tunnels if t.session_name != 'soundplay']
+        if len(tunnels) == 0:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(len(tunnels)) as pool:
+            futures = {pool.submit(self.probe, t): t for t in tunnels}
+            for future in concurrent.futures.as_completed(futures):
+                tunnel = futures[future]
+                try:
+                    version, latency = future.result()
+                except HealthError as error:
+                    self.failed(tunnel, str(error))
+                else:
+                    self.passed(tunnel, version, latency)
+
+
+    def passed(self, tunnel, version, latency):
+        health = self.session_health(tunnel.session_name)
+        previous = health.state
+        health.checks += 1
+        health.checked = time.time()
+        health.failures = 0
+        health.error = None
+        health.latency = latency
+        health.samples.append(latency)
+        if version is not None:
+            health.version = version
+        health.state = 'degraded' if latency > self.slow else 'ok'
+
+        name = tunnel.session_name
+        if health.state == 'degraded' and previous != 'degraded':
+            self.log.warning(f"Session '{name}' is slow: {latency:.2f}s to "
+                             f"respond on port {tunnel.local_port}",
+                             extra={'session': name, 'port': tunnel.local_port,
+                                    'duration': latency})
+        elif health.state == 'ok' and previous in ['degraded', 'dead']:
+            self.log.info(f"Session '{name}' is healthy again "
+                          f"({latency*1000:.0f}ms)")
+        else:
+            self.log.debug(f"Session '{name}' responded in {latency*1000:.1f}ms",
+                           extra={'session': name, 'port': tunnel.local_port,
+                                  'duration': latency})
+
+
+    def failed(self, tunnel, error):
+        health = self.session_health(tunnel.session_name)
+        health.checks += 1
+        health.checked = time.time()
+        health.failures += 1
+        health.error = error
+        name = tunnel.session_name
+
+        if health.failures < self.max_failures:
+            health.state = 'degraded'
+            self.log.warning(f"Session '{name}' failed health check on port "
+                             f"{tunnel.local_port}: {error}",
+                             extra={'session': name, 'port': tunnel.local_port})
+            return
+
+        if health.state != 'dead':
+            self.log.error(f"Session '{name}' is not responding on port "
+                           f"{tunnel.local_port} after {health.failures} "
+                           f"checks: {error}",
+                           extra={'session': name, 'port': tunnel.local_port})
+        health.state = 'dead'
+        #rebuild once when the session is declared dead, then once for every
+        # max_failures more failures
+        if health.failures % self.max_failures != 0:
+            return
+        if not self.rebuild or not self.launcher.can_reconnect(tunnel):
+            return
+        health.rebuilds += 1
+        try:
+            self.launcher.rebuild_tunnel(tunnel)
+        except Exception as error:
+            self.log.error(f"  Could not rebuild tunnel for '{name}': {error}")
+            self.log.debug(traceback.format_exc())
+
+
+    def status(self, session_name):
+        with self.lock:
+            health = self.health.get(session_name)
+        return '' if health is None else str(health)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Check VNC (RFB banner) or soundplay ports.")
+    parser.add_argument("ports", type=int, nargs='+', help="Local ports to check.")
+    parser.add_argument("--host", type=str, dest="host", default='127.0.0.1', help="Host to connect to.")
+    parser.add_argument("--timeout", type=float, dest="timeout", default=3.0, help="Seconds to wait for a response.")
+    parser.add_argument("--sound", dest="sound", default=False, action="store_true",
+                        help="Ports are soundplay servers (no banner).")
+    args = parser.parse_args()
+
+    for port in args.ports:
+        try:
+            if args.sound:
+                latency = stream_alive(port, args.host, args.timeout)
+                print(f"  {port:6d} | alive      | {latency*1000:8.1f} ms")
+            else:
+                version, latency = rfb_banner(port, args.host, args.timeout)
+                print(f"  {port:6d} | RFB {version:6s} | {latency*1000:8.1f} ms")
+        except HealthError as error:
+            print(f"  {port:6d} | FAILED     | {error}")
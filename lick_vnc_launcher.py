@@ -8,14 +8,18 @@ import sys
 
 import argparse
 import atexit
+import concurrent.futures
 import datetime
 import getpass
+import json
 import logging
 import math
 import pathlib 
 import platform
+import shutil
 import socket
 import subprocess
+import tempfile
 import telnetlib
 import threading
 import time
@@ -25,7 +29,21 @@ import warnings
 import yaml
 
 
+import dashboard
+import healthcheck
+import localports
+import logpipeline
+import logupload
+import metrics
+import profiler
+import relay
+import sshtune
 import soundplay
+import sshtransport
+import supervisor
+import taskgraph
+import versioncheck
+import vncprofile
 
 __version__ = '0.92'
 
@@ -45,15 +63,52 @@ class VNCSession(object):
     def __str__(self):
         return f"  {self.name:12s} {self.display:5s} {self.desktop:s}"
 
+
+class SSHTunnel(object):
+    '''An object to contain information about an ssh port forward.
+
+    mode is 'separate' for a forward with its own ssh process, 'batch' for
+    one of several forwards carried by a single ssh process, 'master' for
+    a forward added to the multiplexed master connection and 'inprocess'
+    for a forward over the in-process (paramiko) ssh connection.
+    '''
+    def __init__(self, local_port, server, account, remote_port,
+                 session_name='unknown', proc=None, mode='separate'):
+        self.local_port = local_port
+        self.server = server
+        self.account = account
+        self.remote_port = remote_port
+        self.session_name = session_name
+        self.proc = proc
+        self.mode = mode
+        self.ready = False
+
+    @property
+    def address_and_port(self):
+        return f"{self.account}@{self.server}:{self.remote_port}"
+
+    @property
+    def forwarding(self):
+        return f"{self.local_port}:localhost:{self.remote_port}"
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def __str__(self):
+        return f"  {self.local_port:10d} | {self.session_name:9s} | {self.address_and_port:s}"
+
 class LickVncLauncher(object):
 
     def __init__(self):
         #init vars we need to shutdown app properly
+        self.args = None
         self.config = None
+        self.config_file = None
         self.sound = None
         self.firewall_pass = None
 #         self.ssh_threads = None
         self.ports_in_use = {}
+        self.tunnel_lock = threading.Lock()
         self.vnc_threads  = []
         self.vnc_processes = []
         self.do_authenticate = False
@@ -63,8 +118,41 @@ class LickVncLauncher(object):
         self.tel = None
         self.vncserver = None
         self.ssh_key_valid = False
+        self.vnc_password = None
+        self.sessions_found = []
+        self.use_sound = False
         self.exit = False
 
+        #ssh connection multiplexing (one master connection per server)
+        self.ssh_masters = {}
+        self.ssh_control_dir = None
+
+        #ssh transports per (server, account), see get_ssh_transport
+        self.ssh_transports = {}
+        self.transport_lock = threading.Lock()
+
+        #result of the combined whoami/hostname/vncstatus/soundplay probe
+        self.remote_probe = None
+
+        self.profiler = None
+        #queued, rotating log files, see create_logger
+        self.log_pipeline = None
+        self.log_upload_thread = None
+        self.version_result = None
+        self.tunnel_supervisor = None
+        self.viewer_supervisor = None
+        self.health_checker = None
+        self.relay_manager = None
+        self.link_monitor = None
+        self.metrics_server = None
+        self.startup_graph = None
+        self.start_time = None
+
+        self.tunnel_mode = 'shared'
+        self.ssh_backend = 'openssh'
+
+        self.use_native = False
+        self.native_port_backend = None
         self.use_ps = False
         self.use_netstat = False        
         self.use_ss = False
@@ -95,6 +183,16 @@ class LickVncLauncher(object):
         # so assign localport to constant to avoid conflict
         self.STATUS_PORT       = ':1'
         self.LOCAL_PORT_START  = 5901
+        self.SOUND_PORT        = 9798
+
+        #marks the start of each section of the remote probe output
+        self.PROBE_MARKER = '==KRO:'
+
+        #ssh messages meaning a local forward could not be set up
+        self.SSH_FORWARD_FAILURES = ['cannot listen to port',
+                                     'Could not request local forwarding',
+                                     'Address already in use',
+                                     'forwarding failed']
 
 
 
@@ -102,7 +200,10 @@ class LickVncLauncher(object):
     ## Start point (main)
     ##-------------------------------------------------------------------------
     def start(self):
-    
+
+        self.start_time = time.perf_counter()
+        self.profiler = profiler.Profiler(t0=self.start_time, log=self.log)
+
         ##---------------------------------------------------------------------
         ## Parse command line args and get config
         ##---------------------------------------------------------------------
@@ -110,16 +211,14 @@ class LickVncLauncher(object):
         self.get_args()
         self.get_config()
         self.check_config()
+        self.configure_logging()
+        self.start_metrics()
 
         ##---------------------------------------------------------------------
         ## Log basic system info
         ##---------------------------------------------------------------------
         self.log_system_info()
-        self.check_version()
-
 
-        self.how_check_local_port()
-        
         ##---------------------------------------------------------------------
         ## Determine instrument
         ##---------------------------------------------------------------------
@@ -127,23 +226,26 @@ class LickVncLauncher(object):
         if not self.instrument: 
             self.exit_app(f'Invalid instrument account: "{self.args.account}"')
 
+        if self.args.tune_ssh:
+            self.tune_ssh()
+            self.exit_app()
+
 
         ##---------------------------------------------------------------------
         ## Validate ssh key or use alt method?
         ##---------------------------------------------------------------------
-        if self.args.nosshkey is False and self.config.get('nosshkey', None) is None:
-            self.validate_ssh_key()
-            if not self.ssh_key_valid:
-                self.log.error("\n\n\tCould not validate SSH key.\n\t"\
-                          "Contact sa@ucolick.org "\
-                          "for other options to connect remotely.\n")
-                self.exit_app()
-        else:
+        use_sshkey = self.args.nosshkey is False and \
+                     self.config.get('nosshkey', None) is None
+        if not use_sshkey:
             while self.vnc_password is None:
                 vnc_password = getpass.getpass(f"Password for user {self.args.account}: ")
                 vnc_password = vnc_password.strip()
                 if vnc_password != '':
                      self.vnc_password = vnc_password
+            # password path: type the password once for the master connection
+            self.vncserver = self.get_ssh_server()
+            self.start_ssh_master(self.vncserver, self.args.account,
+                                  password_prompt=True)
 
 
         ##---------------------------------------------------------------------
@@ -156,56 +258,235 @@ class LickVncLauncher(object):
 
 
         ##---------------------------------------------------------------------
-        ## Determine VNC Sessions
-        ##---------------------------------------------------------------------
-        if self.ssh_key_valid:
-            # self.engv_account = self.get_engv_account(self.instrument)
-            self.sessions_found = self.get_vnc_sessions(self.vncserver,
-                                                        self.instrument,
-                                                        self.ssh_account,
-                                                        self.args.account)
-
-        if self.args.authonly is False and\
-                (not self.sessions_found or len(self.sessions_found) == 0):
-            self.exit_app('No VNC sessions found')
-
-
-        ##---------------------------------------------------------------------
-        ## Open requested sessions
+        ## Run startup steps, independent ones concurrently:
+        ##   version, port tools, geometry, ssh key -> sessions -> tunnels
+        ##   -> viewers and soundplay
         ##---------------------------------------------------------------------
-        self.calc_window_geometry()
 #         self.ssh_threads  = []
         self.ports_in_use = {}
         self.vnc_threads  = []
         self.vnc_processes = []
-        for s in self.sessions_found:
-            self.start_vnc_session(s.name)
+        self.use_sound = self.args.nosound is False and \
+                         self.config.get('nosound', False) != True
+
+        if self.ssh_forward and self.config.get('relay', False):
+            self.relay_manager = relay.RelayManager(self.log,
+                        log_interval=self.config.get('relay_log_interval', 300),
+                        engine=self.config.get('relay_engine', 'auto'))
+
+        self.viewer_supervisor = supervisor.ViewerSupervisor(self,
+                    interval=self.config.get('viewer_check_interval', 2),
+                    restart_crashed=self.config.get('viewer_restart', True))
+
+        #the version check reports whenever it finishes, startup never waits
+        if self.config.get('version_check', True):
+            threading.Thread(target=self.check_version, daemon=True).start()
+
+        graph = taskgraph.TaskGraph(log=self.log)
+        graph.add('port tools', self.how_check_local_port)
+        graph.add('geometry', self.calc_window_geometry)
+        key_deps = []
+        if use_sshkey:
+            graph.add('ssh key', self.startup_ssh_key)
+            key_deps = ['ssh key']
+        #a cached session list lets tunnels start without waiting for vncstatus
+        cached = None
+        if use_sshkey:
+            cached = self.load_session_cache(self.get_ssh_server(), self.instrument)
+        if cached:
+            graph.add('sessions', self.startup_cached_sessions, args=(cached,))
+        else:
+            graph.add('sessions', self.startup_sessions, deps=key_deps)
+        graph.add('tunnels', self.startup_tunnels,
+                  deps=['sessions', 'port tools'] + key_deps)
+        viewer_deps = ['tunnels', 'geometry']
+        if self.uses_auto_profile():
+            self.link_monitor = vncprofile.LinkMonitor(self,
+                        interval=self.config.get('vnc_auto_interval', 60))
+            graph.add('link', self.measure_link, deps=key_deps)
+            viewer_deps.append('link')
+        graph.add('viewers', self.startup_viewers, deps=viewer_deps)
+        if self.use_sound:
+            graph.add('soundplay', self.start_soundplay, deps=['tunnels'])
+        self.startup_graph = graph
+        graph.run(t0=self.start_time)
+        self.print_startup_timing(graph)
+        self.log.info('Startup profile:\n' + '\n'.join(self.profiler.summary()))
+        self.write_profile()
+
+        if 'ssh key' in graph.errors:
+            self.log.error("\n\n\tCould not validate SSH key.\n\t"\
+                      "Contact sa@ucolick.org "\
+                      "for other options to connect remotely.\n")
+            self.exit_app()
+        if 'sessions' in graph.errors:
+            self.exit_app(str(graph.errors['sessions']))
+        for name, error in graph.errors.items():
+            self.log.error(f"Startup step '{name}' failed: {error}")
 
+        if cached:
+            threading.Thread(target=self.refresh_sessions, daemon=True).start()
 
-        ##---------------------------------------------------------------------
-        ## Open Soundplay
-        ##---------------------------------------------------------------------
-        sound = None
-        if self.args.nosound is False and self.config.get('nosound', False) != True:
-            self.start_soundplay()
+        if self.ssh_forward:
+            self.tunnel_supervisor = supervisor.TunnelSupervisor(self,
+                        interval=self.config.get('tunnel_check_interval', 1),
+                        reconnect=self.config.get('tunnel_reconnect', True))
+            self.tunnel_supervisor.start()
+        if self.ssh_forward and self.config.get('health_check', True):
+            self.health_checker = healthcheck.HealthChecker(self,
+                        interval=self.config.get('health_check_interval', 15),
+                        timeout=self.config.get('health_timeout', 3),
+                        slow=self.config.get('health_slow', 1.0),
+                        max_failures=self.config.get('health_max_failures', 3),
+                        rebuild=self.config.get('tunnel_reconnect', True))
+            self.health_checker.start()
+        self.viewer_supervisor.start()
+        if self.link_monitor is not None and self.link_monitor.profile is not None \
+                and self.config.get('vnc_auto_adjust', True):
+            self.link_monitor.start()
 
 
         ##---------------------------------------------------------------------
         ## Wait for quit signal, then all done
         ##---------------------------------------------------------------------
         atexit.register(self.exit_app, msg="App exit")
-        self.prompt_menu()
+        if self.config.get('dashboard', True) and dashboard.available():
+            self.run_dashboard()
+        else:
+            self.prompt_menu()
         self.exit_app()
         #todo: Do we need to call exit here explicitly?  App was not exiting on
         # MacOs but does on linux.
 
 
+    ##-------------------------------------------------------------------------
+    ## Startup steps (run from the startup task graph)
+    ##-------------------------------------------------------------------------
+    @profiler.profiled('ssh key')
+    def startup_ssh_key(self):
+        self.change_mod()
+        self.start_ssh_master(self.get_ssh_server(), self.ssh_account)
+        self.validate_ssh_key()
+        if not self.ssh_key_valid:
+            raise RuntimeError('Could not validate SSH key')
+
+
+    @profiler.profiled('sessions')
+    def startup_sessions(self):
+        if self.ssh_key_valid:
+            # self.engv_account = self.get_engv_account(self.instrument)
+            self.sessions_found = self.get_vnc_sessions(self.vncserver,
+                                                        self.instrument,
+                                                        self.ssh_account,
+                                                        self.args.account)
+            self.save_session_cache(self.vncserver, self.instrument,
+                                    self.sessions_found)
+
+        if self.args.authonly is False and\
+                (not self.sessions_found or len(self.sessions_found) == 0):
+            raise RuntimeError('No VNC sessions found')
+
+
+    @profiler.profiled('sessions')
+    def startup_cached_sessions(self, sessions):
+        self.sessions_found = sessions
+
+
+    @profiler.profiled('tunnels')
+    def startup_tunnels(self):
+        #only ask ssh for the forwards here; each viewer waits for its own
+        if self.ssh_forward and self.tunnel_mode == 'shared':
+            self.open_session_tunnels(self.sessions_found, self.use_sound,
+                                      wait=False)
+
+
+    @profiler.profiled('viewers')
+    def startup_viewers(self):
+        self.start_vnc_sessions([s.name for s in self.sessions_found])
+        #viewers are up once every vncviewer process has been spawned
+        for t in self.vnc_threads:
+            t.join()
+
+
+    ##-------------------------------------------------------------------------
+    ## Start several VNC sessions concurrently
+    ##-------------------------------------------------------------------------
+    def start_vnc_sessions(self, session_names):
+        '''
+        Bring up the tunnel and viewer of every session on a bounded thread
+        pool; a viewer is launched as soon as its own tunnel is ready and a
+        failing session does not hold up the others.
+        '''
+        max_workers = self.config.get('max_parallel_tunnels', 6)
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            futures = {pool.submit(self.start_vnc_session, name): name
+                       for name in session_names}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    ok = future.result()
+                except Exception:
+                    trace = traceback.format_exc()
+                    self.log.debug(trace)
+                    ok = False
+                if not ok:
+                    failed.append(name)
+
+        if len(failed) > 0:
+            self.log.error(f"Could not open {len(failed)} of "
+                           f"{len(session_names)} VNC sessions: "
+                           + ', '.join(failed))
+        return failed
+
+
+    ##-------------------------------------------------------------------------
+    ## Print timing of startup steps
+    ##-------------------------------------------------------------------------
+    def print_startup_timing(self, graph):
+
+        lines = ["Startup timing:",
+                 f"  {'Step':12s} | {'Start':>7s} | {'Duration':>8s}"]
+        for task in sorted(graph.tasks.values(),
+                           key=lambda t: t.start if t.start is not None else 1e9):
+            if task.name in graph.skipped:
+                lines.append(f"  {task.name:12s} | {'':>7s} | {'skipped':>8s}")
+            else:
+                status = ' (failed)' if task.name in graph.errors else ''
+                lines.append(f"  {task.name:12s} | {task.start:6.2f}s | "
+                             f"{task.duration:7.2f}s{status}")
+        if 'viewers' in graph.results:
+            viewers_up = graph.tasks['viewers'].end
+            lines.append(f"  All viewers up after {viewers_up:.2f}s")
+        self.log.info('\n'.join(lines))
+
+
+    def profile_failure(self, reason):
+        #reason the running profiled phase failed without raising
+        if self.profiler is not None:
+            self.profiler.fail(reason)
+
+
+    def write_profile(self):
+        filename = getattr(self.args, 'profile', None)
+        if filename is None or self.profiler is None:
+            return
+        try:
+            self.profiler.write_trace(filename)
+        except Exception as error:
+            self.log.error(f"Could not write profile {filename}: {error}")
+            self.log.debug(traceback.format_exc())
+            return
+        self.log.debug(f"Wrote profile trace to {filename}")
+
+
     ##-------------------------------------------------------------------------
     ## Start VNC session
     ##-------------------------------------------------------------------------
     def start_vnc_session(self, session_name):
 
-        self.log.info(f"Opening VNCviewer for '{session_name}'")
+        self.log.info(f"Opening VNCviewer for '{session_name}'",
+                      extra={'session': session_name})
 
 #         try:
         #get session data by name
@@ -218,7 +499,7 @@ class LickVncLauncher(object):
         if not session:
             self.log.error(f"No server VNC session found for '{session_name}'.")
             self.print_sessions_found()
-            return
+            return False
 
         #determine vncserver (only different for "status")
         vncserver = self.vncserver
@@ -235,13 +516,12 @@ class LickVncLauncher(object):
             password = None if self.ssh_key_valid else self.vnc_password
 
             # determine if there is already a tunnel for this session
-            local_port = None
-            for p in self.ports_in_use.keys():
-                if session_name == self.ports_in_use[p][1]:
-                    local_port = p
-                    self.log.info(f"Found existing SSH tunnel on port {port}")
-                    vncserver = 'localhost'
-                    break
+            local_port = self.find_tunnel(session_name)
+            if local_port is not None:
+                self.log.info(f"Found existing SSH tunnel on port {local_port}")
+                if not self.await_tunnel(local_port):
+                    return False
+                vncserver = 'localhost'
 
             #open ssh tunnel
             if local_port is None:
@@ -254,7 +534,9 @@ class LickVncLauncher(object):
                               f"{account}@{vncserver}:{port}")
                     trace = traceback.format_exc()
                     self.log.debug(trace)
-                    return
+                    return False
+                if not local_port:
+                    return False
                 vncserver = 'localhost'
         else:
             local_port = port
@@ -267,13 +549,13 @@ class LickVncLauncher(object):
         if self.config['vncviewer'] in [None, 'None', 'none']:
             self.log.info(f"\nNo VNC viewer application specified")
             self.log.info(f"Open your VNC viewer manually\n")
-            return
+            return True
 
         #determine geometry
         #NOTE: This doesn't work for mac so only trying for linux
         geometry = ''
-        if 'linux' in platform.system().lower():
-            i = len(self.vnc_threads) % len(self.geometry)
+        if 'linux' in platform.system().lower() and len(self.geometry) > 0:
+            i = self.sessions_found.index(session) % len(self.geometry)
             geom = self.geometry[i]
             width  = geom[0]
             height = geom[1]
@@ -284,14 +566,24 @@ class LickVncLauncher(object):
             if xpos != None and ypos != None:
                 geometry += f'+{xpos}+{ypos}'
 
+        if vncserver == 'localhost':
+            local_port = self.relay_port(session_name, local_port)
+
         if self.use_ps:
             time.sleep(2)
 
+        if self.viewer_supervisor is not None and \
+                self.viewer_supervisor.is_running(session_name):
+            self.log.info(f"VNC viewer for '{session_name}' is already running")
+            return True
+
         ## Open vncviewer as separate thread
-        self.vnc_threads.append(threading.Thread(target=self.launch_vncviewer,
-                                       args=(vncserver, local_port, geometry)))
-        self.vnc_threads[-1].start()
-        time.sleep(0.05)
+        thread = threading.Thread(target=self.launch_vncviewer,
+                                  args=(vncserver, local_port, geometry),
+                                  kwargs={'session_name': session_name})
+        self.vnc_threads.append(thread)
+        thread.start()
+        return True
 
     ##-------------------------------------------------------------------------
     ## Get command line args
@@ -303,6 +595,7 @@ class LickVncLauncher(object):
     ##-------------------------------------------------------------------------
     ## Get Configuration
     ##-------------------------------------------------------------------------
+    @profiler.profiled('config')
     def get_config(self):
 
         #define files to try loading in order of pref
@@ -329,6 +622,7 @@ class LickVncLauncher(object):
 
         #load config file and make sure it has the info we need
         self.log.info(f'Using config file:\n {file}')
+        self.config_file = file
 
         # open file a first time just to log the raw contents
         with open(file) as FO:
@@ -357,6 +651,7 @@ class LickVncLauncher(object):
     ##-------------------------------------------------------------------------
     ## Check Configuration
     ##-------------------------------------------------------------------------
+    @profiler.profiled('config')
     def check_config(self):
 
         #check for vncviewer
@@ -371,6 +666,31 @@ class LickVncLauncher(object):
         self.local_port = self.LOCAL_PORT_START
         lps = self.config.get('local_port_start', None)
         if lps: self.local_port = lps
+        #NOTE: Try up to 100 ports beyond
+        self.port_allocator = localports.PortAllocator(self.local_ports_in_use,
+                                                       start=self.local_port,
+                                                       count=100)
+
+        #check tunnel mode
+        self.tunnel_mode = self.config.get('tunnel_mode', 'shared')
+        if self.tunnel_mode not in ['shared', 'separate']:
+            self.log.warning(f"Unknown tunnel_mode '{self.tunnel_mode}', "
+                             f"using 'shared'")
+            self.tunnel_mode = 'shared'
+
+        #check ssh backend
+        self.ssh_backend = self.config.get('ssh_backend', 'openssh')
+        if self.ssh_backend not in sshtransport.BACKENDS:
+            self.log.warning(f"Unknown ssh_backend '{self.ssh_backend}', "
+                             f"using 'openssh'")
+            self.ssh_backend = 'openssh'
+        if self.ssh_backend == 'paramiko':
+            try:
+                import paramiko
+            except ImportError:
+                self.log.warning("ssh_backend 'paramiko' needs the paramiko "
+                                 "package, using 'openssh'")
+                self.ssh_backend = 'openssh'
 
 
         #check ssh_pkeys
@@ -385,6 +705,52 @@ class LickVncLauncher(object):
                 sys.exit()
 
 
+    ##-------------------------------------------------------------------------
+    ## Log file rotation and JSON-lines output from the config
+    ##-------------------------------------------------------------------------
+    def configure_logging(self):
+
+        if self.log_pipeline is None:
+            return
+        self.log_pipeline.configure(
+            max_bytes=float(self.config.get('log_max_mb', 10)) * 1e6,
+            backups=self.config.get('log_backups', 10),
+            json_lines=self.config.get('log_json', False))
+        if self.log_pipeline.json_handler is not None:
+            #first record of the run in the JSON log
+            self.log.debug(f'JSON log: {self.log_pipeline.json_handler.baseFilename}'
+                           f'\nCommand: ' + ' '.join(sys.argv))
+
+
+    def log_file(self):
+        '''The text log file being written.'''
+        if self.log_pipeline is not None:
+            return self.log_pipeline.filename
+        for handler in self.log.handlers:
+            if isinstance(handler, logging.FileHandler):
+                return handler.baseFilename
+        return None
+
+
+    ##-------------------------------------------------------------------------
+    ## Local Prometheus metrics endpoint
+    ##-------------------------------------------------------------------------
+    def start_metrics(self):
+
+        port = self.config.get('metrics_port', None)
+        if port is None:
+            return
+        address = self.config.get('metrics_address', '127.0.0.1')
+        try:
+            self.metrics_server = metrics.MetricsServer(self, int(port), address,
+                                                        version=__version__)
+        except OSError as error:
+            self.log.error(f"Could not serve metrics on {address}:{port}: {error}")
+            return
+        self.metrics_server.start()
+        self.log.info(f"Serving metrics at http://{address}:{self.metrics_server.port}/metrics")
+
+
     ##-------------------------------------------------------------------------
     ## Log basic system info
     ##-------------------------------------------------------------------------
@@ -433,7 +799,10 @@ class LickVncLauncher(object):
 
         print(f"\nSessions found for account '{self.args.account}':")
         for s in self.sessions_found:
-            print(f"  {s.name:12s} {s.display:5s} {s.desktop:s}")
+            viewer = ''
+            if self.viewer_supervisor is not None:
+                viewer = self.viewer_supervisor.status(s.name)
+            print(f"  {s.name:12s} {s.display:5s} {s.desktop:s} {viewer}".rstrip())
 
 
     ##-------------------------------------------------------------------------
@@ -446,10 +815,21 @@ class LickVncLauncher(object):
         else:
             print(f"\nSSH tunnels:")
             print(f"  Local Port | Desktop   | Remote Connection")
-            for p in self.ports_in_use.keys():
-                desktop = self.ports_in_use[p][1]
-                remote_connection = self.ports_in_use[p][0]
-                print(f"  {p:10d} | {desktop:9s} | {remote_connection:s}")
+            for p, tunnel in list(self.ports_in_use.items()):
+                status = 'up' if tunnel.is_alive() else 'DOWN'
+                if self.tunnel_supervisor is not None and \
+                        tunnel.session_name in self.tunnel_supervisor.stats:
+                    stats = self.tunnel_supervisor.stats[tunnel.session_name]
+                    status += f', {stats.reconnects} reconnects'
+                if self.health_checker is not None:
+                    health = self.health_checker.status(tunnel.session_name)
+                    if health:
+                        status += f', {health}'
+                print(f"{tunnel} ({tunnel.mode}, {status})")
+                if self.relay_manager is not None:
+                    relay_status = self.relay_manager.status(tunnel.session_name)
+                    if relay_status:
+                        print(f"  {'':10s} | {'':9s} | {relay_status}")
 
 
     ##-------------------------------------------------------------------------
@@ -460,79 +840,373 @@ class LickVncLauncher(object):
         xterm = subprocess.call(cmd)
 
 
+    ##-------------------------------------------------------------------------
+    ## Find existing ssh tunnel for a session
+    ##-------------------------------------------------------------------------
+    def find_tunnel(self, session_name):
+        with self.tunnel_lock:
+            for p, tunnel in self.ports_in_use.items():
+                if session_name == tunnel.session_name:
+                    return p
+        return None
+
+
+    ##-------------------------------------------------------------------------
+    ## Wait until a tunnel in ports_in_use is usable (close it if it fails)
+    ##-------------------------------------------------------------------------
+    @profiler.profiled('tunnel wait', detail=str)
+    def await_tunnel(self, local_port):
+
+        tunnel = self.ports_in_use.get(local_port, None)
+        if tunnel is None:
+            return False
+        if tunnel.ready:
+            return True
+
+        try:
+            self.wait_for_tunnel(tunnel.proc, local_port)
+        except RuntimeError as e:
+            self.log.error(f"Failed to open SSH tunnel for "
+                           f"{tunnel.address_and_port}: {e}")
+            self.profile_failure(str(e))
+            self.close_ssh_thread(local_port)
+            return False
+
+        tunnel.ready = True
+        return True
+
+
+    ##-------------------------------------------------------------------------
+    ## Check which of several local ports are in use
+    ##-------------------------------------------------------------------------
+    @profiler.profiled('port scan')
+    def local_ports_in_use(self, ports):
+
+        if self.use_native:
+            in_use = localports.ports_in_use(ports, self.native_port_backend)
+        else:
+            in_use = set(p for p in ports if self.is_local_port_in_use(p))
+        self.log.debug(f'Local ports in use from {ports[0]}-{ports[-1]}: '
+                       f'{sorted(in_use)}')
+        return in_use
+
+
+    ##-------------------------------------------------------------------------
+    ## Start an ssh process whose stderr is watched for failures
+    ##-------------------------------------------------------------------------
+    def popen_ssh(self, command):
+
+        self.log.debug('ssh command: ' + ' '.join (command))
+        null = subprocess.DEVNULL
+        proc = subprocess.Popen(command, stdin=null, stdout=null,
+                                stderr=subprocess.PIPE)
+        proc.stderr_lines = []
+        threading.Thread(target=self.watch_ssh_stderr, args=(proc,),
+                         daemon=True).start()
+        return proc
+
+
+    def watch_ssh_stderr(self, proc):
+        for line in proc.stderr:
+            line = line.decode(errors='replace').strip()
+            if line:
+                proc.stderr_lines.append(line)
+                self.log.debug(f'ssh [{proc.pid}]: {line}')
+
+
+    ##-------------------------------------------------------------------------
+    ## Wait for ssh to start listening on a forwarded local port
+    ##-------------------------------------------------------------------------
+    def wait_for_tunnel(self, proc, local_port):
+        '''
+        Return as soon as the forwarded local port accepts a connection.
+        Raises RuntimeError as soon as ssh exits or reports that it could not
+        forward the port, or after the tunnel_timeout config (default 5 s).
+        '''
+        timeout = self.config.get('tunnel_timeout', 5)
+
+        def check():
+            for line in getattr(proc, 'stderr_lines', []):
+                if any(f in line for f in self.SSH_FORWARD_FAILURES):
+                    raise RuntimeError(f'ssh reported: {line}')
+            if proc.poll() is not None:
+                lines = getattr(proc, 'stderr_lines', [])
+                reason = f': {lines[-1]}' if lines else ''
+                raise RuntimeError(f'ssh exited with status '
+                                   f'{proc.returncode}{reason}')
+
+        try:
+            waited = localports.wait_for_port(local_port, timeout, check)
+        except TimeoutError:
+            raise RuntimeError(f'ssh tunnel failed to open after {timeout} seconds')
+        self.log.debug(f'Tunnel on port {local_port} ready after '
+                       f'{waited*1000:.0f} ms')
+
+
+    ##-------------------------------------------------------------------------
+    ## Forward ports over the in-process ssh connection
+    ##-------------------------------------------------------------------------
+    def forward_inprocess(self, server, username, tunnels):
+        '''
+        Forward each of a list of SSHTunnels over the in-process connection
+        to server.  Returns False if the ssh backend runs ssh processes.
+        '''
+        if self.ssh_backend == 'openssh':
+            return False
+        transport = self.get_ssh_transport(server, username)
+        for tunnel in tunnels:
+            tunnel.proc = transport.forward(tunnel.local_port, tunnel.remote_port)
+            tunnel.mode = 'inprocess'
+        return True
+
+
+    ##-------------------------------------------------------------------------
+    ## Add port forwards to the running master connection
+    ##-------------------------------------------------------------------------
+    @profiler.profiled('ssh forward')
+    def forward_on_master(self, server, username, tunnels, cancel=False):
+        '''
+        Ask the master connection for server to add (or cancel) the forwards
+        for a list of SSHTunnels.  Returns False if there is no usable master.
+        '''
+        master = self.ssh_masters.get(server, None)
+        if master is None or master['account'] != username \
+                or master['proc'].poll() is not None:
+            return False
+
+        operation = 'cancel' if cancel else 'forward'
+        command = ['ssh', '-O', operation, '-l', username]
+        for tunnel in tunnels:
+            command += ['-L', tunnel.forwarding]
+        command.append(f"-oControlPath={master['control_path']}")
+        command.append(server)
+
+        self.log.debug('ssh command: ' + ' '.join (command))
+        null = subprocess.DEVNULL
+        try:
+            proc = subprocess.run(command, stdin=null, stdout=null,
+                                  stderr=subprocess.PIPE, timeout=10)
+        except subprocess.TimeoutExpired:
+            self.log.error(f'  Timeout on ssh -O {operation}')
+            return False
+        if proc.returncode != 0:
+            self.log.error(f'  ssh -O {operation} failed: '
+                           f'{proc.stderr.decode().strip()}')
+            return False
+
+        for tunnel in tunnels:
+            tunnel.proc = master['proc']
+            tunnel.mode = 'master'
+        return True
+
+
+    ##-------------------------------------------------------------------------
+    ## ssh command forwarding the local ports of a list of tunnels
+    ##-------------------------------------------------------------------------
+    def ssh_forward_command(self, server, username, tunnels, ssh_pkey=None):
+        '''
+        The one place the forwarding ssh command is built, for opening,
+        reopening and rebuilding tunnels.  A process with a single forward
+        exits if it cannot listen; with several, one bad port should not
+        take the others down.
+        '''
+        command = ['ssh', '-l', username, '-N', '-T', server]
+        for tunnel in tunnels:
+            command += ['-L', tunnel.forwarding]
+        command += self.ssh_options(server, username, ssh_pkey)
+        if len(tunnels) == 1:
+            command.append('-oExitOnForwardFailure=yes')
+        return command
+
+
+    ##-------------------------------------------------------------------------
+    ## Reopen tunnels whose ssh process died, on the same local ports
+    ##-------------------------------------------------------------------------
+    def can_reconnect(self, tunnel):
+        #without the key ssh would prompt for a password from a background
+        # thread, the in-process connection already has the password
+        if tunnel.mode == 'inprocess':
+            return True
+        return self.ssh_key_valid and tunnel.account == self.ssh_account
+
+
+    def restart_tunnels(self, tunnels):
+        '''
+        Reopen a group of tunnels that shared one (now dead) ssh process.
+        Raises RuntimeError if they do not come back.
+        '''
+        server = tunnels[0].server
+        account = tunnels[0].account
+        for tunnel in tunnels:
+            tunnel.ready = False
+
+        if tunnels[0].mode == 'master':
+            if not self.start_ssh_master(server, account):
+                raise RuntimeError('could not reopen SSH master connection')
+            if not self.forward_on_master(server, account, tunnels):
+                raise RuntimeError('could not forward ports on master connection')
+        elif tunnels[0].mode == 'inprocess':
+            self.forward_inprocess(server, account, tunnels)
+        else:
+            proc = self.popen_ssh(self.ssh_forward_command(server, account, tunnels))
+            for tunnel in tunnels:
+                tunnel.proc = proc
+
+        for tunnel in tunnels:
+            self.wait_for_tunnel(tunnel.proc, tunnel.local_port)
+            tunnel.ready = True
+
+
+    def rebuild_tunnel(self, tunnel):
+        '''
+        Rebuild a tunnel whose ssh process is running but which no longer
+        reaches the remote server.  A forward on the master connection is
+        cancelled and added again; otherwise the ssh process is killed and
+        the tunnel supervisor reopens it (with any tunnels sharing it).
+        '''
+        self.log.info(f"Rebuilding SSH tunnel for '{tunnel.session_name}' on "
+                      f"port {tunnel.local_port}")
+        if tunnel.mode == 'master':
+            self.forward_on_master(tunnel.server, tunnel.account, [tunnel],
+                                   cancel=True)
+            self.restart_tunnels([tunnel])
+        elif self.tunnel_supervisor is not None and \
+                self.tunnel_supervisor.reconnect_enabled:
+            tunnel.proc.kill()
+        else:
+            raise RuntimeError('tunnel reconnect is disabled')
+
+
+    ##-------------------------------------------------------------------------
+    ## Open ssh tunnels for several remote ports with one ssh invocation
+    ##-------------------------------------------------------------------------
+    @profiler.profiled('ssh tunnel')
+    def open_ssh_tunnels(self, server, username, password, ssh_pkey, forwards,
+                         wait=True):
+        '''
+        Open tunnels for forwards, a list of (remote_port, session_name),
+        either on the master connection or with one ssh process carrying all
+        of them.  Returns a dict of session_name to local port for the
+        tunnels that came up.  With wait=False the tunnels are returned as
+        soon as ssh was asked for them; use await_tunnel() before using one.
+        '''
+        #one scan of the local ports reserves all of them
+        local_ports = self.port_allocator.reserve(len(forwards))
+        tunnels = []
+        for i, (remote_port, session_name) in enumerate(forwards):
+            if i >= len(local_ports):
+                self.log.error(f"Could not find an open local port for SSH "
+                               f"tunnel to {username}@{server}:{remote_port}")
+                continue
+            tunnels.append(SSHTunnel(local_ports[i], server, username,
+                                     remote_port, session_name=session_name))
+        if len(tunnels) == 0:
+            return {}
+
+        for tunnel in tunnels:
+            self.log.info(f"Opening SSH tunnel for {tunnel.address_and_port} "
+                          f"on local port {tunnel.local_port}.",
+                          extra={'session': tunnel.session_name,
+                                 'port': tunnel.local_port})
+
+        if not self.forward_inprocess(server, username, tunnels) and \
+                not self.forward_on_master(server, username, tunnels):
+            proc = self.popen_ssh(self.ssh_forward_command(server, username,
+                                                           tunnels, ssh_pkey))
+            for tunnel in tunnels:
+                tunnel.proc = proc
+                tunnel.mode = 'batch' if len(tunnels) > 1 else 'separate'
+
+        with self.tunnel_lock:
+            for tunnel in tunnels:
+                self.ports_in_use[tunnel.local_port] = tunnel
+
+        opened = {}
+        for tunnel in tunnels:
+            if not wait or self.await_tunnel(tunnel.local_port):
+                opened[tunnel.session_name] = tunnel.local_port
+
+        return opened
+
+
+    ##-------------------------------------------------------------------------
+    ## Open ssh tunnels for all sessions (and soundplay) at once
+    ##-------------------------------------------------------------------------
+    def open_session_tunnels(self, sessions, sound=False, wait=True):
+
+        account  = self.ssh_account if self.ssh_key_valid else self.args.account
+        password = None if self.ssh_key_valid else self.vnc_password
+
+        forwards = []
+        for s in sessions:
+            if self.find_tunnel(s.name) is None:
+                forwards.append((int(f"59{int(s.display):02d}"), s.name))
+        if sound and self.find_tunnel('soundplay') is None:
+            forwards.append((self.SOUND_PORT, 'soundplay'))
+        if len(forwards) == 0:
+            return {}
+
+        return self.open_ssh_tunnels(self.vncserver, account, password,
+                                     self.ssh_pkey, forwards, wait=wait)
+
+
     ##-------------------------------------------------------------------------
     ## Open ssh tunnel
     ##-------------------------------------------------------------------------
+    @profiler.profiled('ssh tunnel')
     def open_ssh_tunnel(self, server, username, password, ssh_pkey, remote_port,
                         local_port=None, session_name='unknown'):
 
         #get next local port if need be
-        #NOTE: Try up to 100 ports beyond
         if not local_port:
-            for i in range(0,100):
-                if self.is_local_port_in_use(self.local_port): 
-                    self.local_port += 1
-                    continue
-                else:
-                    local_port = self.local_port
-                    self.local_port += 1
-                    break
+            local_ports = self.port_allocator.reserve(1)
+            local_port = local_ports[0] if local_ports else None
 
         #if we can't find an open port, error and return
         if not local_port:
             self.log.error(f"Could not find an open local port for SSH tunnel "
                            f"to {username}@{server}:{remote_port}")
-            self.local_port = self.LOCAL_PORT_START
+            self.profile_failure('no free local port')
             return False
 
         #log
-        address_and_port = f"{username}@{server}:{remote_port}"
-        self.log.info(f"Opening SSH tunnel for {address_and_port} "
-                 f"on local port {local_port}.")
-
-        # build the command
-        forwarding = f"{local_port}:localhost:{remote_port}"
-        command = ['ssh', '-l', username, '-L', forwarding, '-N', '-T', server]
-        command.append('-oStrictHostKeyChecking=no')
-        command.append('-oKexAlgorithms=+diffie-hellman-group1-sha1')
-        command.append('-oCompression=yes')        
-        if ssh_pkey is not None:
-            command.append('-i')
-            command.append(ssh_pkey)
-
-        self.log.debug('ssh command: ' + ' '.join (command))
-        null = subprocess.DEVNULL
-        proc = subprocess.Popen(command,stdin=null,stdout=null,stderr=null)
-
-
-        # Having started the process let's make sure it's actually running.
-        # First try polling,  then confirm the requested local port is in use.
-        # It's a fatal error if either check fails.
+        tunnel = SSHTunnel(local_port, server, username, remote_port,
+                           session_name=session_name)
+        self.log.info(f"Opening SSH tunnel for {tunnel.address_and_port} "
+                 f"on local port {local_port}.",
+                 extra={'session': session_name, 'port': local_port})
+
+        #in shared mode add the forward to the running master connection
+        if self.forward_inprocess(server, username, [tunnel]):
+            pass
+        elif self.tunnel_mode != 'shared' or \
+                not self.forward_on_master(server, username, [tunnel]):
+
+            tunnel.proc = self.popen_ssh(self.ssh_forward_command(server, username,
+                                                                  [tunnel], ssh_pkey))
+
+        with self.tunnel_lock:
+            self.ports_in_use[local_port] = tunnel
+        if not self.await_tunnel(local_port):
+            raise RuntimeError(f'ssh tunnel on port {local_port} failed to open')
 
-        if proc.poll() is not None:
-            raise RuntimeError('subprocess failed to execute ssh')
-        
-        checks = 50
-        while checks > 0:
-            result = self.is_local_port_in_use(local_port)
-            if result == True:
-                break
-            else:
-                checks -= 1
-                time.sleep(0.1)
-
-        if checks == 0:
-            raise RuntimeError('ssh tunnel failed to open after 5 seconds')
-        
-        in_use = [address_and_port, session_name, proc]
-        self.ports_in_use[local_port] = in_use
-        
         return local_port
 
 
     ##-------------------------------------------------------------------------
     ##-------------------------------------------------------------------------
+    @profiler.profiled('port tools')
     def how_check_local_port(self):
+
+        #prefer reading the socket table in-process, no subprocess per probe
+        self.native_port_backend = localports.native_backend()
+        if self.native_port_backend is not None:
+            self.use_native = True
+            self.log.debug(f"Checking local ports with native "
+                           f"'{self.native_port_backend}' backend")
+            return
+        self.log.debug("Native local port check not possible, looking for tools")
+
         try:
             cmd0 = subprocess.check_output(['which', 'ss'])
             self.use_ss = True
@@ -566,40 +1240,143 @@ class LickVncLauncher(object):
     ##-------------------------------------------------------------------------
     def is_local_port_in_use(self, port):
 
-        if self.use_netstat:
-            cmd = f'netstat.exe -an | grep ":{port}"'
-        elif self.use_ss:
-            cmd = f'ss -l | grep ":{port}"'
-        elif self.use_lsof:
-            cmd = f'lsof -i -P -n | grep LISTEN | grep ":{port} (LISTEN)" | grep -v grep'
-        elif self.use_ps:
-            cmd = f'ps aux | grep "{port}:" | grep -v grep'
-
-        self.log.debug(f'Checking for port {port} in use: ' + cmd)
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        data = proc.communicate()[0]
-        data = data.decode("utf-8").strip()
-        lines = data.split('\n') if data else list()
-        if lines:
+        if self.use_native:
+            in_use = localports.port_in_use(port, self.native_port_backend)
+        else:
+            tool = None
+            if self.use_netstat:
+                tool = 'netstat'
+            elif self.use_ss:
+                tool = 'ss'
+            elif self.use_lsof:
+                tool = 'lsof'
+            elif self.use_ps:
+                tool = 'ps'
+            if tool is not None:
+                in_use = localports.port_in_use_tool(port, tool, log=self.log)
+            else:
+                #no tool found either, fall back to the connect and bind test
+                in_use = localports.port_in_use(port, 'socket')
+
+        if in_use:
             self.log.debug(f"Port {port} is in use.")
-            return True
-        else: 
-            return False
+        return in_use
+
+
+    ##-------------------------------------------------------------------------
+    ## Port a client should use to reach a tunnel (its relay if enabled)
+    ##-------------------------------------------------------------------------
+    def relay_port(self, session_name, local_port):
+        if self.relay_manager is None:
+            return local_port
+        try:
+            return self.relay_manager.start_relay(session_name, local_port)
+        except OSError as error:
+            self.log.error(f"Could not start relay for '{session_name}', "
+                           f"using the tunnel directly: {error}")
+            return local_port
+
+
+    ##-------------------------------------------------------------------------
+    ## VNC viewer profile of a session
+    ##-------------------------------------------------------------------------
+    def profile_setting(self, session_name):
+        #by session name, else the 'default' entry, else no profile
+        profiles = self.config.get('vnc_profiles', None) or {}
+        return profiles.get(session_name, profiles.get('default', None))
+
+
+    def uses_auto_profile(self):
+        profiles = self.config.get('vnc_profiles', None) or {}
+        return 'auto' in profiles.values()
+
+
+    def session_profile(self, session_name):
+        '''
+        Return the profile settings for session_name, or None to use the
+        static vncargs only.
+        '''
+        setting = self.profile_setting(session_name)
+        if setting is None:
+            return None
+        if setting == 'auto':
+            if self.link_monitor is None or self.link_monitor.profile is None:
+                setting = 'broadband'
+            else:
+                setting = self.link_monitor.profile
+        try:
+            return vncprofile.resolve(setting)
+        except ValueError as error:
+            self.log.error(f"{error}; using vncargs for '{session_name}'")
+            return None
+
+
+    ##-------------------------------------------------------------------------
+    ## Measure link round trip and bandwidth for auto profiles
+    ##-------------------------------------------------------------------------
+    @profiler.profiled('link')
+    def measure_link(self, rounds=3, size=262144):
+        '''
+        Time a few empty ssh commands (round trip) and the download of size
+        random bytes (bandwidth).  Never raises: viewers wait for this step.
+        '''
+        server = self.get_ssh_server()
+        account = self.ssh_account if self.ssh_key_valid else self.args.account
+        transport = self.get_ssh_transport(server, account)
+
+        try:
+            #on a shared connection each command costs one round trip
+            rtts = []
+            for i in range(rounds):
+                start = time.perf_counter()
+                result = transport.run('true', timeout=10)
+                if result.status == 0:
+                    rtts.append(time.perf_counter() - start)
+            if len(rtts) == 0:
+                raise RuntimeError('ssh commands failed')
+            rtt = min(rtts)
+
+            #random data so ssh compression cannot inflate the figure
+            bandwidth = None
+            start = time.perf_counter()
+            result = transport.run(f'head -c {size} /dev/urandom', timeout=60)
+            elapsed = time.perf_counter() - start - rtt
+            if result.status == 0 and len(result.stdout) == size and elapsed > 0:
+                bandwidth = size / elapsed
+        except Exception as error:
+            self.log.warning(f'Could not measure the link ({error}), auto VNC '
+                             f'sessions use the broadband profile')
+            self.profile_failure(str(error))
+            self.log.debug(traceback.format_exc())
+            return
+        self.link_monitor.measured(rtt, bandwidth)
+
+
+    def restart_auto_viewers(self):
+        for session in self.sessions_found:
+            if self.profile_setting(session.name) == 'auto':
+                self.viewer_supervisor.restart(session.name)
 
 
     ##-------------------------------------------------------------------------
     ## Launch vncviewer
     ##-------------------------------------------------------------------------
-    def launch_vncviewer(self, vncserver, port, geometry=None):
+    @profiler.profiled('vncviewer', detail=lambda server, port, *a, **k: f'{server}::{port}')
+    def launch_vncviewer(self, vncserver, port, geometry=None, session_name=None):
 
         vncviewercmd   = self.config.get('vncviewer', 'vncviewer')
         vncprefix      = self.config.get('vncprefix', '')
         vncargs        = self.config.get('vncargs', None)
 
         cmd = [vncviewercmd]
-        if vncargs:  
-            vncargs = vncargs.split()           
-            cmd = cmd + vncargs
+        vncargs = vncargs.split() if vncargs else []
+        profile = self.session_profile(session_name)
+        if profile is not None:
+            flavour = self.config.get('vnc_flavour', None) or \
+                      vncprofile.detect_flavour(vncviewercmd, self.config.get('vncargs', None))
+            vncargs = vncprofile.strip_args(vncargs, flavour) + \
+                      vncprofile.profile_args(profile, flavour)
+        cmd = cmd + vncargs
         if self.args.viewonly:
             cmd.append('-ViewOnly')
         #todo: make this config on/off so it doesn't break things 
@@ -616,11 +1393,16 @@ class LickVncLauncher(object):
 
         #append to proc list so we can terminate on app exit
         self.vnc_processes.append(proc)
+        if self.viewer_supervisor is not None and session_name is not None:
+            self.viewer_supervisor.track(session_name, proc, vncserver, port,
+                                         geometry)
+        return proc
 
 
     ##-------------------------------------------------------------------------
     ## Start soundplay
     ##-------------------------------------------------------------------------
+    @profiler.profiled('soundplay')
     def start_soundplay(self):
 
         try:
@@ -629,33 +1411,45 @@ class LickVncLauncher(object):
                 self.sound.terminate()
 
             #config vars
-            sound_port  = 9798
+            sound_port  = self.SOUND_PORT
             aplay       = self.config.get('aplay', None)
             soundplayer = self.config.get('soundplayer', None)
             vncserver   = self.vncserver
 
             if soundplayer is None:
                 soundplayer = self.guess_soundplay()
+
+            probe = self.remote_probe
+            if probe is not None and probe['soundplay'] is False:
+                self.log.warning(f"Soundplay server does not appear to be "
+                                 f"running on {probe['server']}")
             
             #Do we need ssh tunnel for this?
             if self.ssh_forward:
 
                 account  = self.ssh_account if self.ssh_key_valid else self.args.account
                 password = None if self.ssh_key_valid else self.vnc_password
-                sound_port = self.open_ssh_tunnel(self.vncserver, account,
-                                                  password, self.ssh_pkey,
-                                                  sound_port, None,
+                local_port = self.find_tunnel('soundplay')
+                if local_port is not None and not self.await_tunnel(local_port):
+                    return
+                if local_port is None:
+                    local_port = self.open_ssh_tunnel(self.vncserver, account,
+                                                      password, self.ssh_pkey,
+                                                      sound_port, None,
                                                       session_name='soundplay')
+                sound_port = local_port
                 if not sound_port:
                     return
                 else:
                     vncserver = 'localhost'
+                    sound_port = self.relay_port('soundplay', sound_port)
 
             self.sound = soundplay.soundplay()
             self.sound.connect(self.instrument, vncserver, sound_port,
                                aplay=aplay, player=soundplayer)
-        except Exception:
+        except Exception as error:
             self.log.error('Unable to start soundplay.  See log for details.')
+            self.profile_failure(str(error))
             trace = traceback.format_exc()
             self.log.debug(trace)
 
@@ -774,64 +1568,240 @@ class LickVncLauncher(object):
 
 
     ##-------------------------------------------------------------------------
-    ## Utility function for opening ssh client, executing command and closing
+    ## Get ssh server name for telescope
     ##-------------------------------------------------------------------------
-    def do_ssh_cmd(self, cmd, server, account):
-            
-        output = None
-        self.log.debug(f'Trying SSH connect to {server} as {account}:')
-        command = ['ssh', server, '-l', account, '-T']
+    def get_ssh_server(self):
+        if self.tel is None:
+            return None
+        return self.servers_to_try[self.tel] + '.ucolick.org'
 
-        if self.ssh_pkey is not None:
-            command.append('-i')
-            command.append(self.ssh_pkey)
-            
-        command.append('-oStrictHostKeyChecking=no')
-        command.append('-oKexAlgorithms=+diffie-hellman-group1-sha1')
-        command.append('-oCompression=yes')        
-        command.append(cmd)
-        self.log.debug('ssh command: ' + ' '.join (command))
 
-        
-        pipe = subprocess.PIPE
+    ##-------------------------------------------------------------------------
+    ## Common ssh/scp options, including the shared master connection
+    ##-------------------------------------------------------------------------
+    def ssh_options(self, server, account, ssh_pkey=None):
+
+        if ssh_pkey is None:
+            ssh_pkey = self.ssh_pkey
+
+        options = ['-oStrictHostKeyChecking=no',
+                   '-oKexAlgorithms=+diffie-hellman-group1-sha1']
+        options += self.ssh_cipher_options(server)
+        if ssh_pkey is not None:
+            options += ['-i', ssh_pkey]
+
+        #ride on the master connection if we have one for this server/account
+        master = self.ssh_masters.get(server, None)
+        if master is not None and master['account'] == account \
+                and master['proc'].poll() is None:
+            options.append(f"-oControlPath={master['control_path']}")
+            options.append('-oControlMaster=no')
+
+        return options
+
+
+    def ssh_cipher_options(self, server):
+        #settings chosen by --tune-ssh for this server, else compress
+        tuning = (self.config.get('ssh_tuning', None) or {}).get(server, None)
+        if tuning is None:
+            return ['-oCompression=yes']
+        return sshtune.cipher_options(tuning.get('cipher', None),
+                                      tuning.get('compression', True))
+
+
+    ##-------------------------------------------------------------------------
+    ## Measure ssh ciphers and compression and save the best in the config
+    ##-------------------------------------------------------------------------
+    def tune_ssh(self):
+
+        server = self.get_ssh_server()
+        account = self.ssh_account
+        self.change_mod()
+        options = [o for o in self.ssh_options(server, account)
+                   if not o.startswith('-oCompression') and not o.startswith('-oCiphers')]
+        size = int(self.config.get('ssh_tune_size', 4) * 1e6)
+
+        self.log.info(f"Tuning ssh to {account}@{server}, this takes a few minutes...")
+        results = sshtune.tune(server, account, options, size=size, log=self.log)
+        best = sshtune.choose_best(results)
+        if best is None:
+            self.log.error("No ssh trial connection succeeded, see log for details")
+            return
+
+        cipher, compression = best
+        self.log.info(f"Best setting for {server}: {cipher}, "
+                      f"compression {'on' if compression else 'off'}")
+        try:
+            sshtune.save_tuning(self.config_file, server, cipher, compression)
+        except Exception as error:
+            self.log.error(f"Could not save ssh settings in {self.config_file}: {error}")
+            self.log.debug(traceback.format_exc())
+            return
+        tuning = dict(self.config.get('ssh_tuning', None) or {})
+        tuning[server] = {'cipher': cipher, 'compression': compression}
+        self.config['ssh_tuning'] = tuning
+        self.log.info(f"Saved in {self.config_file}")
+
+
+    ##-------------------------------------------------------------------------
+    ## Start multiplexed ssh master connection
+    ##-------------------------------------------------------------------------
+    @profiler.profiled('ssh master')
+    def start_ssh_master(self, server, account, password_prompt=False):
+        '''
+        Open one authenticated ssh connection to server that all later ssh
+        commands, tunnels and uploads share via ControlPath.  Returns False
+        (and everything falls back to separate connections) if it fails.
+        '''
+        if server is None:
+            return False
+        if self.config.get('ssh_multiplex', True) is False:
+            self.log.debug('SSH connection multiplexing disabled in config')
+            return False
+        if self.ssh_backend != 'openssh':
+            #the in-process connection is already shared by everything
+            return False
+
+        master = self.ssh_masters.get(server, None)
+        if master is not None and master['proc'].poll() is None:
+            return True
+
+        if self.ssh_control_dir is None:
+            self.ssh_control_dir = tempfile.mkdtemp(prefix='kro-ssh-')
+        control_path = os.path.join(self.ssh_control_dir, f'{account}@{server}')
+        #a master that was killed leaves its socket behind
+        if os.path.exists(control_path):
+            os.remove(control_path)
+
+        self.log.info(f"Opening SSH master connection to {account}@{server}")
+        command = ['ssh', '-l', account, '-M', '-N', '-T', server]
+        command += self.ssh_options(server, account)
+        command.append(f'-oControlPath={control_path}')
+        command.append('-oControlPersist=no')
+        command.append('-oServerAliveInterval=30')
+        #with a key nobody can answer prompts, so fail fast instead.  On the
+        # password path ssh asks once on the terminal.
+        if password_prompt:
+            timeout = 120
+        else:
+            command.append('-oBatchMode=yes')
+            timeout = 10
+
+        self.log.debug('ssh command: ' + ' '.join(command))
         null = subprocess.DEVNULL
-        stdout = subprocess.STDOUT        
-        stdin = null
+        try:
+            proc = subprocess.Popen(command, stdin=null, stdout=null, stderr=null)
+        except Exception:
+            self.log.error('  Could not start SSH master connection')
+            trace = traceback.format_exc()
+            self.log.debug(trace)
+            return False
 
-        proc = subprocess.Popen(command, stdin=stdin, stdout=pipe, stderr=stdout)
-        if proc.poll() is not None:
-            raise RuntimeError('subprocess failed to execute ssh')
-        
+        #the control socket appears once the master has authenticated
+        start = time.time()
+        while time.time() - start < timeout:
+            if proc.poll() is not None:
+                self.log.warning(f'  SSH master connection exited with '
+                                 f'{proc.returncode}, using separate connections')
+                self.profile_failure(f'exit status {proc.returncode}')
+                return False
+            if os.path.exists(control_path):
+                break
+            time.sleep(0.05)
+        else:
+            self.log.warning('  SSH master connection timed out, '
+                             'using separate connections')
+            self.profile_failure('timeout')
+            proc.kill()
+            return False
+
+        self.ssh_masters[server] = {'account': account,
+                                    'control_path': control_path,
+                                    'proc': proc}
+        self.log.debug(f'  SSH master ready after {time.time()-start:.2f}s')
+        return True
+
+
+    ##-------------------------------------------------------------------------
+    ## Stop multiplexed ssh master connections
+    ##-------------------------------------------------------------------------
+    def stop_ssh_masters(self):
+
+        for server in list(self.ssh_masters.keys()):
+            master = self.ssh_masters.pop(server)
+            proc = master['proc']
+            self.log.info(f" Closing SSH master connection to {server}")
+            if proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+        if self.ssh_control_dir is not None:
+            shutil.rmtree(self.ssh_control_dir, ignore_errors=True)
+            self.ssh_control_dir = None
+
+
+    ##-------------------------------------------------------------------------
+    ## Utility function for opening ssh client, executing command and closing
+    ##-------------------------------------------------------------------------
+    @profiler.profiled('ssh command', detail=lambda cmd, *a: cmd[:80])
+    def do_ssh_cmd(self, cmd, server, account):
+
+        self.log.debug(f'Trying SSH connect to {server} as {account}:')
+        transport = self.get_ssh_transport(server, account)
         try:
-            stdout,stderr = proc.communicate(timeout=6)
-        except subprocess.TimeoutExpired:
+            result = transport.run(cmd, timeout=6)
+        except sshtransport.TransportTimeout:
             self.log.error('  Timeout')
+            self.profile_failure('timeout')
             return
 
-        if proc.returncode != 0:
-            message = '  command failed with error ' + str(proc.returncode)
+        #stderr (host key warnings, login banners) never mixes with output
+        stderr = result.stderr.decode(errors='replace').strip()
+        if stderr:
+            self.log.debug(f"Stderr: '{stderr}'")
+        if result.status != 0:
+            message = '  command failed with error ' + str(result.status)
             self.log.error(message)
+            self.profile_failure(f'exit status {result.status}: {stderr[:80]}')
 
-        stdout = stdout.decode()
-        stdout = stdout.strip()
+        stdout = result.text
         self.log.debug(f"Output: '{stdout}'")
+        return stdout
 
-        # The first line might be a warning about accepting a ssh host key.
-        # Check for that, and get rid of it from the output.
 
-        lines = stdout.split('\n')
+    ##-------------------------------------------------------------------------
+    ## ssh transport (subprocess or in-process) per server and account
+    ##-------------------------------------------------------------------------
+    def get_ssh_transport(self, server, account):
+
+        key = (server, account)
+        with self.transport_lock:
+            transport = self.ssh_transports.get(key, None)
+            if transport is not None:
+                return transport
+            tuning = (self.config.get('ssh_tuning', None) or {}).get(server, None)
+            compression = True if tuning is None else tuning.get('compression', True)
+            key_filename = self.ssh_pkey if os.path.exists(self.ssh_pkey) else None
+            transport = sshtransport.create_transport(
+                self.ssh_backend, server, account,
+                options=lambda: self.ssh_options(server, account),
+                key_filename=key_filename, password=self.vnc_password,
+                compression=compression, log=self.log)
+            self.ssh_transports[key] = transport
+            return transport
+
+
+    def close_ssh_transports(self):
+        with self.transport_lock:
+            transports = list(self.ssh_transports.values())
+            self.ssh_transports = {}
+        for transport in transports:
+            transport.close()
 
-        output = []
-        
-        for ln in lines:
-            if 'Warning: ' in ln:
-                self.log.debug('Removed warning from command output:')
-                self.log.debug(ln)
-            else:
-                output.append(ln)
-        stdout = '\n'.join(output)
 
-        return stdout
     ##-------------------------------------------------------------------------
     ## Validate ssh key on remote vnc server
     ##-------------------------------------------------------------------------
@@ -845,20 +1815,12 @@ class LickVncLauncher(object):
             self.log.error(" Cannot validate SSH key for undefined telescope")
             return
         
+        #one round trip gets identity, sessions and soundplay state together
         self.ssh_key_valid = False
-        cmd = 'whoami'
-        server =  self.servers_to_try[self.tel] + '.ucolick.org'
-        try:
-            data = self.do_ssh_cmd(cmd, server,
-                                    self.ssh_account)
-        except Exception as e:
-            self.log.error('  Failed: ' + str(e))
-            trace = traceback.format_exc()
-            self.log.debug(trace)
-            data = None
+        server =  self.get_ssh_server()
+        probe = self.probe_remote(server, self.ssh_account, self.instrument)
 
-
-        if data == self.ssh_account:
+        if probe is not None and probe['whoami'] == self.ssh_account:
             self.ssh_key_valid = True
             self.vncserver = server
 
@@ -926,16 +1888,12 @@ class LickVncLauncher(object):
         if self.tel is None:
             return vncserver
         
-        server = self.servers_to_try[self.tel] + ".ucolick.org"
-        cmd = f"vncstatus {self.instrument}"
-
-        try:
-            data = self.do_ssh_cmd(cmd, server, self.ssh_account)
-        except Exception as e:
-            self.log.error('  Failed: ' + str(e))
-            trace = traceback.format_exc()
-            self.log.debug(trace)
-            data = None
+        server = self.get_ssh_server()
+        probe = self.remote_probe
+        if probe is None or probe['server'] != server or \
+                probe['vncstatus'] is None:
+            probe = self.probe_remote(server, self.ssh_account, self.instrument)
+        data = probe['vncstatus'] if probe is not None else None
             
         # parse data
         if data and len(data) > 3:
@@ -951,25 +1909,64 @@ class LickVncLauncher(object):
 
 
     ##-------------------------------------------------------------------------
-    ## Determine VNC Sessions
+    ## Probe remote server with one command batch
     ##-------------------------------------------------------------------------
-    def get_vnc_sessions(self, vncserver, instrument, account, instr_account):
-        self.log.info(f"Connecting to {account}@{vncserver} to get VNC sessions list")
+    def probe_remote(self, server, account, instrument=None):
+        '''
+        Run whoami, hostname, vncstatus and a soundplay server check in one
+        ssh round trip.  Returns a dict with those results (see
+        parse_remote_probe) or None if ssh failed.
+        '''
+        #plain commands joined by ';' so this works from csh and sh logins
+        sections = [('whoami', 'whoami'), ('hostname', 'hostname')]
+        if instrument is not None:
+            sections.append(('vncstatus', f'vncstatus {instrument}'))
+        sections.append(('soundplay', f"netstat -an | grep LISTEN | "
+                                      f"grep -E '[.:]{self.SOUND_PORT}[[:space:]]'"))
+        #grep exits with 1 when soundplay is not listening, which is normal:
+        # end with true so the batch's exit status does not report a failure
+        cmd = '; '.join(f'echo {self.PROBE_MARKER}{name}; {command}'
+                        for name, command in sections) + '; true'
 
-        sessions = []
-        cmd = f"vncstatus {instrument}"
         try:
-            data = self.do_ssh_cmd(cmd, vncserver, account)
+            data = self.do_ssh_cmd(cmd, server, account)
         except Exception as e:
             self.log.error('  Failed: ' + str(e))
             trace = traceback.format_exc()
             self.log.debug(trace)
-            data = ''
-        
+            data = None
+        if data is None:
+            return None
+
+        probe = parse_remote_probe(data, self.PROBE_MARKER)
+        probe['server'] = server
+        probe['instrument'] = instrument
+        self.log.debug(f"  Remote probe: user={probe['whoami']} "
+                       f"host={probe['hostname']} soundplay={probe['soundplay']}")
+        self.remote_probe = probe
+        return probe
+
+
+    def take_probe_vncstatus(self, vncserver, instrument):
+        probe = self.remote_probe
+        if probe is None or probe['server'] != vncserver or \
+                probe['instrument'] != instrument or probe['vncstatus'] is None:
+            return None
+        data = probe['vncstatus']
+        probe['vncstatus'] = None
+        return data
+
+
+    ##-------------------------------------------------------------------------
+    ## Parse vncstatus output
+    ##-------------------------------------------------------------------------
+    def parse_vncstatus(self, data, instrument, vncserver, account):
+
+        sessions = []
         if data:
             lns = data.split("\n")
             for ln in lns:
-                if ln[0] != "#":
+                if ln and ln[0] != "#":
                     fields = ln.split('-')
                     display = fields[0].strip()
                     if display == 'Usage':
@@ -980,6 +1977,29 @@ class LickVncLauncher(object):
                     name = ''.join(desktop.split()[1:]) 
                     s = VNCSession(display=display, desktop=desktop, user=account)
                     sessions.append(s)            
+        return sessions
+
+
+    ##-------------------------------------------------------------------------
+    ## Determine VNC Sessions
+    ##-------------------------------------------------------------------------
+    def get_vnc_sessions(self, vncserver, instrument, account, instr_account):
+        self.log.info(f"Getting VNC sessions list from {account}@{vncserver}")
+
+        #use the vncstatus output from the key validation probe if it has not
+        # been used yet, otherwise ask the server again
+        data = self.take_probe_vncstatus(vncserver, instrument)
+        if data is None:
+            cmd = f"vncstatus {instrument}"
+            try:
+                data = self.do_ssh_cmd(cmd, vncserver, account)
+            except Exception as e:
+                self.log.error('  Failed: ' + str(e))
+                trace = traceback.format_exc()
+                self.log.debug(trace)
+                data = ''
+
+        sessions = self.parse_vncstatus(data, instrument, vncserver, account)
         self.log.debug(f'  Got {len(sessions)} sessions')
         for s in sessions:
             self.log.debug(str(s))
@@ -987,29 +2007,148 @@ class LickVncLauncher(object):
         return sessions
 
 
+    ##-------------------------------------------------------------------------
+    ## On-disk cache of VNC sessions per server and instrument
+    ##-------------------------------------------------------------------------
+    def session_cache_file(self, vncserver, instrument):
+        return pathlib.Path('cache') / f'sessions-{vncserver}-{instrument}.json'
+
+
+    def load_session_cache(self, vncserver, instrument):
+        '''
+        Return the cached session list, or None if there is no cache or it is
+        older than the session_cache_ttl config (seconds, default one day).
+        '''
+        ttl = self.config.get('session_cache_ttl', 86400)
+        if not ttl or vncserver is None:
+            return None
+
+        cachefile = self.session_cache_file(vncserver, instrument)
+        try:
+            with open(cachefile) as FO:
+                cache = json.load(FO)
+            age = time.time() - cache['time']
+            sessions = [VNCSession(**s) for s in cache['sessions']]
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self.log.warning(f'Ignoring unreadable session cache {cachefile}')
+            trace = traceback.format_exc()
+            self.log.debug(trace)
+            return None
+
+        if age > ttl or len(sessions) == 0:
+            self.log.debug(f'Session cache {cachefile} expired ({age:.0f}s old)')
+            return None
+        self.log.info(f"Using {len(sessions)} cached VNC sessions "
+                      f"({age/60:.0f} min old), refreshing in background")
+        return sessions
+
+
+    def save_session_cache(self, vncserver, instrument, sessions):
+
+        if not self.config.get('session_cache_ttl', 86400) or not sessions:
+            return
+        cachefile = self.session_cache_file(vncserver, instrument)
+        cache = {'time': time.time(),
+                 'sessions': [s.__dict__ for s in sessions]}
+        try:
+            cachefile.parent.mkdir(parents=True, exist_ok=True)
+            tmpfile = cachefile.with_suffix('.tmp')
+            with open(tmpfile, 'w') as FO:
+                json.dump(cache, FO, indent=1)
+            os.replace(tmpfile, cachefile)
+        except Exception:
+            self.log.warning(f'Could not write session cache {cachefile}')
+            trace = traceback.format_exc()
+            self.log.debug(trace)
+
+
+    ##-------------------------------------------------------------------------
+    ## Refresh cached sessions from the server and reconcile
+    ##-------------------------------------------------------------------------
+    def refresh_sessions(self):
+
+        fresh = self.get_vnc_sessions(self.vncserver, self.instrument,
+                                      self.ssh_account, self.args.account)
+        if len(fresh) == 0:
+            self.log.warning('Could not refresh VNC session list, '
+                             'keeping cached sessions')
+            return
+        self.save_session_cache(self.vncserver, self.instrument, fresh)
+
+        added, removed, changed = diff_sessions(self.sessions_found, fresh)
+        if not (added or removed or changed):
+            self.log.debug('Cached VNC session list is up to date')
+            return
+
+        for s in removed:
+            self.log.warning(f"VNC session '{s.name}' (display {s.display}) "
+                             f"is no longer on the server")
+        for s in changed:
+            self.log.warning(f"VNC session '{s.name}' moved to display "
+                             f"{s.display}, reopening")
+            #the old viewer can outlive its tunnel (a cancelled forward keeps
+            # open connections), close it so one opens on the new port
+            if self.viewer_supervisor is not None:
+                self.viewer_supervisor.close_viewer(s.name)
+            local_port = self.find_tunnel(s.name)
+            if local_port is not None:
+                self.close_ssh_thread(local_port)
+
+        #keep the order from the server for menu numbers and window positions
+        self.sessions_found = fresh
+        reopen = [s.name for s in added + changed]
+        if reopen and self.args.authonly is False:
+            self.log.info(f"Opening {len(reopen)} new VNC sessions: "
+                          + ', '.join(reopen))
+            self.start_vnc_sessions(reopen)
+
+
     ##-------------------------------------------------------------------------
     ## Close ssh threads
     ##-------------------------------------------------------------------------
-    def close_ssh_thread(self, p):
-        if p in self.ports_in_use.keys():
+    def close_ssh_thread(self, p, cancel=True):
+        with self.tunnel_lock:
             try:
-                remote_connection, desktop, process = self.ports_in_use.pop(p, None)
+                tunnel = self.ports_in_use.pop(p)
             except KeyError:
                 return
-            
-            self.log.info(f" Closing SSH tunnel for port {p:d}, {desktop:s} "
-                     f"on {remote_connection:s}")
-            process.kill()
+            shared = [t for t in self.ports_in_use.values()
+                      if t.proc is tunnel.proc]
+        self.port_allocator.release(p)
+        if self.relay_manager is not None:
+            self.relay_manager.stop_relay(tunnel.session_name)
+
+        self.log.info(f" Closing SSH tunnel for port {p:d}, {tunnel.session_name:s} "
+                 f"on {tunnel.address_and_port:s}")
+
+        if tunnel.mode == 'master':
+            #the master itself is stopped separately on exit
+            if cancel:
+                self.forward_on_master(tunnel.server, tunnel.account, [tunnel],
+                                       cancel=True)
+        elif tunnel.mode == 'batch':
+            #ssh cannot drop one forward from a running process, so only kill
+            # it once none of its other forwards are in use
+            if len(shared) == 0:
+                tunnel.proc.kill()
+            else:
+                self.log.info(f"  Port {p:d} stays forwarded until the other "
+                              f"{len(shared)} tunnels in its ssh process close")
+        else:
+            tunnel.proc.kill()
 
 
     def close_ssh_threads(self):
         for p in list(self.ports_in_use.keys()):
-            self.close_ssh_thread(p)
+            self.close_ssh_thread(p, cancel=False)
 
 
     ##-------------------------------------------------------------------------
     ## Calculate vnc windows size and position
     ##-------------------------------------------------------------------------
+    @profiler.profiled('geometry')
     def calc_window_geometry(self):
 
         self.log.debug(f"Calculating VNC window geometry...")
@@ -1033,7 +2172,6 @@ class LickVncLauncher(object):
 
         #get num rows and cols 
         #todo: assumming 2x2 always for now; make smarter
-        num_win = len(self.sessions_found)
         cols = 2
         rows = 2
 
@@ -1134,141 +2272,171 @@ class LickVncLauncher(object):
                  f"  q               Quit (or Control-C)",
                  f"-"*(line_length-2),
                  ]
-        menu = "\n"
-        for newline in lines:
-            menu += '|' + newline + ' '*(line_length-len(newline)-1) + '|\n'
-        menu += "> "
 
         quit = None
         while quit is None:
+            #the background version check may have finished since last time
+            shown = list(lines)
+            result = self.version_result
+            if result is not None and result.status == 'behind':
+                shown.insert(3, f"  Update available: v{result.remote}")
+            menu = "\n"
+            for newline in shown:
+                menu += '|' + newline + ' '*(line_length-len(newline)-1) + '|\n'
+            menu += "> "
+
             cmd = input(menu).lower()
-            cmatch = re.match(r'c (\d+)', cmd)
-            nmatch = re.match(r'(\d)', cmd)
-            if cmd == '':
-                pass
-            elif cmd == 'q':
-                self.log.debug(f'Recieved command "{cmd}"')
+            if self.run_command(cmd):
                 quit = True
-            elif cmd == 'w':
-                self.log.debug(f'Recieved command "{cmd}"')
-                try:
-                    self.position_vnc_windows()
-                except:
-                    self.log.error("Failed to reposition windows, see log")
-                    trace = traceback.format_exc()
-                    self.log.debug(trace)
-            elif cmd == 'p':
-                self.log.debug(f'Recieved command "{cmd}"')
-                self.play_test_sound()
-            elif cmd == 's':
-                self.log.debug(f'Recieved command "{cmd}"')
-                self.start_soundplay()
-            elif cmd == 'u':
-                self.log.debug(f'Recieved command "{cmd}"')
-                self.upload_log()
-            elif cmd == 'l':
-                self.log.debug(f'Recieved command "{cmd}"')
-                self.print_sessions_found()
-            elif cmd == 't':
-                self.log.debug(f'Recieved command "{cmd}"')
-                self.list_tunnels()
-            elif cmd == 'v':
-                self.log.debug(f'Recieved command "{cmd}"')
-                self.check_version()
-            elif cmatch is not None:
-                self.log.debug(f'Recieved command "{cmd}"')
-                self.close_ssh_thread(int(cmatch.group(1)))
-            elif nmatch is not None:
-                self.log.debug(f'Recieved command "{cmd}"')
-                desktop = int(nmatch.group(1)) - 1
-                if desktop >= 0 and desktop < 6:
-                    self.start_vnc_session(self.sessions_found[desktop].name)
-                else:
-                    self.log.error(f'Unrecognized desktop: "{cmd}"')
-            else:
-                self.log.debug(f'Recieved command "{cmd}"')
-                self.log.error(f'Unrecognized command: "{cmd}"')
 
 
     ##-------------------------------------------------------------------------
-    ## Check for latest version number on GitHub
+    ## Full-screen dashboard in place of the menu
     ##-------------------------------------------------------------------------
-    def check_version(self):
-        url = ('https://raw.githubusercontent.com/bpholden/'
-               'lickRemoteObserving/master/lick_vnc_launcher.py')
+    def run_dashboard(self):
+
+        board = dashboard.Dashboard(self,
+                    refresh=self.config.get('dashboard_refresh', 1.0),
+                    version=__version__)
         try:
-            import requests
-            from packaging import version
-            r = requests.get(url)
-            findversion = re.search(r"__version__ = '(\d.+)'", r.text)
-            if findversion is not None:
-                remote_version = version.parse(findversion.group(1))
-                local_version = version.parse(__version__)
-            else:
-                self.log.warning(f'Unable to determine software version on GitHub')
-                return
-            if remote_version == local_version:
-                self.log.info(f'Your software is up to date (v{__version__})')
-            elif remote_version > local_version:
-                self.log.info(f'Your software (v{__version__}) is ahead of the released version')
-            else:
-                self.log.warning(f'Your local software (v{__version__}) is not  '
-                                 f'the currently available version '
-                                 f'(v{remote_version})')
-        except:
-            self.log.warning("Unable to verify remote version")
+            board.run()
+        except Exception as error:
+            #e.g. a terminal curses cannot drive
+            self.log.error(f"Could not run the dashboard ({error}), using the menu")
+            self.log.debug(traceback.format_exc())
+            self.prompt_menu()
+            return
+        self.log.debug(f"Dashboard redrew {board.draws} times")
+
 
     ##-------------------------------------------------------------------------
-    ## Upload log file to Lick
+    ## Run one menu command (from the menu or the dashboard)
     ##-------------------------------------------------------------------------
-    def upload_log(self):
-        
-        account = self.ssh_account
-
-        logfile_handlers = [lh for lh in self.log.handlers if
-                            isinstance(lh, logging.FileHandler)]
-        logfile = pathlib.Path(logfile_handlers.pop(0).baseFilename)
+    def run_command(self, cmd):
+        '''Returns True for the quit command.'''
 
-        source = str(logfile)
-        destination = account + '@' + self.vncserver + ':' + logfile.name
+        cmatch = re.match(r'c (\d+)', cmd)
+        nmatch = re.match(r'(\d)', cmd)
+        if cmd == '':
+            pass
+        elif cmd == 'q':
+            self.log.debug(f'Recieved command "{cmd}"')
+            return True
+        elif cmd == 'w':
+            self.log.debug(f'Recieved command "{cmd}"')
+            try:
+                self.position_vnc_windows()
+            except:
+                self.log.error("Failed to reposition windows, see log")
+                trace = traceback.format_exc()
+                self.log.debug(trace)
+        elif cmd == 'p':
+            self.log.debug(f'Recieved command "{cmd}"')
+            self.play_test_sound()
+        elif cmd == 's':
+            self.log.debug(f'Recieved command "{cmd}"')
+            self.start_soundplay()
+        elif cmd == 'u':
+            self.log.debug(f'Recieved command "{cmd}"')
+            self.upload_log()
+        elif cmd == 'l':
+            self.log.debug(f'Recieved command "{cmd}"')
+            self.print_sessions_found()
+        elif cmd == 't':
+            self.log.debug(f'Recieved command "{cmd}"')
+            self.list_tunnels()
+        elif cmd == 'v':
+            self.log.debug(f'Recieved command "{cmd}"')
+            self.check_version(force=True)
+        elif cmatch is not None:
+            self.log.debug(f'Recieved command "{cmd}"')
+            self.close_ssh_thread(int(cmatch.group(1)))
+        elif nmatch is not None:
+            self.log.debug(f'Recieved command "{cmd}"')
+            desktop = int(nmatch.group(1)) - 1
+            if desktop >= 0 and desktop < 6:
+                self.start_vnc_session(self.sessions_found[desktop].name)
+            else:
+                self.log.error(f'Unrecognized desktop: "{cmd}"')
+        else:
+            self.log.debug(f'Recieved command "{cmd}"')
+            self.log.error(f'Unrecognized command: "{cmd}"')
+        return False
 
-        command = ['scp',]
 
-        if self.ssh_pkey is not None:
-            command.append('-i')
-            command.append(self.ssh_pkey)
+    ##-------------------------------------------------------------------------
+    ## Check for latest version number on GitHub
+    ##-------------------------------------------------------------------------
+    @profiler.profiled('version check')
+    def check_version(self, force=False):
+        '''
+        Compare with the version on GitHub.  The answer is cached for the
+        version_check_ttl config (seconds, default 6 hours) unless force.
+        '''
+        ttl = 0 if force else self.config.get('version_check_ttl', 21600)
+        result = versioncheck.check(__version__, ttl=ttl,
+                    timeout=self.config.get('version_check_timeout', 3))
+        self.version_result = result
+        self.log.debug(f'Version check: {result.status} (from {result.source})')
+        if result.status == 'unknown':
+            self.log.warning(str(result))
+            self.profile_failure(result.error)
+        elif result.status == 'behind':
+            self.log.warning(str(result))
+        else:
+            self.log.info(str(result))
 
-        command.append('-oStrictHostKeyChecking=no')
-        command.append('-oKexAlgorithms=+diffie-hellman-group1-sha1')
-        command.append('-oCompression=yes')
-        command.append(source)
-        command.append(destination)
 
-        self.log.debug('scp command: ' + ' '.join (command))
+    ##-------------------------------------------------------------------------
+    ## Upload log file to Lick
+    ##-------------------------------------------------------------------------
+    def upload_log(self):
+        '''
+        Send the part of the log not uploaded yet, compressed, in the
+        background (see logupload) so the menu stays responsive.
+        '''
+        if self.log_upload_thread is not None and self.log_upload_thread.is_alive():
+            self.log.info('  Log upload already in progress')
+            return
+        self.log_upload_thread = threading.Thread(target=self.upload_log_now,
+                                                  name='log-upload', daemon=True)
+        self.log_upload_thread.start()
 
-        pipe = subprocess.PIPE
-        null = subprocess.DEVNULL
 
-        stdin = null
+    @profiler.profiled('log upload')
+    def upload_log_now(self):
 
-        proc = subprocess.Popen(command, stdin=stdin, stdout=null, stderr=null)
-        if proc.poll() is not None:
-            raise RuntimeError('subprocess failed to execute scp')
+        account = self.ssh_account
+        uploader = logupload.LogUploader(log=self.log)
+        timeout = self.config.get('log_upload_timeout', 120)
 
         try:
-            stdout,stderr = proc.communicate(timeout=10)
-        except subprocess.TimeoutExpired:
-            self.log.error('  Timeout attempting to upload log file')
+            logfile = self.log_file()
+            if logfile is None:
+                self.log.warning('  No log file to upload, logging to file is off')
+                return
+            transport = self.get_ssh_transport(self.vncserver, account)
+            result = uploader.upload(logfile, transport, timeout=timeout)
+        except sshtransport.TransportTimeout:
+            self.log.error(f'  Timeout attempting to upload log file, the rest '
+                           f'will be sent with the next upload')
+            self.profile_failure('timeout')
+            return
+        except sshtransport.TransportError as error:
+            self.log.error(f'  {error}')
+            self.profile_failure(str(error))
+            return
+        except Exception as error:
+            self.log.error(f'  Log upload failed: {error}')
+            self.log.debug(traceback.format_exc())
+            self.profile_failure(str(error))
             return
 
-        if proc.returncode != 0:
-            message = '  command failed with error ' + str(proc.returncode)
-            self.log.error(message)
-        else:
-            self.log.info(f'  Uploaded {logfile.name}')
-            self.log.info(f'  to {destination}')
+        self.log.info(f'  {result}')
+        if result.raw:
+            self.log.info(f'  to {account}@{self.vncserver}:{result.destination}')
+
 
-        
     ##-------------------------------------------------------------------------
     ## Terminate all vnc processes
     ##-------------------------------------------------------------------------
@@ -1302,6 +2470,31 @@ class LickVncLauncher(object):
         #todo: Fix app exit so certain clean ups don't cause errors (ie thread not started, etc
         if msg != None: self.log.info(msg)
 
+        if self.link_monitor is not None:
+            self.link_monitor.stop()
+        #stop reopening tunnels that are about to be closed
+        if self.health_checker is not None:
+            self.health_checker.stop()
+        if self.tunnel_supervisor is not None:
+            self.tunnel_supervisor.stop()
+            report = self.tunnel_supervisor.report()
+            if report:
+                self.log.info('SSH tunnel reconnects this run:\n' + '\n'.join(report))
+        #do not relaunch viewers that are about to be terminated
+        if self.viewer_supervisor is not None:
+            self.viewer_supervisor.stop()
+            self.viewer_supervisor.restart_crashed = False
+            self.viewer_supervisor.check()
+            report = self.viewer_supervisor.report()
+            if report:
+                self.log.info('VNC viewers this run:\n' + '\n'.join(report))
+
+        if self.relay_manager is not None:
+            report = self.relay_manager.report()
+            if report:
+                self.log.info('Relay traffic this run:\n' + '\n'.join(report))
+            self.relay_manager.stop()
+
         #terminate soundplayer
         if self.sound: 
             self.sound.terminate()
@@ -1310,9 +2503,14 @@ class LickVncLauncher(object):
         if self.ssh_forward:
             self.close_ssh_threads()
             self.close_authentication(self.firewall_pass)
+        self.close_ssh_transports()
+        self.stop_ssh_masters()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
 
         #close vnc sessions
         self.kill_vnc_processes()
+        self.write_profile()
 
         self.exit = True
         self.log.info("EXITING APP\n")        
@@ -1336,7 +2534,7 @@ class LickVncLauncher(object):
         #and call exit_app function
         msg = traceback.format_exc()
         if self.log:
-            logfile = self.log.handlers[0].baseFilename
+            logfile = self.log_file()
             print(f"* Attach log file at: {logfile}\n")
             self.log.debug(f"\n\n!!!!! PROGRAM ERROR:\n{msg}\n")
         else:
@@ -1345,6 +2543,61 @@ class LickVncLauncher(object):
         self.exit_app()
 
 
+##-------------------------------------------------------------------------
+## Parse remote probe output
+##-------------------------------------------------------------------------
+def parse_remote_probe(data, marker):
+    '''
+    Split the output of the remote probe command batch on its section
+    markers.  Returns a dict with 'whoami' and 'hostname' (first line or
+    None), 'vncstatus' (text or None) and 'soundplay' (True if the sound
+    server port is listening, False if not, None if that could not be told).
+    '''
+    sections = {}
+    current = None
+    for line in data.split('\n'):
+        if line.startswith(marker):
+            current = line[len(marker):].strip()
+            sections[current] = []
+        elif current is not None:
+            sections[current].append(line)
+
+    def first_line(name):
+        lines = [ln.strip() for ln in sections.get(name, []) if ln.strip()]
+        return lines[0] if lines else None
+
+    probe = {'whoami': first_line('whoami'),
+             'hostname': first_line('hostname'),
+             'vncstatus': None,
+             'soundplay': None}
+    if 'vncstatus' in sections:
+        probe['vncstatus'] = '\n'.join(sections['vncstatus']).strip()
+    if 'soundplay' in sections:
+        lines = [ln for ln in sections['soundplay'] if ln.strip()]
+        if any('LISTEN' in ln for ln in lines):
+            probe['soundplay'] = True
+        elif len(lines) == 0:
+            probe['soundplay'] = False
+    return probe
+
+
+##-------------------------------------------------------------------------
+## Compare two VNC session lists
+##-------------------------------------------------------------------------
+def diff_sessions(old, new):
+    '''
+    Return lists of sessions (added, removed, changed) going from old to new,
+    matched by name.  changed holds the new session where the display moved.
+    '''
+    old_by_name = {s.name: s for s in old}
+    new_by_name = {s.name: s for s in new}
+    added = [s for s in new if s.name not in old_by_name]
+    removed = [s for s in old if s.name not in new_by_name]
+    changed = [s for s in new if s.name in old_by_name
+               and old_by_name[s.name].display != s.display]
+    return added, removed, changed
+
+
 ##-------------------------------------------------------------------------
 ## Create argument parser
 ##-------------------------------------------------------------------------
@@ -1369,6 +2622,14 @@ def create_parser():
     parser.add_argument("--viewonly", dest="viewonly",
         default=False, action="store_true",
         help="Open VNC sessions in View Only mode (only for TigerVnC viewer)")
+    parser.add_argument("--tune-ssh", dest="tune_ssh",
+        default=False, action="store_true",
+        help="Measure ssh ciphers and compression to the server, save the "
+             "fastest in the config file and exit.")
+    parser.add_argument("--profile", dest="profile", type=str, default=None,
+        metavar="FILE",
+        help="Write a trace of the startup phases (Chrome trace-event JSON, "
+             "open in chrome://tracing or ui.perfetto.dev) to FILE.")
     parser.add_argument("--nosshkey", dest="nosshkey",
         default=False, action="store_true",
         help=argparse.SUPPRESS)
@@ -1388,24 +2649,22 @@ def create_parser():
 ## Create logger
 ##-------------------------------------------------------------------------
 def create_logger():
-
+    '''
+    Console output (info+) is written directly; the full debug log goes
+    through a queue to rotating files in logs/ (see logpipeline).  Returns
+    the LogPipeline.
+    '''
+    logFile = 'logs/'
     try:
         ## Create logger object
         log = logging.getLogger('KRO')
         log.setLevel(logging.DEBUG)
 
-        #create log file and log dir if not exist
-        ymd = datetime.datetime.utcnow().date().strftime('%Y%m%d')
-        pathlib.Path('logs/').mkdir(parents=True, exist_ok=True)
-
-        #file handler (full debug logging)
-        logFile = f'logs/lick-remote-log-utc-{ymd}.txt'
-        logFileHandler = logging.FileHandler(logFile)
-        logFileHandler.setLevel(logging.DEBUG)
-        logFormat = logging.Formatter('%(asctime)s UT - %(levelname)s: %(message)s')
-        logFormat.converter = time.gmtime
-        logFileHandler.setFormatter(logFormat)
-        log.addHandler(logFileHandler)
+        #file handlers (full debug logging), written by a background thread
+        pipeline = logpipeline.LogPipeline(log)
+        logFile = pipeline.filename
+        pipeline.start()
+        atexit.register(pipeline.stop)
 
         #stream/console handler (info+ only)
         logConsoleHandler = logging.StreamHandler()
@@ -1415,6 +2674,7 @@ def create_logger():
         logConsoleHandler.setFormatter(logFormat)
         
         log.addHandler(logConsoleHandler)
+        return pipeline
 
     except Exception as error:
         print(str(error))
@@ -1432,7 +2692,7 @@ if __name__ == '__main__':
     #catch all exceptions so we can exit gracefully
     try:        
         lvl = LickVncLauncher()
-        create_logger()
+        lvl.log_pipeline = create_logger()
         lvl.log = logging.getLogger('KRO')
         lvl.start()
     except Exception as error:
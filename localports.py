@@ -0,0 +1,277 @@
+'''
+Check whether local TCP ports are in use without spawning subprocesses.
+
+On Linux the listening-socket table is read straight from /proc/net/tcp and
+/proc/net/tcp6.  Elsewhere a port is tested by trying to connect to it and
+to bind it.  The shell pipelines used before these backends existed are kept
+in TOOL_COMMANDS as a last resort and for benchmarking.
+
+wait_for_port() waits, with adaptive backoff, for a port to accept
+connections.  PortAllocator hands out free local ports for ssh forwards,
+several at a time, from one scan of the socket table.
+
+Run this file directly to benchmark the available backends.
+'''
+import argparse
+import errno
+import os
+import socket
+import subprocess
+import threading
+import time
+
+
+PROC_NET_FILES = ['/proc/net/tcp', '/proc/net/tcp6']
+TCP_LISTEN = '0A'
+
+#shell pipelines that print something if the port is in use
+TOOL_COMMANDS = {
+    'netstat' : 'netstat.exe -an | grep ":{port}"',
+    'ss'      : 'ss -l | grep ":{port}"',
+    'lsof'    : 'lsof -i -P -n | grep LISTEN | grep ":{port} (LISTEN)" | grep -v grep',
+    'ps'      : 'ps aux | grep "{port}:" | grep -v grep',
+}
+
+
+##-------------------------------------------------------------------------
+## Choose a native backend
+##-------------------------------------------------------------------------
+def native_backend():
+    '''
+    Return 'proc' if the kernel socket table is readable, 'socket' if socket
+    tests work, or None if neither does and a tool must be used instead.
+    '''
+    try:
+        with open(PROC_NET_FILES[0]) as FO:
+            FO.readline()
+        return 'proc'
+    except OSError:
+        pass
+
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.close()
+        return 'socket'
+    except OSError:
+        return None
+
+
+##-------------------------------------------------------------------------
+## Listening ports from the kernel table
+##-------------------------------------------------------------------------
+def listening_ports_proc():
+    '''
+    Return the set of TCP ports in LISTEN state from /proc/net/tcp[6].
+    '''
+    ports = set()
+    for filename in PROC_NET_FILES:
+        try:
+            with open(filename) as FO:
+                FO.readline()
+                for line in FO:
+                    fields = line.split()
+                    if len(fields) > 3 and fields[3] == TCP_LISTEN:
+                        ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+        except OSError:
+            continue
+    return ports
+
+
+##-------------------------------------------------------------------------
+## Socket connect/bind test for a single port
+##-------------------------------------------------------------------------
+def port_in_use_socket(port, host='127.0.0.1'):
+    '''
+    A port is in use if something accepts a connection on it or if we are
+    not allowed to bind it ourselves.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(0.2)
+        if sock.connect_ex((host, port)) == 0:
+            return True
+    finally:
+        sock.close()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, port))
+    except OSError as error:
+        return error.errno in (errno.EADDRINUSE, errno.EACCES)
+    finally:
+        sock.close()
+    return False
+
+
+##-------------------------------------------------------------------------
+## Shell tool test for a single port
+##-------------------------------------------------------------------------
+def port_in_use_tool(port, tool, log=None):
+    cmd = TOOL_COMMANDS[tool].format(port=port)
+    if log: log.debug(f'Checking for port {port} in use: {cmd}')
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    data = proc.communicate()[0]
+    return data.decode('utf-8').strip() != ''
+
+
+##-------------------------------------------------------------------------
+## Test a single port with any backend
+##-------------------------------------------------------------------------
+def port_in_use(port, backend='proc'):
+    if backend == 'proc':
+        return port in listening_ports_proc()
+    elif backend == 'socket':
+        return port_in_use_socket(port)
+    else:
+        return port_in_use_tool(port, backend)
+
+
+##-------------------------------------------------------------------------
+## Ports in use from a list of candidates with any backend
+##-------------------------------------------------------------------------
+def ports_in_use(ports, backend='proc'):
+    '''
+    Return the subset of ports that are in use.  The proc backend reads the
+    socket table once for all of them.
+    '''
+    if backend == 'proc':
+        return listening_ports_proc().intersection(ports)
+    return set(p for p in ports if port_in_use(p, backend))
+
+
+##-------------------------------------------------------------------------
+## Connect test for a single port
+##-------------------------------------------------------------------------
+def port_accepts(port, host='127.0.0.1', timeout=0.5):
+    '''
+    Return True if something accepts a TCP connection on host:port.
+    '''
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except OSError:
+        return False
+    sock.close()
+    return True
+
+
+##-------------------------------------------------------------------------
+## Wait for a port to accept connections
+##-------------------------------------------------------------------------
+def wait_for_port(port, timeout=5.0, check=None, initial=0.005, maximum=0.25):
+    '''
+    Wait until port accepts a connection, sleeping initial seconds after the
+    first failed attempt and growing the sleep by half each time up to
+    maximum.  check() is called before every attempt and may raise to abort
+    the wait (e.g. when the process that should listen has died).  Returns
+    the seconds waited; raises TimeoutError after timeout seconds.
+    '''
+    start = time.perf_counter()
+    delay = initial
+    while True:
+        if check is not None:
+            check()
+        if port_accepts(port, timeout=min(0.5, timeout)):
+            return time.perf_counter() - start
+        elapsed = time.perf_counter() - start
+        if elapsed >= timeout:
+            raise TimeoutError(f'port {port} not accepting connections '
+                               f'after {timeout} seconds')
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 1.5, maximum)
+
+
+##-------------------------------------------------------------------------
+## Thread-safe local port allocator
+##-------------------------------------------------------------------------
+class PortAllocator(object):
+    '''
+    Reserve free local ports in [start, start+count).  A reservation is held
+    until it is released, so ports handed to a tunnel that has not bound yet
+    are never given out twice.
+
+    in_use is a callable taking a list of candidate ports and returning the
+    set of those already in use; it is called once per reserve().
+    '''
+    def __init__(self, in_use, start=5901, count=100):
+        self.in_use = in_use
+        self.start = start
+        self.count = count
+        self.reserved = set()
+        self.scans = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, n=1):
+        '''
+        Return a list of up to n reserved ports (fewer if the range is full).
+        '''
+        with self.lock:
+            candidates = [p for p in range(self.start, self.start + self.count)
+                          if p not in self.reserved]
+            if len(candidates) == 0:
+                return []
+            busy = self.in_use(candidates)
+            self.scans += 1
+            ports = [p for p in candidates if p not in busy][:n]
+            self.reserved.update(ports)
+            return ports
+
+    def release(self, port):
+        with self.lock:
+            self.reserved.discard(port)
+
+
+##-------------------------------------------------------------------------
+## Micro-benchmark
+##-------------------------------------------------------------------------
+def benchmark(backends, ports, repeat=1):
+    '''
+    Time probing every port in ports with each backend.  Returns a dict of
+    backend to (seconds per probe, number of ports found in use).
+    '''
+    results = {}
+    for backend in backends:
+        found = 0
+        start = time.perf_counter()
+        for i in range(repeat):
+            found = sum(1 for p in ports if port_in_use(p, backend))
+        elapsed = time.perf_counter() - start
+        results[backend] = (elapsed / (repeat * len(ports)), found)
+    return results
+
+
+def available_backends():
+    backends = []
+    native = native_backend()
+    if native == 'proc':
+        backends += ['proc', 'socket']
+    elif native == 'socket':
+        backends.append('socket')
+    for tool, exe in [('ss', 'ss'), ('lsof', 'lsof'), ('netstat', 'netstat.exe'),
+                      ('ps', 'ps')]:
+        if any(os.access(os.path.join(d, exe), os.X_OK)
+               for d in os.environ.get('PATH', '').split(os.pathsep)):
+            backends.append(tool)
+    return backends
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark local port probe backends.")
+    parser.add_argument("--start",  type=int, dest="start",  default=5901, help="First port to probe.")
+    parser.add_argument("--count",  type=int, dest="count",  default=100,  help="Number of ports to probe (the launcher scans up to 100).")
+    parser.add_argument("--repeat", type=int, dest="repeat", default=1,    help="Number of times to repeat the scan.")
+    parser.add_argument("--backend", type=str, dest="backends", action="append", default=None,
+                        help="Backend to benchmark (proc, socket, ss, lsof, netstat, ps). Default is all available.")
+    args = parser.parse_args()
+
+    backends = args.backends or available_backends()
+    ports = list(range(args.start, args.start + args.count))
+    results = benchmark(backends, ports, args.repeat)
+
+    print(f"Probing {len(ports)} ports x {args.repeat}:")
+    print(f"  {'Backend':8s} | {'per probe':>12s} | {'full scan':>12s} | in use")
+    for backend, (per_probe, found) in results.items():
+        print(f"  {backend:8s} | {per_probe*1e6:9.1f} us | "
+              f"{per_probe*len(ports)*1e3:9.2f} ms | {found}")
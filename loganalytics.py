@@ -0,0 +1,466 @@
+'''
+Offline analysis of the launcher logs in logs/.
+
+Reads any number of log files (the daily .txt files, their rotated .txt.N
+copies, the .gz files made by the log upload, or the .jsonl files of
+log_json) one line at a time, in time order, and splits them into runs at
+"PROGRAM STARTED".  For each run it can print a timeline of tunnel opens,
+drops and reconnects, viewer starts and exits and failures; across all
+runs it prints latency percentiles per phase and per telescope:
+
+  startup: <step>   steps of the startup graph ("Startup task ... finished")
+  startup: viewers up   launch until all viewers were up
+  <phase>           profiled phases (ssh command, tunnel wait, vncviewer...)
+  tunnel downtime   time a dropped tunnel was down before it recovered
+
+Percentiles come from log-spaced histograms (within 2%), so memory does not
+grow with the number of log lines.  The table can be exported as CSV or
+JSON and the per-run summaries written as CSV while the logs are read:
+
+  python loganalytics.py logs/ --timeline --by night --csv phases.csv
+'''
+import argparse
+import calendar
+import collections
+import csv
+import glob
+import gzip
+import json
+import math
+import os
+import re
+import sys
+import time
+
+
+TELESCOPES = ['apf', 'shane', 'nickel']
+PERCENTILES = [50, 90, 99]
+
+HEADER = re.compile(r'^(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d),(\d{3}) UT - (\w+): (.*)$')
+SPAN = re.compile(r'^([a-z][a-z ]*): ([\d.]+)ms(?: \(failed: (.*)\))?$')
+TASK_DONE = re.compile(r"^Startup task '(.+)' finished in ([\d.]+)s")
+VIEWERS_UP = re.compile(r'All viewers up after ([\d.]+)s')
+TIMING_FAILED = re.compile(r'^\s+(\S.*?)\s+\|.*\(failed\)')
+RECOVERED = re.compile(r"SSH tunnel for '(.+)' on port (\d+) recovered after ([\d.]+)s down")
+
+#first line of a message: timeline event kind
+EVENTS = [('Opening SSH tunnel for ', 'tunnel open'),
+          ('Reopening SSH tunnel for ', 'tunnel reopen'),
+          ('Opening VNCviewer for ', 'viewer start'),
+          ('Relaunching VNC viewer for ', 'viewer start'),
+          ('Restarting VNC viewer for ', 'viewer start'),
+          ('Starting soundplayer', 'soundplay'),
+          ('EXITING APP', 'exit')]
+
+#lines kept of a multi-line message (config dumps can be long)
+MAX_MESSAGE_LINES = 50
+MAX_TIMELINE_EVENTS = 1000
+
+
+##-------------------------------------------------------------------------
+## Latency histogram with bounded memory
+##-------------------------------------------------------------------------
+class Histogram(object):
+    '''
+    Counts of values in buckets growing by a factor 1+error, so any
+    percentile is known to within error (relative) in O(log range) memory.
+    '''
+    def __init__(self, error=0.02, smallest=1e-4):
+        self.growth = math.log1p(error)
+        self.smallest = smallest
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        value = max(float(value), 0.0)
+        if value <= self.smallest:
+            index = 0
+        else:
+            index = int(math.ceil(math.log(value / self.smallest) / self.growth))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(p / 100 * self.count)))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                #middle of the bucket, which spans smallest*g**(index-1)..smallest*g**index
+                value = self.smallest * math.exp(self.growth * (index - 0.5))
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+##-------------------------------------------------------------------------
+## Read log records in time order
+##-------------------------------------------------------------------------
+def log_files(paths):
+    '''
+    Log files under paths (files or directories), oldest first: by date in
+    the name, then rotated copies (.txt.2, .txt.1) before the current file.
+    In directories the .txt logs are read; .jsonl files only when given
+    by name.
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in ['*.txt', '*.txt.[0-9]*', '*.txt.gz']:
+                files += glob.glob(os.path.join(path, pattern))
+        elif os.path.isfile(path):
+            files.append(path)
+
+    def order(filename):
+        name = os.path.basename(filename)
+        if name.endswith('.gz'):
+            name = name[:-3]
+        backup = 0
+        base, ext = os.path.splitext(name)
+        if ext[1:].isdigit():
+            name, backup = base, int(ext[1:])
+        return (name, -backup, filename)
+    return sorted(set(files), key=order)
+
+
+def open_log(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', errors='replace')
+    return open(filename, errors='replace')
+
+
+def read_records(filename):
+    '''
+    Yield (time, level, message, fields) for each record of a log file.
+    time is seconds since the epoch (UT) and fields the structured fields
+    (only in .jsonl files).  Lines after the first of a message are joined
+    to it with newlines.
+    '''
+    if filename.endswith('.jsonl') or filename.endswith('.jsonl.gz'):
+        yield from read_json_records(filename)
+        return
+
+    record = None
+    with open_log(filename) as FO:
+        for line in FO:
+            line = line.rstrip('\n')
+            match = HEADER.match(line)
+            if match is None:
+                if record is not None and len(record[2]) < MAX_MESSAGE_LINES:
+                    record[2].append(line)
+                continue
+            if record is not None:
+                yield record[0], record[1], '\n'.join(record[2]), {}
+            parts = [int(x) for x in match.groups()[:7]]
+            seconds = calendar.timegm(parts[:6] + [0, 0, 0]) + parts[6] / 1000
+            record = (seconds, match.group(8), [match.group(9)])
+    if record is not None:
+        yield record[0], record[1], '\n'.join(record[2]), {}
+
+
+def read_json_records(filename):
+    with open_log(filename) as FO:
+        for line in FO:
+            try:
+                entry = json.loads(line)
+                stamp = entry['time'].rstrip('Z')
+                date, clock = stamp.split('T')
+                parts = [int(x) for x in date.split('-')]
+                hours, minutes, seconds = clock.split(':')
+                seconds = calendar.timegm(parts + [int(hours), int(minutes), 0, 0, 0, 0]) \
+                          + float(seconds)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+            yield seconds, entry.get('level', 'INFO'), entry.get('message', ''), entry
+
+
+##-------------------------------------------------------------------------
+## One launcher run
+##-------------------------------------------------------------------------
+class Run(object):
+    '''An object to contain what one launcher run logged.
+    '''
+    def __init__(self, start, filename, command=''):
+        self.start = start
+        self.end = start
+        self.filename = filename
+        self.command = command
+        self.telescope = telescope_of(command)
+        self.events = []
+        self.dropped_events = 0
+        self.counts = collections.Counter()
+        self.startup = None
+
+    def event(self, when, kind, detail=''):
+        self.counts[kind] += 1
+        if len(self.events) < MAX_TIMELINE_EVENTS:
+            self.events.append((when, kind, detail))
+        else:
+            self.dropped_events += 1
+
+    @property
+    def night(self):
+        #observing night: the UT date 12 hours earlier, so a night is one key
+        return utc_text(self.start - 12 * 3600)[:10]
+
+    def summary(self):
+        return {'start': utc_text(self.start),
+                'night': self.night,
+                'telescope': self.telescope,
+                'file': os.path.basename(self.filename),
+                'duration': round(self.end - self.start, 3),
+                'startup': self.startup,
+                'tunnel_opens': self.counts['tunnel open'],
+                'tunnel_drops': self.counts['tunnel drop'],
+                'reconnects': self.counts['reconnect'],
+                'viewer_starts': self.counts['viewer start'],
+                'viewer_exits': self.counts['viewer exit'],
+                'failures': self.counts['failure']}
+
+    def timeline(self):
+        lines = [f"Run {utc_text(self.start)} UT  {self.telescope}  "
+                 f"{os.path.basename(self.filename)}"]
+        for when, kind, detail in self.events:
+            lines.append(f"  {when - self.start:+9.2f}s  {kind:14s} {detail}")
+        if self.dropped_events:
+            lines.append(f"  ... {self.dropped_events} more events")
+        return lines
+
+
+def telescope_of(command):
+    '''Telescope account given on the launcher command line, or unknown.'''
+    for word in command.split():
+        if word.lower() in TELESCOPES:
+            return word.lower()
+    return 'unknown'
+
+
+def utc_text(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+##-------------------------------------------------------------------------
+## Split records into runs and collect latencies
+##-------------------------------------------------------------------------
+class LogAnalyzer(object):
+
+    def __init__(self, by='telescope', on_run=None):
+        self.by = by
+        self.on_run = on_run
+        self.run = None
+        self.runs = 0
+        self.records = 0
+        self.histograms = collections.OrderedDict()
+
+
+    def key(self, metric):
+        run = self.run
+        if self.by == 'night':
+            return (run.night, metric)
+        if self.by == 'both':
+            return (f'{run.telescope} {run.night}', metric)
+        return (run.telescope, metric)
+
+
+    def sample(self, metric, seconds):
+        key = self.key(metric)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].add(seconds)
+
+
+    def read(self, filenames):
+        for filename in filenames:
+            for when, level, message, fields in read_records(filename):
+                self.add(filename, when, level, message, fields)
+        self.finish_run()
+
+
+    def finish_run(self):
+        if self.run is None:
+            return
+        self.runs += 1
+        if self.on_run is not None:
+            self.on_run(self.run)
+        self.run = None
+
+
+    ##-------------------------------------------------------------------------
+    ## One log record
+    ##-------------------------------------------------------------------------
+    def add(self, filename, when, level, message, fields):
+        self.records += 1
+        #the JSON log is only opened once the config is read
+        if 'PROGRAM STARTED' in message or (fields and message.startswith('JSON log:')):
+            self.finish_run()
+            command = ''
+            for line in message.split('\n'):
+                if line.startswith('Command:'):
+                    command = line[len('Command:'):].strip()
+            self.run = Run(when, filename, command)
+            self.run.event(when, 'start', command)
+            return
+        if self.run is None:
+            #the log starts in the middle of a run
+            self.run = Run(when, filename)
+        run = self.run
+        run.end = when
+        first = message.split('\n', 1)[0].strip()
+
+        #profiled phases, logged at debug when each call ends
+        phase = fields.get('phase')
+        if phase is not None and fields.get('duration') is not None:
+            self.sample(phase, fields['duration'])
+            if '(failed: ' in first:
+                run.event(when, 'failure', first)
+            return
+        match = SPAN.match(first)
+        if match and level == 'DEBUG':
+            self.sample(match.group(1), float(match.group(2)) / 1000)
+            if match.group(3):
+                run.event(when, 'failure', first)
+            return
+
+        match = TASK_DONE.match(first)
+        if match:
+            self.sample(f'startup: {match.group(1)}', float(match.group(2)))
+            return
+        if first.startswith('Startup timing:'):
+            match = VIEWERS_UP.search(message)
+            if match:
+                run.startup = float(match.group(1))
+                self.sample('startup: viewers up', run.startup)
+                run.event(when, 'startup done', f'all viewers up after {run.startup:.2f}s')
+            for line in message.split('\n')[1:]:
+                failed = TIMING_FAILED.match(line)
+                if failed:
+                    run.event(when, 'failure', f'startup step {failed.group(1)} failed')
+            return
+
+        match = RECOVERED.search(first)
+        if match:
+            self.sample('tunnel downtime', float(match.group(3)))
+            run.event(when, 'reconnect', first)
+            return
+        if first.startswith('SSH tunnel for ') and ' dropped ' in first:
+            run.event(when, 'tunnel drop', first)
+            return
+        if first.startswith('VNC viewer for ') and ' exited with ' in first:
+            run.event(when, 'viewer exit', first)
+            return
+        for prefix, kind in EVENTS:
+            if first.startswith(prefix):
+                run.event(when, kind, first[len(prefix):] if kind != 'exit' else '')
+                return
+        if level in ['ERROR', 'CRITICAL']:
+            run.event(when, 'failure', first)
+
+
+    ##-------------------------------------------------------------------------
+    ## Percentile table
+    ##-------------------------------------------------------------------------
+    def rows(self):
+        rows = []
+        for (group, metric), histogram in sorted(self.histograms.items()):
+            row = collections.OrderedDict([('group', group), ('metric', metric),
+                                           ('count', histogram.count),
+                                           ('mean', round(histogram.mean, 4))])
+            for p in PERCENTILES:
+                row[f'p{p}'] = round(histogram.percentile(p), 4)
+            row['max'] = round(histogram.max, 4)
+            rows.append(row)
+        return rows
+
+
+    def table(self):
+        rows = self.rows()
+        if not rows:
+            return ['  No timings found']
+        label = self.by.capitalize() if self.by != 'both' else 'Group'
+        width = max([len(r['group']) for r in rows] + [len(label)])
+        mwidth = max([len(r['metric']) for r in rows] + [6])
+        columns = ['mean'] + [f'p{p}' for p in PERCENTILES] + ['max']
+        lines = [f"  {label:{width}s} | "
+                 f"{'Metric':{mwidth}s} | {'Count':>6s} | "
+                 + ' | '.join(f'{c:>8s}' for c in columns)]
+        for row in rows:
+            lines.append(f"  {row['group']:{width}s} | {row['metric']:{mwidth}s} | "
+                         f"{row['count']:6d} | "
+                         + ' | '.join(f'{row[c]:7.3f}s' for c in columns))
+        return lines
+
+
+def write_csv(filename, rows):
+    with open(filename, 'w', newline='') as FO:
+        if not rows:
+            return
+        writer = csv.DictWriter(FO, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+##-------------------------------------------------------------------------
+## Command line
+##-------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Startup and session timings from launcher logs.")
+    parser.add_argument("paths", nargs='*', default=['logs'],
+                        help="Log files or directories of them (default logs/).")
+    parser.add_argument("--by", choices=['telescope', 'night', 'both'], default='telescope',
+                        help="Group the percentiles by telescope, observing night or both.")
+    parser.add_argument("--timeline", action="store_true", default=False,
+                        help="Print the timeline of each run.")
+    parser.add_argument("--csv", type=str, dest="csv_file", default=None,
+                        help="Write the percentile table to this CSV file.")
+    parser.add_argument("--json", type=str, dest="json_file", default=None,
+                        help="Write the percentile table and run count to this JSON file.")
+    parser.add_argument("--runs-csv", type=str, dest="runs_file", default=None,
+                        help="Write a summary line per run to this CSV file.")
+    args = parser.parse_args()
+
+    filenames = log_files(args.paths)
+    if not filenames:
+        print(f"No log files found in {' '.join(args.paths)}")
+        sys.exit(1)
+
+    runs_FO = open(args.runs_file, 'w', newline='') if args.runs_file else None
+    runs_writer = None
+
+    def on_run(run):
+        global runs_writer
+        if args.timeline:
+            print('\n'.join(run.timeline()) + '\n')
+        if runs_FO is not None:
+            summary = run.summary()
+            if runs_writer is None:
+                runs_writer = csv.DictWriter(runs_FO, fieldnames=list(summary.keys()))
+                runs_writer.writeheader()
+            runs_writer.writerow(summary)
+
+    analyzer = LogAnalyzer(by=args.by, on_run=on_run)
+    analyzer.read(filenames)
+    if runs_FO is not None:
+        runs_FO.close()
+
+    print(f"{analyzer.runs} runs, {analyzer.records} records in {len(filenames)} files")
+    print('\n'.join(analyzer.table()))
+
+    rows = analyzer.rows()
+    if args.csv_file:
+        write_csv(args.csv_file, rows)
+    if args.json_file:
+        with open(args.json_file, 'w') as FO:
+            json.dump({'runs': analyzer.runs, 'group_by': args.by,
+                       'percentiles': rows}, FO, indent=1)
@@ -0,0 +1,164 @@
+'''
+Queue-based logging to rotating files.
+
+Records for the log files go onto a bounded queue and are written by a
+background thread (logging.handlers.QueueListener), so the tunnel, viewer
+and health check threads never wait for the disk.  If the writer falls
+behind and the queue fills, records are dropped and counted rather than
+blocking the caller.
+
+The text log keeps the logs/lick-remote-log-utc-YYYYMMDD.txt name of the
+current UT date, moves to a new file at UT midnight and is rotated to
+numbered backups (.1, .2, ...) when it grows past max_bytes.  Optionally
+the same records are written as JSON lines (.jsonl) with the structured
+fields session, port, phase and duration when a record has them (pass
+them with extra={...}).
+'''
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+
+STRUCTURED_FIELDS = ['session', 'port', 'phase', 'duration']
+TEXT_FORMAT = '%(asctime)s UT - %(levelname)s: %(message)s'
+
+
+def utc_date(timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d')
+
+
+class DailyRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    Writes to pattern.format(date=YYYYMMDD) for the UT date of each record,
+    switching files at UT midnight, with size rotation within a day.
+    '''
+    def __init__(self, pattern, maxBytes=0, backupCount=0):
+        self.pattern = pattern
+        self.date = utc_date()
+        super().__init__(pattern.format(date=self.date), maxBytes=maxBytes,
+                         backupCount=backupCount)
+
+
+    def shouldRollover(self, record):
+        if utc_date(record.created) != self.date:
+            return True
+        return super().shouldRollover(record)
+
+
+    def doRollover(self):
+        date = utc_date()
+        if date == self.date:
+            super().doRollover()
+            return
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.date = date
+        self.baseFilename = os.path.abspath(self.pattern.format(date=date))
+        self.stream = self._open()
+
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per record: time, level, thread, message and any
+    structured fields.
+    '''
+    def format(self, record):
+        created = datetime.datetime.utcfromtimestamp(record.created)
+        entry = {'time': created.isoformat(timespec='milliseconds') + 'Z',
+                 'level': record.levelname,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''A QueueHandler that drops records instead of blocking on a full queue.
+    '''
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline(object):
+
+    def __init__(self, log, directory='logs', prefix='lick-remote-log-utc',
+                 max_bytes=10000000, backups=10, queue_size=10000):
+        self.log = log
+        self.directory = directory
+        self.prefix = prefix
+        os.makedirs(directory, exist_ok=True)
+
+        self.text_handler = DailyRotatingFileHandler(self.pattern('.txt'),
+                                                     max_bytes, backups)
+        formatter = logging.Formatter(TEXT_FORMAT)
+        formatter.converter = time.gmtime
+        self.text_handler.setFormatter(formatter)
+        self.json_handler = None
+
+        self.queue = queue.Queue(queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.handler.setLevel(logging.DEBUG)
+        self.listener = logging.handlers.QueueListener(self.queue, self.text_handler)
+        self.running = False
+
+
+    def pattern(self, suffix):
+        return os.path.join(self.directory, f'{self.prefix}-{{date}}{suffix}')
+
+
+    @property
+    def filename(self):
+        '''The text log file currently written.'''
+        return self.text_handler.baseFilename
+
+
+    def start(self):
+        self.log.addHandler(self.handler)
+        self.listener.start()
+        self.running = True
+
+
+    def configure(self, max_bytes=None, backups=None, json_lines=False):
+        for handler in self.listener.handlers:
+            if max_bytes is not None:
+                handler.maxBytes = int(max_bytes)
+            if backups is not None:
+                handler.backupCount = int(backups)
+        if json_lines and self.json_handler is None:
+            self.json_handler = DailyRotatingFileHandler(self.pattern('.jsonl'),
+                        self.text_handler.maxBytes, self.text_handler.backupCount)
+            self.json_handler.setFormatter(JsonFormatter())
+            #the listener reads its handlers for every record
+            self.listener.handlers = self.listener.handlers + (self.json_handler,)
+
+
+    def stop(self):
+        '''Write out the queued records and stop the writer thread.'''
+        if not self.running:
+            return
+        self.running = False
+        self.log.removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        if self.handler.dropped:
+            self.log.warning(f'{self.handler.dropped} log records were dropped '
+                             f'because the log writer fell behind')
@@ -0,0 +1,167 @@
+'''
+Incremental, compressed upload of the launcher log to the VNC server.
+
+Only the part of the log written since the last successful upload is sent,
+gzip-compressed and appended on the server to <log name>.gz.  Gzip files
+joined end to end are still one valid gzip file, so zcat or gunzip on the
+server give the whole log.  The offset reached (and the inode of the log
+file) are kept in cache/log_upload.json and only advanced after the server
+accepted the data, so an upload that timed out is simply resent next time.
+If the log was rotated since the last upload, the rest of the rotated copy
+is sent before the new file.  The new part is read and compressed in
+CHUNK_SIZE pieces as the transport sends them, so a large log is never
+held in memory whole.
+'''
+import json
+import os
+import time
+import zlib
+
+
+CHUNK_SIZE = 256 * 1024
+
+
+class UploadResult(object):
+    '''An object to contain the outcome of one log upload.
+    '''
+    def __init__(self, destination):
+        self.destination = destination
+        self.raw = 0
+        self.compressed = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        if self.raw == 0:
+            return 'Log already uploaded, nothing new to send'
+        ratio = self.raw / self.compressed if self.compressed else 0
+        rate = self.compressed / self.seconds / 1e3 if self.seconds > 0 else 0
+        return (f'Uploaded {self.raw/1e3:.1f} kB of new log as '
+                f'{self.compressed/1e3:.1f} kB gzip ({ratio:.1f}x smaller) '
+                f'in {self.seconds:.1f}s ({rate:.1f} kB/s)')
+
+
+class GzipStream(object):
+    '''
+    Iterating yields length bytes of an open file, read CHUNK_SIZE at a
+    time, as one gzip member.  raw and compressed count what was yielded.
+    '''
+    def __init__(self, FO, length, level=6, chunk_size=CHUNK_SIZE):
+        self.FO = FO
+        self.length = length
+        self.level = level
+        self.chunk_size = chunk_size
+        self.raw = 0
+        self.compressed = 0
+
+    def __iter__(self):
+        #wbits 31: gzip header and trailer around the deflate data
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        while self.raw < self.length:
+            data = self.FO.read(min(self.chunk_size, self.length - self.raw))
+            if not data:
+                break
+            self.raw += len(data)
+            chunk = compressor.compress(data)
+            if chunk:
+                self.compressed += len(chunk)
+                yield chunk
+        chunk = compressor.flush()
+        self.compressed += len(chunk)
+        yield chunk
+
+
+class LogUploader(object):
+
+    def __init__(self, statefile='cache/log_upload.json', level=6,
+                 max_backups=10, chunk_size=CHUNK_SIZE, log=None):
+        self.statefile = statefile
+        self.level = level
+        self.chunk_size = chunk_size
+        self.max_backups = max_backups
+        self.log = log
+
+
+    ##-------------------------------------------------------------------------
+    ## Upload offsets per log file
+    ##-------------------------------------------------------------------------
+    def load_state(self):
+        try:
+            with open(self.statefile) as FO:
+                return json.load(FO)
+        except (OSError, ValueError):
+            return {}
+
+
+    def save_state(self, state):
+        directory = os.path.dirname(self.statefile)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = f'{self.statefile}.tmp'
+        with open(tmp, 'w') as FO:
+            json.dump(state, FO, indent=1)
+        os.replace(tmp, self.statefile)
+
+
+    def pending(self, filename, entry):
+        '''
+        (path, start, end) ranges of the log not uploaded yet, given the
+        saved entry ({'inode': ..., 'offset': ...} or None) for filename.
+        '''
+        stat = os.stat(filename)
+        if entry is None:
+            return [(filename, 0, stat.st_size)]
+        if entry['inode'] == stat.st_ino and entry['offset'] <= stat.st_size:
+            return [(filename, entry['offset'], stat.st_size)]
+
+        #rotated: finish the copy that was being uploaded, then start over
+        ranges = []
+        for i in range(1, self.max_backups + 1):
+            backup = f'{filename}.{i}'
+            try:
+                backup_stat = os.stat(backup)
+            except OSError:
+                break
+            if backup_stat.st_ino == entry['inode'] and \
+                    entry['offset'] <= backup_stat.st_size:
+                ranges.append((backup, entry['offset'], backup_stat.st_size))
+                break
+        ranges.append((filename, 0, stat.st_size))
+        return ranges
+
+
+    ##-------------------------------------------------------------------------
+    ## Send the new part of the log
+    ##-------------------------------------------------------------------------
+    def upload(self, filename, transport, timeout=120):
+        '''
+        Append what is new in filename to <basename>.gz on the server with
+        transport.append().  Returns an UploadResult; transport errors are
+        raised after the ranges already sent were recorded.
+        '''
+        filename = os.path.abspath(filename)
+        result = UploadResult(os.path.basename(filename) + '.gz')
+        state = self.load_state()
+        start_time = time.perf_counter()
+
+        for path, start, end in self.pending(filename, state.get(filename)):
+            if end <= start:
+                continue
+            with open(path, 'rb') as FO:
+                inode = os.fstat(FO.fileno()).st_ino
+                FO.seek(start)
+                stream = GzipStream(FO, end - start, self.level, self.chunk_size)
+                transport.append(stream, result.destination,
+                                 timeout=max(timeout - (time.perf_counter() - start_time), 1))
+            if self.log: self.log.debug(f'Uploaded {path} bytes {start}-{start + stream.raw} '
+                                        f'({stream.compressed} bytes gzip)')
+            result.raw += stream.raw
+            result.compressed += stream.compressed
+            state[filename] = {'inode': inode, 'offset': start + stream.raw}
+            self.save_state(state)
+
+        #also record where an already uploaded (or empty) new file starts
+        if filename not in state or state[filename]['inode'] != os.stat(filename).st_ino:
+            state[filename] = {'inode': os.stat(filename).st_ino, 'offset': 0}
+            self.save_state(state)
+        result.seconds = time.perf_counter() - start_time
+        return result
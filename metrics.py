@@ -0,0 +1,203 @@
+'''
+Prometheus metrics for the launcher on a local HTTP port.
+
+With metrics_port set in the config, GET /metrics on that port answers in
+the Prometheus text format with the state of this station: tunnels per
+local port, reconnects, health check latency, viewers, soundplay, relay
+traffic and how long each startup step took.  Every value is read from the
+launcher's in-memory state (the supervisors' counters, the health
+checker's last probe, poll() of processes it started), so a scrape starts
+no subprocesses and sends nothing over the network.
+'''
+import collections
+import http.server
+import threading
+import time
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+HEALTH_STATES = ['unknown', 'ok', 'degraded', 'dead']
+
+
+class Exposition(object):
+    '''Metrics in the text format: HELP and TYPE once per metric, then all
+    of its samples together.
+    '''
+    def __init__(self):
+        self.families = collections.OrderedDict()
+
+    def add(self, name, kind, help_text, value, **labels):
+        if value is None:
+            return
+        if name not in self.families:
+            self.families[name] = [f'# HELP {name} {help_text}',
+                                   f'# TYPE {name} {kind}']
+        sample = name
+        if labels:
+            pairs = ','.join(f'{key}="{escape(value)}"' for key, value in labels.items())
+            sample = f'{name}{{{pairs}}}'
+        self.families[name].append(f'{sample} {float(value):g}')
+
+    def text(self):
+        return '\n'.join(line for lines in self.families.values() for line in lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def running(proc):
+    '''1 if a process started by the launcher is running (poll() only).'''
+    return 1 if proc is not None and proc.poll() is None else 0
+
+
+##-------------------------------------------------------------------------
+## Collect from the launcher
+##-------------------------------------------------------------------------
+def collect(launcher, version=None):
+    out = Exposition()
+    out.add('lick_launcher_info', 'gauge', 'Launcher version and telescope.', 1,
+            version=version or '', telescope=launcher.tel or '',
+            instrument=launcher.instrument or '', server=launcher.vncserver or '')
+    out.add('lick_launcher_uptime_seconds', 'gauge', 'Seconds since the launcher started.',
+            time.perf_counter() - launcher.start_time if launcher.start_time else None)
+
+    #tunnels
+    with launcher.tunnel_lock:
+        tunnels = sorted(launcher.ports_in_use.items())
+    for port, tunnel in tunnels:
+        out.add('lick_tunnel_up', 'gauge', 'SSH tunnel process alive (1) or not (0).',
+                1 if tunnel.is_alive() else 0, port=port,
+                session=tunnel.session_name, mode=tunnel.mode)
+
+    tunnel_supervisor = launcher.tunnel_supervisor
+    if tunnel_supervisor is not None:
+        now = time.time()
+        for name, stats in sorted(list(tunnel_supervisor.stats.items())):
+            downtime = stats.downtime
+            if stats.down_since is not None:
+                downtime += now - stats.down_since
+            out.add('lick_tunnel_drops_total', 'counter',
+                    'Times the SSH tunnel was found dead.', stats.drops, session=name)
+            out.add('lick_tunnel_reconnects_total', 'counter',
+                    'Times the SSH tunnel was reopened.', stats.reconnects, session=name)
+            out.add('lick_tunnel_downtime_seconds_total', 'counter',
+                    'Seconds the SSH tunnel was down.', downtime, session=name)
+
+    #health checks
+    health_checker = launcher.health_checker
+    if health_checker is not None:
+        with health_checker.lock:
+            health = sorted(health_checker.health.items())
+        for name, session in health:
+            out.add('lick_probe_latency_seconds', 'gauge',
+                    'Latency of the last successful health check.', session.latency,
+                    session=name)
+            out.add('lick_probe_checks_total', 'counter', 'Health checks made.',
+                    session.checks, session=name)
+            out.add('lick_probe_failures', 'gauge',
+                    'Failed health checks in a row.', session.failures, session=name)
+            for state in HEALTH_STATES:
+                out.add('lick_session_health', 'gauge',
+                        'Health check state of the session (1 for the current state).',
+                        1 if session.state == state else 0, session=name, state=state)
+
+    #viewers
+    viewer_supervisor = launcher.viewer_supervisor
+    if viewer_supervisor is not None:
+        with viewer_supervisor.lock:
+            viewers = sorted(viewer_supervisor.viewers.items())
+        for name, record in viewers:
+            out.add('lick_viewer_running', 'gauge', 'VNC viewer process running.',
+                    running(record.proc), session=name, port=record.port)
+            out.add('lick_viewer_restarts_total', 'counter',
+                    'Times the VNC viewer was relaunched.', record.restarts, session=name)
+    out.add('lick_viewer_processes', 'gauge', 'VNC viewer processes running.',
+            sum(running(proc) for proc in list(launcher.vnc_processes)))
+
+    #soundplay
+    if launcher.use_sound:
+        sound = launcher.sound
+        out.add('lick_soundplay_running', 'gauge', 'Soundplay process running.',
+                running(sound.proc) if sound is not None else 0)
+
+    #relays
+    relay_manager = launcher.relay_manager
+    if relay_manager is not None:
+        with relay_manager.lock:
+            relays = sorted(relay_manager.relays.items())
+        for name, relay in relays:
+            out.add('lick_relay_bytes_total', 'counter', 'Bytes through the local relay.',
+                    relay.stats.bytes_in, session=name, direction='in')
+            out.add('lick_relay_bytes_total', 'counter', 'Bytes through the local relay.',
+                    relay.stats.bytes_out, session=name, direction='out')
+
+    #startup steps
+    graph = launcher.startup_graph
+    if graph is not None:
+        for name, task in list(graph.tasks.items()):
+            out.add('lick_startup_phase_seconds', 'gauge',
+                    'Duration of the startup step.', task.duration, phase=name,
+                    failed=str(name in graph.errors).lower())
+        if 'viewers' in graph.results and graph.tasks['viewers'].end is not None:
+            out.add('lick_startup_viewers_up_seconds', 'gauge',
+                    'Seconds from launch until all viewers were up.',
+                    graph.tasks['viewers'].end)
+    return out.text()
+
+
+##-------------------------------------------------------------------------
+## HTTP server
+##-------------------------------------------------------------------------
+class MetricsServer(object):
+
+    def __init__(self, launcher, port, address='127.0.0.1', version=None):
+        self.launcher = launcher
+        self.log = launcher.log
+        self.version = version
+        self.server = http.server.ThreadingHTTPServer((address, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+
+    def handler(self):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/metrics', '/']:
+                    self.send_error(404)
+                    return
+                try:
+                    body = collect(metrics.launcher, metrics.version).encode()
+                except Exception as error:
+                    metrics.log.debug(f'Metrics collection failed: {error}')
+                    self.send_error(500, str(error))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='metrics', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread = None
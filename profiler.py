@@ -0,0 +1,218 @@
+'''
+Phase-level profiling of launcher runs.
+
+Methods of the launcher marked with @profiled('phase name') are recorded as
+spans: wall time, the thread they ran on, the subprocesses they started and
+why they failed (an exception, or a reason given with Profiler.fail()).
+Each finished span is also logged at debug level with its phase and
+duration as structured fields.  The launcher prints summary() at the end
+of startup; with --profile the
+spans are written as a Chrome trace-event file, which chrome://tracing or
+https://ui.perfetto.dev open as a timeline with one row per thread.
+'''
+import collections
+import functools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import weakref
+
+
+#profilers counting subprocesses, see install_subprocess_hook
+PROFILERS = weakref.WeakSet()
+
+
+##-------------------------------------------------------------------------
+## Count subprocesses started inside spans
+##-------------------------------------------------------------------------
+def count_subprocess():
+    for profiler in list(PROFILERS):
+        profiler.count_subprocess()
+
+
+def install_subprocess_hook():
+    if getattr(install_subprocess_hook, 'installed', False):
+        return
+    install_subprocess_hook.installed = True
+
+    if hasattr(sys, 'addaudithook'):
+        def hook(event, args):
+            if event == 'subprocess.Popen':
+                count_subprocess()
+        sys.addaudithook(hook)
+        return
+
+    #python 3.7 has no audit hooks, wrap Popen itself
+    init = subprocess.Popen.__init__
+
+    @functools.wraps(init)
+    def counting_init(popen, *args, **kwargs):
+        count_subprocess()
+        init(popen, *args, **kwargs)
+    subprocess.Popen.__init__ = counting_init
+
+
+class Span(object):
+    '''An object to contain one timed call of a profiled phase.
+    '''
+    def __init__(self, name, start, thread, detail=None):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.thread = thread
+        self.detail = detail
+        self.subprocesses = 0
+        self.error = None
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class Profiler(object):
+
+    def __init__(self, t0=None, max_spans=10000, log=None):
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self.log = log
+        self.spans = collections.deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        install_subprocess_hook()
+        PROFILERS.add(self)
+
+
+    def count_subprocess(self):
+        for span in getattr(self.local, 'stack', []):
+            span.subprocesses += 1
+
+
+    ##-------------------------------------------------------------------------
+    ## Record spans
+    ##-------------------------------------------------------------------------
+    def begin(self, name, detail=None):
+        span = Span(name, time.perf_counter(), threading.current_thread(), detail)
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(span)
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+
+    def end(self, span, error=None):
+        span.end = time.perf_counter()
+        if error is not None and span.error is None:
+            span.error = error
+        stack = self.local.stack
+        if span in stack:
+            stack.remove(span)
+        if self.log is not None:
+            failed = '' if span.error is None else f' (failed: {span.error})'
+            self.log.debug(f'{span.name}: {span.duration*1000:.1f}ms{failed}',
+                           extra={'phase': span.name,
+                                  'duration': round(span.duration, 6)})
+
+
+    def fail(self, reason):
+        '''Mark the innermost running span of this thread as failed.'''
+        stack = getattr(self.local, 'stack', [])
+        if stack and stack[-1].error is None:
+            stack[-1].error = reason
+
+
+    ##-------------------------------------------------------------------------
+    ## Summary table per phase
+    ##-------------------------------------------------------------------------
+    def summary(self, until=None):
+        '''
+        Lines of a table with the calls, total and longest wall time,
+        subprocesses and failures of each phase that started before until
+        (perf_counter time, default now).
+        '''
+        with self.lock:
+            spans = [s for s in self.spans if until is None or s.start <= until]
+        phases = collections.OrderedDict()
+        for span in sorted(spans, key=lambda s: s.start):
+            phases.setdefault(span.name, []).append(span)
+
+        width = max([len(name) for name in phases] + [5])
+        lines = [f"  {'Phase':{width}s} | {'Calls':>5s} | {'Total':>7s} | "
+                 f"{'Max':>7s} | {'Procs':>5s} | Failures"]
+        for name, group in phases.items():
+            failures = [s for s in group if s.error is not None]
+            failed = ''
+            if failures:
+                failed = f"{len(failures)}: {failures[0].error}"
+                if len(failed) > 60:
+                    failed = failed[:57] + '...'
+            lines.append(f"  {name:{width}s} | {len(group):5d} | "
+                         f"{sum(s.duration for s in group):6.2f}s | "
+                         f"{max(s.duration for s in group):6.2f}s | "
+                         f"{sum(s.subprocesses for s in group):5d} | {failed}")
+        return lines
+
+
+    ##-------------------------------------------------------------------------
+    ## Chrome trace-event file
+    ##-------------------------------------------------------------------------
+    def trace(self):
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                   'args': {'name': 'lick_vnc_launcher'}}]
+        threads = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            tid = span.thread.ident
+            if tid not in threads:
+                threads[tid] = span.thread.name
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                               'tid': tid, 'args': {'name': span.thread.name}})
+            args = {'subprocesses': span.subprocesses}
+            if span.detail is not None:
+                args['detail'] = span.detail
+            if span.error is not None:
+                args['error'] = span.error
+            events.append({'name': span.name, 'cat': 'launcher', 'ph': 'X',
+                           'pid': pid, 'tid': tid,
+                           'ts': round((span.start - self.t0) * 1e6),
+                           'dur': round(span.duration * 1e6), 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+    def write_trace(self, filename):
+        tmp = f'{filename}.tmp'
+        with open(tmp, 'w') as FO:
+            json.dump(self.trace(), FO)
+        os.replace(tmp, filename)
+
+
+##-------------------------------------------------------------------------
+## Decorator for launcher methods
+##-------------------------------------------------------------------------
+def profiled(name, detail=None):
+    '''
+    Record each call of a method as a span of phase name, using the
+    profiler attribute of the object (if it has one).  detail is an
+    optional function of the call's arguments giving a short description.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = getattr(self, 'profiler', None)
+            if profiler is None:
+                return method(self, *args, **kwargs)
+            span = profiler.begin(name, detail(*args, **kwargs) if detail else None)
+            error = None
+            try:
+                return method(self, *args, **kwargs)
+            except BaseException as e:
+                error = f'{type(e).__name__}: {e}'
+                raise
+            finally:
+                profiler.end(span, error)
+        return wrapper
+    return decorator
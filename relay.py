@@ -0,0 +1,664 @@
+'''
+Byte-counting TCP relay between a local client and an ssh forward.
+
+A Relay listens on a free local port and copies every connection it
+accepts to the tunnel's local port, counting the bytes in each direction,
+the connections, and the time the relay itself adds (connecting upstream
+and handing each chunk on).  The vncviewer is pointed at the relay instead
+of the tunnel, so the counters show how much each desktop uses.
+
+Each relay runs one event loop (epoll on Linux) over non-blocking sockets,
+connecting upstream without blocking too, so a slow tunnel endpoint never
+holds up the other connections.
+On Linux the bytes never enter Python: os.splice() moves them from the
+socket into a pipe and from the pipe into the other socket inside the
+kernel.  Elsewhere each direction reads into one preallocated buffer with
+recv_into() and sends from a memoryview of it.
+
+Run this file directly to benchmark relay throughput and CPU per GB of
+each engine against a direct connection (and an ssh -L forward with
+--ssh).
+
+RelayManager owns the relays of all sessions, samples their counters for
+throughput over time and logs a summary periodically and on exit.
+'''
+import argparse
+import collections
+import errno
+import os
+import selectors
+import socket
+import threading
+import time
+import traceback
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+BUFFER_SIZE = 256 * 1024
+CONNECT_TIMEOUT = 2.0
+CONNECT_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN,
+                       getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)}
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+
+##-------------------------------------------------------------------------
+## Human readable sizes
+##-------------------------------------------------------------------------
+def format_bytes(n):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(n) < 1000 or unit == 'GB':
+            break
+        n /= 1000
+    return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+
+
+class RelayStats(object):
+    '''An object to contain the counters of one session's relay.
+    '''
+    def __init__(self, samples=720):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.active = 0
+        self.chunks = 0
+        self.connect_time = 0.0
+        self.forward_time = 0.0
+        self.samples = collections.deque(maxlen=samples)
+        self.lock = threading.Lock()
+
+    def add(self, direction, nbytes, elapsed):
+        with self.lock:
+            if direction == 'in':
+                self.bytes_in += nbytes
+            else:
+                self.bytes_out += nbytes
+            self.chunks += 1
+            self.forward_time += elapsed
+
+    def sample(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.samples.append((now, self.bytes_in, self.bytes_out))
+
+    def rate(self, window=60.0, now=None):
+        '''
+        Return (bytes in, bytes out) per second from the oldest sample in the
+        last window seconds to the current counters.
+        '''
+        now = time.time() if now is None else now
+        with self.lock:
+            first = None
+            for sample in reversed(self.samples):
+                if now - sample[0] > window:
+                    break
+                first = sample
+            current = (now, self.bytes_in, self.bytes_out)
+        if first is None:
+            return 0.0, 0.0
+        elapsed = current[0] - first[0]
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (current[1] - first[1]) / elapsed, (current[2] - first[2]) / elapsed
+
+    @property
+    def added_latency(self):
+        '''Mean seconds the relay adds per connection and per chunk.'''
+        with self.lock:
+            per_connection = self.connect_time / self.connections if self.connections else 0.0
+            per_chunk = self.forward_time / self.chunks if self.chunks else 0.0
+        return per_connection, per_chunk
+
+    def __str__(self):
+        rate_in, rate_out = self.rate()
+        per_connection, per_chunk = self.added_latency
+        return (f"{self.connections} conns ({self.active} open), "
+                f"in {format_bytes(self.bytes_in)} ({format_bytes(rate_in)}/s), "
+                f"out {format_bytes(self.bytes_out)} ({format_bytes(rate_out)}/s), "
+                f"adds {per_connection*1000:.1f}ms/conn {per_chunk*1e6:.0f}us/chunk")
+
+
+def best_engine():
+    '''
+    Return 'splice' where the kernel can move data between sockets without
+    copying it through Python (Linux, Python 3.10+), otherwise 'buffered'.
+    '''
+    if hasattr(os, 'splice') and hasattr(os, 'pipe2'):
+        return 'splice'
+    return 'buffered'
+
+
+class Stream(object):
+    '''One direction of a relayed connection: src is read, dst written.
+
+    The splice engine moves data socket -> pipe -> socket inside the kernel;
+    the buffered engine reads into one preallocated buffer with recv_into()
+    and sends from a memoryview of it, so no bytes objects are created.
+    '''
+    def __init__(self, src, dst, direction, engine, bufsize):
+        self.src = src
+        self.dst = dst
+        self.direction = direction
+        self.engine = engine
+        self.bufsize = bufsize
+        self.pending = 0
+        self.chunk = 0
+        self.arrived = 0.0
+        self.total = 0
+        self.eof = False
+        self.done = False
+        self.pipe_r = None
+        self.pipe_w = None
+        if engine == 'splice':
+            self.pipe_r, self.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+            #a larger pipe lets one splice move a whole chunk
+            if hasattr(fcntl, 'F_SETPIPE_SZ'):
+                try:
+                    fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, bufsize)
+                except OSError:
+                    pass
+        else:
+            self.buffer = bytearray(bufsize)
+            self.view = memoryview(self.buffer)
+            self.offset = 0
+
+    def read(self):
+        '''Read one chunk from src; returns 0 at end of stream.'''
+        if self.engine == 'splice':
+            n = os.splice(self.src.fileno(), self.pipe_w, self.bufsize,
+                          flags=SPLICE_FLAGS)
+        else:
+            n = self.src.recv_into(self.buffer)
+            self.offset = 0
+        self.pending = n
+        self.chunk = n
+        return n
+
+    def write(self):
+        '''Write as much of the pending chunk to dst as it will take.'''
+        if self.engine == 'splice':
+            n = os.splice(self.pipe_r, self.dst.fileno(), self.pending,
+                          flags=SPLICE_FLAGS)
+        else:
+            n = self.dst.send(self.view[self.offset:self.offset + self.pending])
+            self.offset += n
+        self.pending -= n
+        self.total += n
+        return n
+
+    def close(self):
+        for fd in [self.pipe_r, self.pipe_w]:
+            if fd is not None:
+                os.close(fd)
+        self.pipe_r = self.pipe_w = None
+
+
+class PendingConnect(object):
+    '''A client waiting for its upstream connection to complete.
+    '''
+    def __init__(self, client, upstream):
+        self.client = client
+        self.upstream = upstream
+        self.started = time.perf_counter()
+
+
+class Connection(object):
+    '''A relayed client connection and its upstream connection.
+    '''
+    def __init__(self, client, upstream, engine, bufsize):
+        self.client = client
+        self.upstream = upstream
+        self.streams = [Stream(client, upstream, 'out', engine, bufsize),
+                        Stream(upstream, client, 'in', engine, bufsize)]
+        self.masks = {client: 0, upstream: 0}
+        self.opened = time.time()
+
+    def interest(self, sock):
+        mask = 0
+        for stream in self.streams:
+            if stream.src is sock and not stream.eof and stream.pending == 0:
+                mask |= selectors.EVENT_READ
+            if stream.dst is sock and stream.pending > 0:
+                mask |= selectors.EVENT_WRITE
+        return mask
+
+
+class Relay(object):
+
+    def __init__(self, session_name, target_port, target_host='127.0.0.1',
+                 log=None, bufsize=BUFFER_SIZE, engine='auto'):
+        self.session_name = session_name
+        self.target_port = target_port
+        self.target_host = target_host
+        self.log = log
+        self.bufsize = bufsize
+        self.engine = best_engine() if engine == 'auto' else engine
+        self.stats = RelayStats()
+        self.port = None
+        self.server = None
+        self.selector = None
+        self.connections = set()
+        self.pending = set()
+        self.closed = False
+        self.wake_r, self.wake_w = socket.socketpair()
+
+
+    def start(self, port=0):
+        '''
+        Listen on localhost:port (default any free port) and return the port.
+        '''
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen(8)
+        self.server.setblocking(False)
+        self.port = self.server.getsockname()[1]
+
+        #one epoll (or select) loop carries all connections of the relay
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ, 'accept')
+        self.selector.register(self.wake_r, selectors.EVENT_READ, 'wake')
+        threading.Thread(target=self.run, daemon=True).start()
+        return self.port
+
+
+    def stop(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.wake_w.send(b'x')
+        except OSError:
+            pass
+
+
+    ##-------------------------------------------------------------------------
+    ## Event loop
+    ##-------------------------------------------------------------------------
+    def run(self):
+        try:
+            while not self.closed:
+                for key, mask in self.selector.select(timeout=1.0):
+                    if key.data == 'accept':
+                        self.accept()
+                    elif isinstance(key.data, PendingConnect):
+                        self.connect_ready(key.data)
+                    elif key.data != 'wake':
+                        self.ready(key.data, key.fileobj, mask)
+                self.expire()
+        except Exception:
+            if self.log:
+                self.log.error(f"Relay for '{self.session_name}' failed, "
+                               f"see log for details")
+                self.log.debug(traceback.format_exc())
+        finally:
+            for conn in list(self.connections):
+                self.close(conn)
+            for pending in list(self.pending):
+                self.pending.discard(pending)
+                pending.client.close()
+                pending.upstream.close()
+            self.selector.close()
+            self.server.close()
+            self.wake_r.close()
+            self.wake_w.close()
+            self.closed = True
+
+
+    def accept(self):
+        try:
+            client, addr = self.server.accept()
+        except BlockingIOError:
+            return
+        #connect without waiting: a slow or dead tunnel endpoint must not
+        # stall the other connections on this loop
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        upstream.setblocking(False)
+        pending = PendingConnect(client, upstream)
+        error = upstream.connect_ex((self.target_host, self.target_port))
+        if error == 0:
+            self.connected(pending)
+        elif error in CONNECT_IN_PROGRESS:
+            self.pending.add(pending)
+            self.selector.register(upstream, selectors.EVENT_WRITE, pending)
+        else:
+            self.connect_failed(pending, os.strerror(error))
+
+
+    def connect_ready(self, pending):
+        self.selector.unregister(pending.upstream)
+        self.pending.discard(pending)
+        error = pending.upstream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            self.connect_failed(pending, os.strerror(error))
+        else:
+            self.connected(pending)
+
+
+    def expire(self):
+        '''Give up on upstream connections not made within CONNECT_TIMEOUT.'''
+        now = time.perf_counter()
+        for pending in list(self.pending):
+            if now - pending.started > CONNECT_TIMEOUT:
+                self.selector.unregister(pending.upstream)
+                self.pending.discard(pending)
+                self.connect_failed(pending, 'timed out')
+
+
+    def connect_failed(self, pending, reason):
+        pending.client.close()
+        pending.upstream.close()
+        if self.log: self.log.warning(f"Relay for '{self.session_name}' could "
+                                      f"not reach port {self.target_port}: {reason}")
+
+
+    def connected(self, pending):
+        client, upstream = pending.client, pending.upstream
+        connect_time = time.perf_counter() - pending.started
+        for sock in [client, upstream]:
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        conn = Connection(client, upstream, self.engine, self.bufsize)
+        self.connections.add(conn)
+        self.update(conn)
+        with self.stats.lock:
+            self.stats.connections += 1
+            self.stats.active += 1
+            self.stats.connect_time += connect_time
+        if self.log: self.log.debug(f"Relay for '{self.session_name}' connected "
+                                    f"in {connect_time*1000:.1f}ms ({self.engine})")
+
+
+    def update(self, conn):
+        '''Register each socket for the events its streams are waiting for.'''
+        for sock in [conn.client, conn.upstream]:
+            mask = conn.interest(sock)
+            if mask == conn.masks[sock]:
+                continue
+            if conn.masks[sock] == 0:
+                self.selector.register(sock, mask, conn)
+            elif mask == 0:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, mask, conn)
+            conn.masks[sock] = mask
+
+
+    def ready(self, conn, sock, mask):
+        try:
+            for stream in conn.streams:
+                if mask & selectors.EVENT_READ and stream.src is sock \
+                        and stream.pending == 0 and not stream.eof:
+                    self.transfer(stream)
+                if mask & selectors.EVENT_WRITE and stream.dst is sock \
+                        and stream.pending > 0:
+                    self.flush(stream)
+        except OSError:
+            #reset by either end
+            self.close(conn)
+            return
+        if all(stream.done for stream in conn.streams):
+            self.close(conn)
+        else:
+            self.update(conn)
+
+
+    def transfer(self, stream):
+        try:
+            n = stream.read()
+        except BlockingIOError:
+            return
+        if n == 0:
+            stream.eof = True
+        else:
+            stream.arrived = time.perf_counter()
+        self.flush(stream)
+
+
+    def flush(self, stream):
+        while stream.pending > 0:
+            try:
+                stream.write()
+            except BlockingIOError:
+                return
+        if stream.chunk > 0:
+            self.stats.add(stream.direction, stream.chunk,
+                           time.perf_counter() - stream.arrived)
+            stream.chunk = 0
+        if stream.eof and not stream.done:
+            stream.done = True
+            try:
+                stream.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+
+    def close(self, conn):
+        if conn not in self.connections:
+            return
+        self.connections.discard(conn)
+        for sock in [conn.client, conn.upstream]:
+            if conn.masks[sock] != 0:
+                self.selector.unregister(sock)
+            sock.close()
+        for stream in conn.streams:
+            stream.close()
+        with self.stats.lock:
+            self.stats.active -= 1
+        totals = {stream.direction: stream.total for stream in conn.streams}
+        if self.log and not self.closed:
+            self.log.info(f"Relay for '{self.session_name}' connection closed "
+                          f"after {time.time() - conn.opened:.0f}s, "
+                          f"in {format_bytes(totals['in'])}, "
+                          f"out {format_bytes(totals['out'])}")
+
+
+class RelayManager(object):
+
+    def __init__(self, log, sample_interval=5.0, log_interval=300.0, engine='auto'):
+        self.log = log
+        self.engine = engine
+        self.sample_interval = sample_interval
+        self.log_interval = log_interval
+        self.relays = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+
+    ##-------------------------------------------------------------------------
+    ## Start (or reuse) the relay for a session
+    ##-------------------------------------------------------------------------
+    def start_relay(self, session_name, target_port):
+        '''
+        Return the local port of the relay for session_name in front of
+        target_port, starting one if needed.
+        '''
+        with self.lock:
+            relay = self.relays.get(session_name)
+            if relay is not None and relay.target_port == target_port \
+                    and not relay.closed:
+                return relay.port
+            if relay is not None:
+                relay.stop()
+            relay = Relay(session_name, target_port, log=self.log,
+                          engine=self.engine)
+            port = relay.start()
+            relay.stats.sample()
+            self.relays[session_name] = relay
+        self.log.info(f"Relaying '{session_name}' through local port {port} "
+                      f"to port {target_port} ({relay.engine})")
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return port
+
+
+    def stop_relay(self, session_name):
+        with self.lock:
+            relay = self.relays.get(session_name)
+        if relay is not None and not relay.closed:
+            relay.stop()
+
+
+    def stop(self):
+        self.stop_event.set()
+        with self.lock:
+            relays = list(self.relays.values())
+        for relay in relays:
+            relay.stop()
+
+
+    def run(self):
+        last_log = time.time()
+        while not self.stop_event.wait(self.sample_interval):
+            try:
+                now = time.time()
+                with self.lock:
+                    relays = list(self.relays.values())
+                for relay in relays:
+                    relay.stats.sample(now)
+                if self.log_interval and now - last_log >= self.log_interval:
+                    last_log = now
+                    self.log.info('Relay traffic:\n' + '\n'.join(self.report()))
+            except Exception:
+                self.log.error('Relay sampler error, see log for details')
+                self.log.debug(traceback.format_exc())
+
+
+    def status(self, session_name):
+        with self.lock:
+            relay = self.relays.get(session_name)
+        if relay is None or relay.closed:
+            return ''
+        return f"relay :{relay.port}, {relay.stats}"
+
+
+    def report(self):
+        lines = []
+        with self.lock:
+            relays = sorted(self.relays.items())
+        for name, relay in relays:
+            lines.append(f"  {name:18s} {relay.stats}")
+        return lines
+
+
+##-------------------------------------------------------------------------
+## Benchmark
+##-------------------------------------------------------------------------
+def _bench_source(ports, total):
+    '''Send total bytes to every client that connects, then close.'''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(8)
+    ports.put(server.getsockname()[1])
+    block = memoryview(bytearray(BUFFER_SIZE))
+    while True:
+        client, addr = server.accept()
+        sent = 0
+        while sent < total:
+            sent += client.send(block[:min(len(block), total - sent)])
+        client.close()
+
+
+def _bench_sink(port, results):
+    '''Read from port until it closes and report (bytes, seconds).'''
+    buffer = bytearray(BUFFER_SIZE)
+    start = time.perf_counter()
+    sock = socket.create_connection(('127.0.0.1', port))
+    received = 0
+    while True:
+        n = sock.recv_into(buffer)
+        if n == 0:
+            break
+        received += n
+    results.put((received, time.perf_counter() - start))
+
+
+def _cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def benchmark(modes, total, ssh_host=None):
+    '''
+    Push total bytes through each mode ('direct', a relay engine or 'ssh')
+    and return a dict of mode to (MB/s, CPU seconds per GB forwarded).
+    The source and sink run in child processes, so the CPU counted is that
+    of the relay (this process) or of the ssh client.
+    '''
+    import multiprocessing
+    import resource
+    import subprocess
+    import localports
+
+    ports = multiprocessing.Queue()
+    results_queue = multiprocessing.Queue()
+    source = multiprocessing.Process(target=_bench_source, args=(ports, total),
+                                     daemon=True)
+    source.start()
+    source_port = ports.get()
+
+    results = {}
+    for mode in modes:
+        relay = ssh = None
+        if mode == 'direct':
+            port = source_port
+        elif mode == 'ssh':
+            port = localports.PortAllocator(localports.ports_in_use,
+                                            start=15900).reserve()[0]
+            ssh = subprocess.Popen(['ssh', '-N', '-oBatchMode=yes',
+                                    '-oExitOnForwardFailure=yes',
+                                    '-L', f'{port}:localhost:{source_port}',
+                                    ssh_host])
+            localports.wait_for_port(port, timeout=15)
+        else:
+            relay = Relay('benchmark', source_port, engine=mode)
+            port = relay.start()
+
+        cpu = _cpu_seconds(resource.getrusage(resource.RUSAGE_SELF))
+        sink = multiprocessing.Process(target=_bench_sink, args=(port, results_queue))
+        sink.start()
+        received, elapsed = results_queue.get()
+        sink.join()
+        cpu = _cpu_seconds(resource.getrusage(resource.RUSAGE_SELF)) - cpu
+
+        if relay is not None:
+            relay.stop()
+        if ssh is not None:
+            ssh.terminate()
+            pid, status, usage = os.wait4(ssh.pid, 0)
+            ssh.returncode = status
+            #includes the ssh handshake, which is small next to a GB
+            cpu = _cpu_seconds(usage)
+        if mode == 'direct':
+            cpu = 0.0
+        results[mode] = (received / elapsed / 1e6, cpu / (received / 1e9))
+
+    source.terminate()
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the local relay engines.")
+    parser.add_argument("--size", type=float, dest="size", default=1.0,
+                        help="GB to transfer per mode.")
+    parser.add_argument("--engine", type=str, dest="engines", action="append", default=None,
+                        help="Relay engine to benchmark (splice, buffered). Default is all available.")
+    parser.add_argument("--ssh", type=str, dest="ssh_host", default=None,
+                        help="Also forward through 'ssh -L' to this host (e.g. localhost with a running sshd and key login).")
+    args = parser.parse_args()
+
+    engines = args.engines or (['splice', 'buffered'] if best_engine() == 'splice'
+                               else ['buffered'])
+    modes = ['direct'] + engines + (['ssh'] if args.ssh_host else [])
+    results = benchmark(modes, int(args.size * 1e9), args.ssh_host)
+
+    print(f"Transferring {args.size:.1f} GB per mode:")
+    print(f"  {'Mode':8s} | {'Throughput':>12s} | {'CPU per GB':>10s}")
+    for mode, (rate, cpu_per_gb) in results.items():
+        print(f"  {mode:8s} | {rate:7.0f} MB/s | {cpu_per_gb:8.2f} s")
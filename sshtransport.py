@@ -0,0 +1,440 @@
+'''
+SSH transports: how the launcher runs remote commands, forwards ports and
+uploads files.
+
+OpenSSHTransport runs the ssh and scp clients as subprocesses (sharing the
+launcher's ControlMaster connection through the options it is given).
+ParamikoTransport does everything in-process over one paramiko connection:
+commands are channels with real exit statuses and separate stderr, port
+forwards are local listeners feeding 'direct-tcpip' channels, and uploads
+go over SFTP, so no process is spawned per operation.
+
+Both return CommandResult from run().  Only ParamikoTransport has
+forward(): it returns an object with the poll()/kill()/terminate()/
+returncode interface of a Popen, so the launcher's tunnel bookkeeping and
+supervisors treat it like the ssh processes the launcher starts itself for
+the openssh backend (several -L forwards per process, or forwards added
+to the master connection).
+'''
+import select
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import traceback
+
+
+BACKENDS = ['openssh', 'paramiko']
+
+
+class TransportError(Exception):
+    pass
+
+
+class TransportTimeout(TransportError):
+    pass
+
+
+class CommandResult(object):
+    '''An object to contain the result of a remote command.
+    '''
+    def __init__(self, status, stdout, stderr):
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def text(self):
+        return self.stdout.decode(errors='replace').strip()
+
+
+##-------------------------------------------------------------------------
+## Create a transport by backend name
+##-------------------------------------------------------------------------
+def create_transport(backend, server, account, options=None, key_filename=None,
+                     password=None, compression=True, log=None):
+    '''
+    options is a callable returning the ssh command line options (openssh
+    only, called for every command so it sees the current master).
+    '''
+    if backend == 'openssh':
+        return OpenSSHTransport(server, account, options, log)
+    if backend == 'paramiko':
+        return ParamikoTransport(server, account, key_filename, password,
+                                 compression, log)
+    raise ValueError(f"unknown ssh backend '{backend}', choose from "
+                     + ', '.join(BACKENDS))
+
+
+def chunks(data):
+    '''append() takes bytes or an iterable of bytes.'''
+    return [data] if isinstance(data, (bytes, bytearray)) else data
+
+
+class OpenSSHTransport(object):
+
+    def __init__(self, server, account, options=None, log=None):
+        self.server = server
+        self.account = account
+        self.options = options or (lambda: [])
+        self.log = log
+
+
+    def alive(self):
+        return True
+
+
+    def run(self, command, timeout=10):
+        args = ['ssh', self.server, '-l', self.account, '-T']
+        args += self.options()
+        args.append(command)
+        if self.log: self.log.debug('ssh command: ' + ' '.join(args))
+        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise TransportTimeout(f'ssh command timed out after {timeout}s')
+        return CommandResult(proc.returncode, stdout, stderr)
+
+
+    def upload(self, source, destination, timeout=10):
+        args = ['scp'] + self.options()
+        args += [source, f'{self.account}@{self.server}:{destination}']
+        if self.log: self.log.debug('scp command: ' + ' '.join(args))
+        try:
+            proc = subprocess.run(args, stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                  timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise TransportTimeout(f'scp timed out after {timeout}s')
+        if proc.returncode != 0:
+            raise TransportError(f'scp failed with status {proc.returncode}: '
+                                 f'{proc.stderr.decode(errors="replace").strip()}')
+
+
+    def append(self, data, destination, timeout=10):
+        '''
+        Append bytes, or an iterable of byte chunks written as they come, to
+        a remote file (through cat on the server).
+        '''
+        args = ['ssh', self.server, '-l', self.account, '-T']
+        args += self.options()
+        args.append(f'cat >> {shlex.quote(destination)}')
+        if self.log: self.log.debug('ssh command: ' + ' '.join(args))
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        #the chunks are written from this thread, a timer enforces the timeout
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+        try:
+            try:
+                for chunk in chunks(data):
+                    proc.stdin.write(chunk)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            stderr = proc.stderr.read()
+            proc.wait()
+        finally:
+            timer.cancel()
+            #reading the chunks failed: do not leave ssh waiting for more
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if expired.is_set():
+            raise TransportTimeout(f'upload timed out after {timeout}s')
+        if proc.returncode != 0:
+            raise TransportError(f'upload failed with status {proc.returncode}: '
+                                 f'{stderr.decode(errors="replace").strip()}')
+
+
+    def close(self):
+        pass
+
+
+class ParamikoTransport(object):
+
+    def __init__(self, server, account, key_filename=None, password=None,
+                 compression=True, log=None):
+        try:
+            import paramiko
+        except ImportError:
+            raise TransportError("ssh_backend 'paramiko' needs the paramiko "
+                                 "package (conda install paramiko)")
+        self.paramiko = paramiko
+        self.server = server
+        self.account = account
+        self.key_filename = key_filename
+        self.password = password
+        self.compression = compression
+        self.log = log
+        self.client = None
+        self.lock = threading.Lock()
+
+
+    ##-------------------------------------------------------------------------
+    ## One connection, reopened on demand
+    ##-------------------------------------------------------------------------
+    def connect(self):
+        with self.lock:
+            if self.alive():
+                return self.client.get_transport()
+            if self.client is not None:
+                self.client.close()
+            if self.log: self.log.debug(f'Opening in-process ssh connection to '
+                                        f'{self.account}@{self.server}')
+            client = self.paramiko.SSHClient()
+            #same as -oStrictHostKeyChecking=no
+            client.set_missing_host_key_policy(self.paramiko.AutoAddPolicy())
+            try:
+                client.connect(self.server, username=self.account,
+                               key_filename=self.key_filename,
+                               password=self.password,
+                               look_for_keys=self.key_filename is None,
+                               allow_agent=self.key_filename is None,
+                               compress=self.compression, timeout=10,
+                               banner_timeout=10, auth_timeout=10)
+            except (self.paramiko.SSHException, OSError) as error:
+                raise TransportError(f'ssh connection to {self.server} failed: {error}')
+            transport = client.get_transport()
+            transport.set_keepalive(30)
+            self.client = client
+            return transport
+
+
+    def alive(self):
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+    def run(self, command, timeout=10):
+        transport = self.connect()
+        try:
+            channel = transport.open_session(timeout=timeout)
+            channel.settimeout(timeout)
+            channel.exec_command(command)
+            stdout, stderr = [], []
+            #settimeout only covers recv(), the loop needs its own deadline
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    channel.close()
+                    raise TransportTimeout(f'ssh command timed out after {timeout}s')
+                if channel.recv_ready():
+                    stdout.append(channel.recv(65536))
+                elif channel.recv_stderr_ready():
+                    stderr.append(channel.recv_stderr(65536))
+                elif channel.exit_status_ready() and not channel.recv_ready() \
+                        and not channel.recv_stderr_ready():
+                    break
+                else:
+                    select.select([channel], [], [], remaining)
+            #drain whatever arrived with the exit status
+            while channel.recv_ready():
+                stdout.append(channel.recv(65536))
+            while channel.recv_stderr_ready():
+                stderr.append(channel.recv_stderr(65536))
+            status = channel.recv_exit_status()
+            channel.close()
+        except socket.timeout:
+            raise TransportTimeout(f'ssh command timed out after {timeout}s')
+        except self.paramiko.SSHException as error:
+            raise TransportError(str(error))
+        return CommandResult(status, b''.join(stdout), b''.join(stderr))
+
+
+    def forward(self, local_port, remote_port, remote_host='localhost'):
+        self.connect()
+        return ParamikoForward(self, local_port, remote_host, remote_port, self.log)
+
+
+    def upload(self, source, destination, timeout=10):
+        self.connect()
+        try:
+            sftp = self.client.open_sftp()
+            sftp.get_channel().settimeout(timeout)
+            sftp.put(source, destination)
+            sftp.close()
+        except socket.timeout:
+            raise TransportTimeout(f'upload timed out after {timeout}s')
+        except (self.paramiko.SSHException, OSError) as error:
+            raise TransportError(f'upload failed: {error}')
+
+
+    def append(self, data, destination, timeout=10):
+        '''Append bytes or an iterable of byte chunks to a remote file (over SFTP).'''
+        self.connect()
+        try:
+            sftp = self.client.open_sftp()
+            sftp.get_channel().settimeout(timeout)
+            with sftp.open(destination, 'ab') as remote:
+                remote.set_pipelined(True)
+                for chunk in chunks(data):
+                    remote.write(chunk)
+            sftp.close()
+        except socket.timeout:
+            raise TransportTimeout(f'upload timed out after {timeout}s')
+        except (self.paramiko.SSHException, OSError) as error:
+            raise TransportError(f'upload failed: {error}')
+
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+
+class ParamikoForward(object):
+    '''
+    A local port forwarded over a ParamikoTransport.  Looks like the Popen
+    of an 'ssh -N -L' process: poll() is None while it works.
+    '''
+    def __init__(self, ssh, local_port, remote_host, remote_port, log=None):
+        self.ssh = ssh
+        self.local_port = local_port
+        self.remote_host = remote_host
+        self.remote_port = remote_port
+        self.log = log
+        self.pid = None
+        self.args = ['paramiko', f'{local_port}:{remote_host}:{remote_port}']
+        self.returncode = None
+        self.stderr_lines = []
+        self.sockets = set()
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = None
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.server.bind(('127.0.0.1', local_port))
+            self.server.listen(8)
+        except OSError as error:
+            #the same message ssh gives, so the launcher reports it alike
+            self.stderr_lines.append(f'cannot listen to port: {local_port} ({error})')
+            self.server.close()
+            self.returncode = 255
+            self.closed.set()
+            return
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+        self.thread.start()
+
+
+    def poll(self):
+        if self.returncode is None and not self.ssh.alive():
+            self.close(255)
+        return self.returncode
+
+
+    def wait(self, timeout=None):
+        '''
+        Like Popen.wait(): return the returncode once the forward is closed
+        and its accept thread has finished, or raise TimeoutExpired.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            if deadline is None:
+                return 1.0
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            return min(left, 1.0)
+
+        #poll() as well, a dropped ssh connection closes the forward too
+        while self.poll() is None:
+            self.closed.wait(remaining())
+        while self.thread is not None and self.thread.is_alive():
+            self.thread.join(remaining())
+        return self.returncode
+
+
+    def kill(self):
+        self.close(-9)
+
+
+    def terminate(self):
+        self.close(-15)
+
+
+    def close(self, returncode):
+        with self.lock:
+            if self.returncode is not None and not self.sockets:
+                return
+            if self.returncode is None:
+                self.returncode = returncode
+            sockets = list(self.sockets)
+        #close() alone leaves the port listening while accept() blocks in
+        # accept_loop; shutdown wakes it so the port can be reopened
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        for sock in sockets:
+            sock.close()
+        self.closed.set()
+
+
+    def accept_loop(self):
+        while self.returncode is None:
+            try:
+                client, addr = self.server.accept()
+            except OSError:
+                return
+            if self.returncode is not None:
+                client.close()
+                return
+            threading.Thread(target=self.handle, args=(client, addr), daemon=True).start()
+
+
+    def handle(self, client, addr):
+        try:
+            transport = self.ssh.connect()
+            channel = transport.open_channel('direct-tcpip',
+                                             (self.remote_host, self.remote_port),
+                                             addr, timeout=10)
+        except Exception as error:
+            client.close()
+            if self.log: self.log.debug(f'Forward to {self.remote_host}:'
+                                        f'{self.remote_port} failed: {error}')
+            return
+
+        with self.lock:
+            self.sockets.update([client, channel])
+        try:
+            while self.returncode is None:
+                readable, _, _ = select.select([client, channel], [], [], 1.0)
+                if client in readable:
+                    data = client.recv(65536)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                if channel in readable:
+                    data = channel.recv(65536)
+                    if not data:
+                        break
+                    client.sendall(data)
+        except (OSError, EOFError):
+            pass
+        except Exception:
+            if self.log: self.log.debug(traceback.format_exc())
+        finally:
+            with self.lock:
+                self.sockets.difference_update([client, channel])
+            channel.close()
+            client.close()
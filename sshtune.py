@@ -0,0 +1,256 @@
+'''
+Choose the ssh cipher and compression setting that move data fastest to a
+server.
+
+VNC updates with ZRLE or Tight encoding are already compressed, so ssh's
+own compression (-oCompression=yes) mostly costs CPU on both ends.  A trial
+opens a fresh ssh connection with one cipher and compression setting, runs
+'cat' on the server and pushes payloads through it:
+
+  latency     median round trip of small messages (keyboard and mouse)
+  throughput  MB/s of a large payload echoed back (framebuffer updates);
+              the 'vnc' payload is random bytes, as incompressible as
+              encoded VNC data, the 'text' payload compresses well
+  cpu         CPU seconds of the local ssh client per MB carried
+
+The fastest setting for the 'vnc' payload is chosen (the one using less CPU
+if several are within 5%) and saved per server under ssh_tuning in the
+config file, where ssh_options() picks it up on later launches.
+
+Run this file directly to tune any host, e.g. a local sshd for testing:
+  python sshtune.py localhost --account $USER
+'''
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import threading
+import time
+
+import yaml
+
+
+CIPHERS = ['aes128-gcm@openssh.com', 'aes256-gcm@openssh.com',
+           'chacha20-poly1305@openssh.com', 'aes128-ctr']
+PAYLOADS = ['vnc', 'text']
+TEXT_LINE = b'2024-01-01 01:23:45 KRO INFO: Session Kastblue responded in 12.3ms\n'
+PING = b'x' * 63 + b'\n'
+
+
+class TuneError(Exception):
+    pass
+
+
+##-------------------------------------------------------------------------
+## Representative payloads
+##-------------------------------------------------------------------------
+def make_payload(kind, size):
+    if kind == 'vnc':
+        return os.urandom(size)
+    return (TEXT_LINE * (size // len(TEXT_LINE) + 1))[:size]
+
+
+def cipher_options(cipher, compression):
+    '''ssh options selecting a cipher and compression setting.'''
+    options = [f"-oCompression={'yes' if compression else 'no'}"]
+    if cipher:
+        options.insert(0, f'-oCiphers={cipher}')
+    return options
+
+
+##-------------------------------------------------------------------------
+## Run one trial connection
+##-------------------------------------------------------------------------
+def trial(server, account, cipher, compression, payloads, base_options=(),
+          pings=20, timeout=120):
+    '''
+    Open one ssh connection with cipher and compression, echo payloads (a
+    dict of name to bytes) through 'cat' on the server and return a dict
+    with connect, latency, cpu and per-payload throughput (MB/s).  Raises
+    TuneError if the connection fails (e.g. the cipher is not supported).
+    '''
+    command = ['ssh', '-T', '-l', account, '-oBatchMode=yes',
+               '-oControlMaster=no', '-oControlPath=none']
+    command += cipher_options(cipher, compression)
+    command += list(base_options)
+    command += [server, 'cat']
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, bufsize=0)
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    try:
+        #the first echo includes the handshake
+        proc.stdin.write(PING)
+        if read_exactly(proc.stdout, len(PING)) != PING:
+            raise TuneError('no echo from cat on the server')
+        result = {'connect': time.perf_counter() - start}
+
+        rtts = []
+        for i in range(pings):
+            t0 = time.perf_counter()
+            proc.stdin.write(PING)
+            read_exactly(proc.stdout, len(PING))
+            rtts.append(time.perf_counter() - t0)
+        result['latency'] = statistics.median(rtts)
+
+        carried = 0
+        for name, payload in payloads.items():
+            result[name] = echo(proc, payload) / 1e6
+            carried += 2 * len(payload)
+
+        proc.stdin.close()
+        proc.stdout.read()
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        result['cpu'] = (usage.ru_utime + usage.ru_stime) / (carried / 1e6)
+    except (OSError, ValueError, TuneError) as error:
+        proc.kill()
+        proc.wait()
+        raise TuneError(proc.stderr.read().decode().strip() or str(error))
+    finally:
+        timer.cancel()
+    return result
+
+
+def read_exactly(stream, n):
+    data = b''
+    while len(data) < n:
+        chunk = stream.read(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def echo(proc, payload):
+    '''
+    Write payload to the remote cat while reading it back; returns the
+    bytes per second carried in each direction.
+    '''
+    start = time.perf_counter()
+    writer = threading.Thread(target=proc.stdin.write, args=(payload,))
+    writer.start()
+    received = 0
+    while received < len(payload):
+        chunk = proc.stdout.read(min(1 << 20, len(payload) - received))
+        if not chunk:
+            raise TuneError('connection closed during transfer')
+        received += len(chunk)
+    writer.join()
+    return len(payload) / (time.perf_counter() - start)
+
+
+##-------------------------------------------------------------------------
+## Try every setting
+##-------------------------------------------------------------------------
+def tune(server, account, base_options=(), ciphers=CIPHERS, size=4000000,
+         log=None):
+    '''
+    Run a trial for every cipher with compression on and off.  Returns a
+    list of (cipher, compression, result) for the trials that worked.
+    '''
+    payloads = {kind: make_payload(kind, size) for kind in PAYLOADS}
+    results = []
+    for cipher in ciphers:
+        for compression in [False, True]:
+            name = f"{cipher} compression={'yes' if compression else 'no'}"
+            try:
+                result = trial(server, account, cipher, compression, payloads,
+                               base_options)
+            except TuneError as error:
+                if log: log.warning(f"  {name}: {error}")
+                continue
+            if log: log.info(f"  {name}: {format_result(result)}")
+            results.append((cipher, compression, result))
+    return results
+
+
+def format_result(result):
+    return (f"vnc {result['vnc']:6.1f} MB/s, text {result['text']:6.1f} MB/s, "
+            f"latency {result['latency']*1000:5.1f} ms, "
+            f"cpu {result['cpu']*1000:5.1f} ms/MB")
+
+
+def choose_best(results, margin=0.05):
+    '''
+    Return (cipher, compression) of the fastest trial for the 'vnc'
+    payload, preferring lower CPU among those within margin of it.
+    '''
+    if len(results) == 0:
+        return None
+    fastest = max(r['vnc'] for c, z, r in results)
+    close = [(c, z, r) for c, z, r in results if r['vnc'] >= fastest * (1 - margin)]
+    cipher, compression, result = min(close, key=lambda x: x[2]['cpu'])
+    return cipher, compression
+
+
+##-------------------------------------------------------------------------
+## Save the chosen setting in the config file
+##-------------------------------------------------------------------------
+def save_tuning(filename, server, cipher, compression):
+    '''
+    Store {cipher, compression} for server under ssh_tuning in the config
+    file.  The file is edited as text so its comments survive: an existing
+    ssh_tuning line is replaced, otherwise one is added.
+    '''
+    with open(filename) as FO:
+        text = FO.read()
+    config = yaml.safe_load(text) or {}
+    tuning = dict(config.get('ssh_tuning') or {})
+    tuning[server] = {'cipher': cipher, 'compression': compression}
+    value = yaml.safe_dump(tuning, default_flow_style=True, width=1000).strip()
+
+    flow = text.lstrip().startswith('{')
+    line = f"  ssh_tuning: {value}," if flow else f"ssh_tuning: {value}"
+    pattern = re.compile(r'^[ \t]*ssh_tuning:.*$', re.MULTILINE)
+    if pattern.search(text):
+        text = pattern.sub(lambda m: line, text, count=1)
+    elif flow:
+        #a new first entry ends with a comma whatever follows it
+        brace = text.index('{') + 1
+        text = text[:brace] + '\n' + line + text[brace:]
+    else:
+        text = text.rstrip('\n') + '\n' + line + '\n'
+
+    if yaml.safe_load(text).get('ssh_tuning') != tuning:
+        raise TuneError(f'could not update ssh_tuning in {filename}')
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'w') as FO:
+        FO.write(text)
+    os.replace(tmp, filename)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Find the fastest ssh cipher and compression for a server.")
+    parser.add_argument("server", type=str, help="Server to tune (e.g. localhost).")
+    parser.add_argument("--account", type=str, dest="account", default=os.environ.get('USER', 'user'),
+                        help="Account to log in with (key login required).")
+    parser.add_argument("-i", type=str, dest="key", default=None, help="ssh private key.")
+    parser.add_argument("--size", type=float, dest="size", default=4.0, help="MB per payload.")
+    parser.add_argument("--cipher", type=str, dest="ciphers", action="append", default=None,
+                        help="Cipher to try. Default: " + ', '.join(CIPHERS))
+    parser.add_argument("--save", type=str, dest="config", default=None,
+                        help="Config file to save the best setting in.")
+    args = parser.parse_args()
+
+    import logging
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    log = logging.getLogger('sshtune')
+
+    base_options = ['-i', args.key] if args.key else []
+    log.info(f"Tuning ssh to {args.account}@{args.server}:")
+    results = tune(args.server, args.account, base_options,
+                   args.ciphers or CIPHERS, int(args.size * 1e6), log)
+    best = choose_best(results)
+    if best is None:
+        log.error("No trial connection succeeded")
+    else:
+        cipher, compression = best
+        log.info(f"Best: {cipher} compression={'yes' if compression else 'no'}")
+        if args.config:
+            save_tuning(args.config, args.server, cipher, compression)
+            log.info(f"Saved in {args.config}")
@@ -0,0 +1,451 @@
+'''
+Background supervisors for the processes the launcher starts.
+
+TunnelSupervisor watches the ssh process behind every tunnel in the
+launcher's ports_in_use.  When one dies it reopens the tunnel on the same
+local port, retrying with exponential backoff and jitter, and keeps per
+session counts of drops, reconnects and time spent down.
+
+ViewerSupervisor tracks the vncviewer of every session.  A viewer that
+exits with status 0 was closed by the user and is left closed; one that
+crashes is relaunched on the same server and port.  Crashes soon after a
+start (within min_uptime) back off exponentially, and after
+max_quick_restarts of them in a row the viewer is given up on.  restart()
+relaunches a running viewer on purpose (e.g. with a new profile) and
+close_viewer() closes one whose session moved, neither counted as a crash.
+'''
+import random
+import threading
+import time
+import traceback
+
+import localports
+
+
+class TunnelStats(object):
+    '''An object to contain the reconnect history of one session's tunnel.
+    '''
+    def __init__(self):
+        self.drops = 0
+        self.reconnects = 0
+        self.downtime = 0.0
+        self.down_since = None
+        self.next_attempt = 0.0
+        self.backoff = None
+
+    def __str__(self):
+        return (f"{self.drops} drops, {self.reconnects} reconnects, "
+                f"down {self.downtime:.0f}s")
+
+
+class TunnelSupervisor(object):
+
+    def __init__(self, launcher, interval=1.0, backoff_start=1.0, backoff_max=60.0,
+                 reconnect=True):
+        self.launcher = launcher
+        self.log = launcher.log
+        self.interval = interval
+        self.reconnect_enabled = reconnect
+        self.backoff_start = backoff_start
+        self.backoff_max = backoff_max
+        self.stats = {}
+        self.thread = None
+        self.stop_event = threading.Event()
+
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                self.log.error('Tunnel supervisor error, see log for details')
+                self.log.debug(traceback.format_exc())
+
+
+    def session_stats(self, session_name):
+        if session_name not in self.stats:
+            self.stats[session_name] = TunnelStats()
+        return self.stats[session_name]
+
+
+    ##-------------------------------------------------------------------------
+    ## One pass over all tunnels
+    ##-------------------------------------------------------------------------
+    def check(self):
+        '''
+        Find tunnels whose ssh process has exited and reopen them.  Tunnels
+        sharing a process (a batch process or the master connection) are
+        reopened together.
+        '''
+        with self.launcher.tunnel_lock:
+            tunnels = list(self.launcher.ports_in_use.values())
+
+        groups = {}
+        now = time.time()
+        for tunnel in tunnels:
+            if tunnel.proc is None or tunnel.is_alive():
+                continue
+            stats = self.session_stats(tunnel.session_name)
+            if stats.down_since is None:
+                stats.down_since = now
+                stats.drops += 1
+                stats.backoff = self.backoff_start
+                stats.next_attempt = now
+                self.log.warning(f"SSH tunnel for '{tunnel.session_name}' on "
+                                 f"port {tunnel.local_port} dropped (ssh exited "
+                                 f"with {tunnel.proc.returncode})",
+                                 extra={'session': tunnel.session_name,
+                                        'port': tunnel.local_port})
+            key = ('master', tunnel.server) if tunnel.mode == 'master' else id(tunnel.proc)
+            groups.setdefault(key, []).append(tunnel)
+
+        if not self.reconnect_enabled:
+            return
+        for group in groups.values():
+            stats = [self.session_stats(t.session_name) for t in group]
+            if now < min(s.next_attempt for s in stats):
+                continue
+            self.reconnect(group)
+
+
+    ##-------------------------------------------------------------------------
+    ## Reopen a group of tunnels on their local ports
+    ##-------------------------------------------------------------------------
+    def reconnect(self, group):
+
+        names = ', '.join(t.session_name for t in group)
+        if not self.launcher.can_reconnect(group[0]):
+            for tunnel in group:
+                self.session_stats(tunnel.session_name).next_attempt = float('inf')
+            self.log.warning(f"  Cannot reopen tunnel for {names} automatically "
+                             f"without the ssh key, close and reopen it from the menu")
+            return
+
+        self.log.info(f"Reopening SSH tunnel for {names}")
+        try:
+            self.launcher.restart_tunnels(group)
+        except Exception as error:
+            now = time.time()
+            for tunnel in group:
+                stats = self.session_stats(tunnel.session_name)
+                stats.backoff = min(stats.backoff * 2, self.backoff_max)
+                #jitter so several stations do not retry in lock step
+                stats.next_attempt = now + stats.backoff * random.uniform(0.5, 1.5)
+            self.log.warning(f"  Could not reopen tunnel for {names}: {error}; "
+                             f"retrying in about {stats.backoff:.0f}s")
+            self.log.debug(traceback.format_exc())
+            return
+
+        now = time.time()
+        for tunnel in group:
+            stats = self.session_stats(tunnel.session_name)
+            down = now - stats.down_since
+            stats.downtime += down
+            stats.down_since = None
+            stats.reconnects += 1
+            self.log.info(f"  SSH tunnel for '{tunnel.session_name}' on port "
+                          f"{tunnel.local_port} recovered after {down:.1f}s down",
+                          extra={'session': tunnel.session_name,
+                                 'port': tunnel.local_port, 'duration': down})
+
+
+    ##-------------------------------------------------------------------------
+    ## Summary of reconnects per session
+    ##-------------------------------------------------------------------------
+    def report(self):
+        lines = []
+        for name in sorted(self.stats.keys()):
+            stats = self.stats[name]
+            downtime = stats.downtime
+            if stats.down_since is not None:
+                downtime += time.time() - stats.down_since
+            lines.append(f"  {name:18s} {stats.drops:3d} drops "
+                         f"{stats.reconnects:3d} reconnects "
+                         f"{downtime:7.0f}s down")
+        return lines
+
+
+class ViewerRecord(object):
+    '''An object to contain the vncviewer of one session and its history.
+    '''
+    def __init__(self, session_name, vncserver, port, geometry=None):
+        self.session_name = session_name
+        self.vncserver = vncserver
+        self.port = port
+        self.geometry = geometry
+        self.proc = None
+        self.started = None
+        self.state = 'starting'
+        self.exits = []
+        self.restarts = 0
+        self.quick_exits = 0
+        self.next_attempt = 0.0
+
+    @property
+    def uptime(self):
+        if self.state != 'running' or self.started is None:
+            return 0.0
+        return time.time() - self.started
+
+
+class ViewerSupervisor(object):
+
+    def __init__(self, launcher, interval=2.0, restart_crashed=True, min_uptime=30.0,
+                 max_quick_restarts=5, backoff_start=2.0, backoff_max=60.0):
+        self.launcher = launcher
+        self.log = launcher.log
+        self.interval = interval
+        self.restart_crashed = restart_crashed
+        self.min_uptime = min_uptime
+        self.max_quick_restarts = max_quick_restarts
+        self.backoff_start = backoff_start
+        self.backoff_max = backoff_max
+        self.viewers = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                self.log.error('Viewer supervisor error, see log for details')
+                self.log.debug(traceback.format_exc())
+
+
+    ##-------------------------------------------------------------------------
+    ## Register a newly launched viewer
+    ##-------------------------------------------------------------------------
+    def track(self, session_name, proc, vncserver, port, geometry=None):
+        with self.lock:
+            record = self.viewers.get(session_name)
+            if record is None:
+                record = ViewerRecord(session_name, vncserver, port, geometry)
+                self.viewers[session_name] = record
+            record.vncserver = vncserver
+            record.port = port
+            record.geometry = geometry
+            record.proc = proc
+            record.started = time.time()
+            record.state = 'running'
+        return record
+
+
+    def is_running(self, session_name):
+        with self.lock:
+            record = self.viewers.get(session_name)
+            return record is not None and record.state == 'running' \
+                   and record.proc.poll() is None
+
+
+    ##-------------------------------------------------------------------------
+    ## Stop or restart a running viewer on purpose
+    ##-------------------------------------------------------------------------
+    def end(self, session_name, state):
+        '''
+        Terminate the running viewer of session_name, leaving its record in
+        state so check() does not count the exit as a crash.
+        '''
+        with self.lock:
+            record = self.viewers.get(session_name)
+            if record is None or record.state != 'running':
+                return None
+            record.state = state
+        record.proc.terminate()
+        try:
+            record.proc.wait(timeout=5)
+        except Exception:
+            record.proc.kill()
+        return record
+
+
+    def close_viewer(self, session_name):
+        '''Close the viewer of a session that moved or went away.'''
+        if self.end(session_name, 'closed') is None:
+            return False
+        self.log.info(f"Closed VNC viewer for '{session_name}'")
+        return True
+
+
+    def restart(self, session_name):
+        record = self.end(session_name, 'restarting')
+        if record is None:
+            return False
+        self.log.info(f"Restarting VNC viewer for '{session_name}'")
+        try:
+            self.launcher.launch_vncviewer(record.vncserver, record.port,
+                                           record.geometry, session_name=session_name)
+        except Exception as error:
+            #leave it to check() to relaunch
+            record.state = 'crashed'
+            self.log.error(f"  Could not restart VNC viewer for '{session_name}': {error}")
+            self.log.debug(traceback.format_exc())
+            return False
+        record.restarts += 1
+        return True
+
+
+    ##-------------------------------------------------------------------------
+    ## Drop finished launch threads and viewer processes from the launcher
+    ##-------------------------------------------------------------------------
+    def reap(self):
+        for thread in list(self.launcher.vnc_threads):
+            if not thread.is_alive():
+                self.launcher.vnc_threads.remove(thread)
+        for proc in list(self.launcher.vnc_processes):
+            if proc.poll() is not None:
+                self.launcher.vnc_processes.remove(proc)
+
+
+    ##-------------------------------------------------------------------------
+    ## One pass over all viewers
+    ##-------------------------------------------------------------------------
+    def check(self):
+        '''
+        Record viewers that have exited and relaunch crashed ones whose
+        retry time has come.  A viewer that exits with 0 was closed by the
+        user and is left closed.
+        '''
+        self.reap()
+        now = time.time()
+        relaunch = []
+        with self.lock:
+            for record in self.viewers.values():
+                if record.state == 'running' and record.proc.poll() is not None:
+                    self.exited(record, now)
+                if record.state == 'crashed' and self.restart_crashed \
+                        and now >= record.next_attempt:
+                    relaunch.append(record)
+
+        for record in relaunch:
+            self.relaunch(record)
+
+
+    def exited(self, record, now):
+        code = record.proc.returncode
+        uptime = now - record.started
+        record.exits.append((code, uptime))
+        if code == 0:
+            record.state = 'closed'
+            self.log.info(f"VNC viewer for '{record.session_name}' closed "
+                          f"after {uptime:.0f}s")
+            return
+
+        record.state = 'crashed'
+        self.log.warning(f"VNC viewer for '{record.session_name}' exited with "
+                         f"{code} after {uptime:.0f}s",
+                         extra={'session': record.session_name, 'port': record.port})
+        if not self.restart_crashed:
+            return
+        if uptime < self.min_uptime:
+            record.quick_exits += 1
+        else:
+            record.quick_exits = 0
+        if record.quick_exits > self.max_quick_restarts:
+            record.state = 'failed'
+            self.log.error(f"  VNC viewer for '{record.session_name}' keeps "
+                           f"exiting, not relaunching it again")
+            return
+        backoff = 0.0
+        if record.quick_exits > 0:
+            backoff = min(self.backoff_start * 2**(record.quick_exits - 1),
+                          self.backoff_max)
+        record.next_attempt = now + backoff
+
+
+    ##-------------------------------------------------------------------------
+    ## Relaunch a crashed viewer on its original port
+    ##-------------------------------------------------------------------------
+    def relaunch(self, record):
+
+        name = record.session_name
+        if record.vncserver == 'localhost':
+            #the tunnel was closed from the menu: leave the viewer closed too
+            # (the viewer may be on the session's relay port, not the tunnel's)
+            if self.launcher.find_tunnel(name) is None:
+                record.state = 'closed'
+                self.log.info(f"  Not relaunching VNC viewer for '{name}', "
+                              f"its tunnel is closed")
+                return
+            #tunnel is being reopened, try again on the next pass
+            if not localports.port_accepts(record.port):
+                return
+
+        self.log.info(f"Relaunching VNC viewer for '{name}' on "
+                      f"{record.vncserver}:{record.port}",
+                      extra={'session': name, 'port': record.port})
+        try:
+            self.launcher.launch_vncviewer(record.vncserver, record.port,
+                                           record.geometry, session_name=name)
+        except Exception as error:
+            record.next_attempt = time.time() + self.backoff_max
+            self.log.error(f"  Could not relaunch VNC viewer for '{name}': {error}")
+            self.log.debug(traceback.format_exc())
+            return
+        record.restarts += 1
+
+
+    ##-------------------------------------------------------------------------
+    ## Viewer status and summary
+    ##-------------------------------------------------------------------------
+    def status(self, session_name):
+        with self.lock:
+            record = self.viewers.get(session_name)
+            if record is None:
+                return ''
+            status = record.state
+            if record.state == 'running':
+                status += f' {format_duration(record.uptime)}'
+            if record.restarts > 0:
+                status += f', {record.restarts} restarts'
+            return status
+
+
+    def report(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.viewers.keys()):
+                record = self.viewers[name]
+                codes = ','.join(str(code) for code, uptime in record.exits) or '-'
+                lines.append(f"  {name:18s} {record.state:8s} "
+                             f"{record.restarts:3d} restarts  exit codes {codes}")
+        return lines
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return f"{seconds//60}m{seconds%60:02d}s"
+    return f"{seconds//3600}h{seconds%3600//60:02d}m"
@@ -0,0 +1,101 @@
+'''
+Run a set of startup steps as a dependency graph.
+
+Each task starts as soon as all of the tasks it depends on have finished, so
+independent steps (version check, port tool discovery, window geometry, ssh
+key validation...) run concurrently.  A task fails by raising; tasks that
+depend on a failed task are skipped.  Start and end times of every task are
+recorded for the startup timing report.
+'''
+import concurrent.futures
+import time
+
+
+class Task(object):
+    '''An object to contain one step of the graph.
+    '''
+    def __init__(self, name, func, deps=(), args=(), kwargs=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class TaskGraph(object):
+
+    def __init__(self, max_workers=6, log=None):
+        self.max_workers = max_workers
+        self.log = log
+        self.tasks = {}
+        self.results = {}
+        self.errors = {}
+        self.skipped = set()
+        self.t0 = None
+
+
+    def add(self, name, func, deps=(), args=(), kwargs=None):
+        for d in deps:
+            if d not in self.tasks:
+                raise ValueError(f"Task '{name}' depends on unknown task '{d}'")
+        self.tasks[name] = Task(name, func, deps, args, kwargs)
+
+
+    def _run_task(self, task):
+        task.start = time.perf_counter() - self.t0
+        if self.log: self.log.debug(f"Startup task '{task.name}' started")
+        try:
+            result = task.func(*task.args, **task.kwargs)
+        finally:
+            task.end = time.perf_counter() - self.t0
+            if self.log: self.log.debug(f"Startup task '{task.name}' finished "
+                                        f"in {task.duration:.2f}s")
+        return result
+
+
+    def run(self, t0=None):
+        '''
+        Run all tasks and return the dict of results.  t0 is the
+        perf_counter() value that task times are measured from (default now).
+        '''
+        self.t0 = time.perf_counter() if t0 is None else t0
+        pending = dict(self.tasks)
+        running = {}
+        finished = set()
+
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            while pending or running:
+                for name in list(pending.keys()):
+                    task = pending[name]
+                    if any(d in self.errors or d in self.skipped for d in task.deps):
+                        self.skipped.add(name)
+                        del pending[name]
+                        if self.log: self.log.debug(f"Startup task '{name}' skipped")
+                    elif all(d in finished for d in task.deps):
+                        running[pool.submit(self._run_task, task)] = name
+                        del pending[name]
+
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as error:
+                        self.errors[name] = error
+                        if self.log: self.log.debug(f"Startup task '{name}' "
+                                                    f"failed: {error}")
+                    finished.add(name)
+
+        return self.results
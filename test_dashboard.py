@@ -0,0 +1,86 @@
+import logging
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import dashboard
+import healthcheck
+import supervisor
+from lick_vnc_launcher import LickVncLauncher, SSHTunnel
+
+
+pytestmark = pytest.mark.skipif(dashboard.curses is None, reason='needs curses')
+
+
+class CommandLauncher(object):
+    '''Records the menu commands the dashboard runs.'''
+    def __init__(self):
+        self.log = logging.getLogger('KRO')
+        self.commands = []
+        self.done = threading.Event()
+
+    def run_command(self, cmd):
+        self.commands.append(cmd)
+        print(f'ran {cmd}')
+        self.done.set()
+        return cmd == 'q'
+
+
+def test_session_rows():
+    lvl = LickVncLauncher()
+    lvl.log = logging.getLogger('KRO')
+    proc = subprocess.Popen(['sleep', '30'])
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    try:
+        lvl.ports_in_use = {5902: SSHTunnel(5902, 'shimmy', 'user', 5902, 'Kastred', dead),
+                            5901: SSHTunnel(5901, 'shimmy', 'user', 5901, 'Kastblue', proc)}
+        lvl.tunnel_supervisor = supervisor.TunnelSupervisor(lvl)
+        lvl.tunnel_supervisor.session_stats('Kastblue').reconnects = 2
+        lvl.health_checker = healthcheck.HealthChecker(lvl)
+        health = lvl.health_checker.session_health('Kastblue')
+        health.state, health.latency = 'degraded', 1.5
+        lvl.viewer_supervisor = supervisor.ViewerSupervisor(lvl)
+        lvl.viewer_supervisor.track('Kastred', dead, 'localhost', 5902)
+
+        rows = dashboard.session_rows(lvl)
+        assert [r['name'] for r in rows] == ['Kastblue', 'Kastred']
+        assert rows[0]['tunnel'] == 'up (2x)' and rows[0]['rtt'] == 1.5
+        assert rows[0]['health'] == 'degraded' and rows[0]['rate_in'] is None
+        assert rows[1]['tunnel'] == 'DOWN' and rows[1]['viewer'] == 'exited'
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_keys_run_menu_commands():
+    launcher = CommandLauncher()
+    board = dashboard.Dashboard(launcher)
+    stdout = sys.stdout
+    sys.stdout = board.output
+    try:
+        board.handle_key(ord('t'))
+        assert launcher.done.wait(5)
+        deadline = time.time() + 5
+        while board.busy is not None and time.time() < deadline:
+            time.sleep(0.01)
+        launcher.done.clear()
+
+        #'c' asks for the port on the bottom line
+        for key in [ord('c'), ord('1'), ord('5'), ord('x'), 127, ord('9'), ord('0'), 10]:
+            board.handle_key(key)
+        assert launcher.done.wait(5)
+        board.handle_key(ord('c'))
+        board.handle_key(27)
+        assert board.prompt is None
+
+        board.handle_key(ord('Q'))
+    finally:
+        sys.stdout = stdout
+        board.executor.shutdown(wait=True)
+    assert launcher.commands == ['t', 'c 190', 'q']
+    assert board.quit
+    assert list(board.output.lines) == ['ran t', 'ran c 190', 'ran q']
@@ -0,0 +1,100 @@
+import sys
+import time
+
+import pytest
+
+import fakelick
+
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32',
+                                reason='fake ssh needs unix sockets')
+
+
+@pytest.fixture
+def lick():
+    with fakelick.FakeLick(handshake=0.02) as lick:
+        yield lick
+
+
+def test_parse_ssh_args():
+    options, server, command = fakelick.parse_ssh_args(
+        ['shimmy', '-l', 'user', '-T', '-oControlPath=/tmp/x', '-oControlMaster=no',
+         'echo', 'a;', 'whoami'])
+    assert server == 'shimmy'
+    assert options['l'] == 'user'
+    assert fakelick.control_path(options) == '/tmp/x'
+    assert command == 'echo a; whoami'
+
+    options, server, command = fakelick.parse_ssh_args(
+        ['-l', 'user', '-N', '-T', 'shimmy', '-L', '1:localhost:5901',
+         '-L', '2:localhost:9798', '-oExitOnForwardFailure=yes'])
+    assert options['L'] == ['1:localhost:5901', '2:localhost:9798']
+    assert 'N' in options['flags'] and command is None
+
+
+def test_end_to_end(lick):
+    run = lick.launch()
+    run.wait_for_output('MENU')
+    lick.wait_for_viewers(since=run.started)
+    assert len(lick.viewers_ready()) == 3
+    assert lick.stubs[fakelick.SOUND_PORT].connections >= 1
+
+    listing = run.send('t')
+    for name in ['Kastblue', 'Kastred', 'KastGuiderCamera', 'soundplay']:
+        assert name in listing
+    start = len(run.output)
+    run.send('u')
+    run.wait_for_output('kB gzip', start=start)
+    assert any(name.startswith('lick-remote-log') and name.endswith('.gz')
+               for name in lick.uploads())
+
+    run.quit()
+    assert 'EXITING APP' in run.output
+    time.sleep(0.2)
+    assert lick.ssh_processes() == []
+
+
+def test_reconnect_after_killed_tunnel(lick):
+    run = lick.launch(viewer_check_interval=0.5)
+    run.wait_for_output('MENU')
+    lick.wait_for_viewers(since=run.started)
+
+    port = sorted(lick.viewers_ready())[0]
+    killed = time.time()
+    assert lick.kill_tunnel(port) == 'master'
+    #the tunnel supervisor reopens the master and its forwards, the viewer
+    # supervisor relaunches the viewers that lost their connection
+    lick.wait_for_viewers(since=killed, timeout=30)
+    assert fakelick.port_state(port)
+    assert 'Reopening SSH tunnel' in run.output
+    run.quit()
+
+
+def test_separate_tunnels_without_master(lick):
+    run = lick.launch(tunnel_mode='separate', ssh_multiplex=False, nosound=True)
+    run.wait_for_output('MENU')
+    lick.wait_for_viewers(since=run.started)
+    processes = lick.ssh_processes()
+    assert [p['role'] for p in processes] == ['tunnel'] * 3
+    assert sorted(len(p['ports']) for p in processes) == [1, 1, 1]
+    run.quit()
+
+
+def test_refresh_reopens_moved_session(lick):
+    run = lick.launch()
+    run.wait_for_output('MENU')
+    lick.wait_for_viewers(since=run.started)
+    run.quit()
+
+    #the next start uses the cached list, the refresh finds display 1 moved
+    lick.move_desktop(1, 4)
+    run = lick.launch()
+    run.wait_for_output('moved to display 4')
+    run.wait_for_output('MENU')
+    #a viewer on a fourth local port: the new tunnel to display 4
+    deadline = time.time() + 30
+    while len(lick.viewers_ready()) < 4 and time.time() < deadline:
+        time.sleep(0.05)
+    assert len(lick.viewers_ready()) == 4
+    assert "Closed VNC viewer for 'Kastblue'" in run.output
+    run.quit()
@@ -0,0 +1,122 @@
+import logging
+import socket
+import subprocess
+import threading
+
+import pytest
+
+import healthcheck
+from lick_vnc_launcher import SSHTunnel
+
+
+def serve(reply, close=True):
+    '''Accept connections on a free port, send reply and optionally close.'''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    conns = []
+
+    def accept():
+        while True:
+            try:
+                conn, addr = server.accept()
+            except OSError:
+                return
+            if reply:
+                conn.sendall(reply)
+            if close:
+                conn.close()
+            else:
+                conns.append(conn)
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server, server.getsockname()[1]
+
+
+def test_rfb_banner():
+    server, port = serve(b'RFB 003.008\n', close=False)
+    version, latency = healthcheck.rfb_banner(port)
+    assert version == '3.8'
+    assert latency >= 0
+    server.close()
+
+
+@pytest.mark.parametrize('reply', [b'SSH-2.0-OpenSSH\r\n', b'', b'RFB 003'])
+def test_rfb_banner_bad(reply):
+    server, port = serve(reply)
+    with pytest.raises(healthcheck.HealthError):
+        healthcheck.rfb_banner(port, timeout=1)
+    server.close()
+
+
+def test_stream_alive():
+    server, port = serve(b'', close=False)
+    assert healthcheck.stream_alive(port, hold=0.1) >= 0
+    server.close()
+    server, port = serve(b'', close=True)
+    with pytest.raises(healthcheck.HealthError):
+        healthcheck.stream_alive(port, hold=1)
+    server.close()
+
+
+class FakeLauncher(object):
+    def __init__(self):
+        self.log = logging.getLogger('KRO')
+        self.tunnel_lock = threading.Lock()
+        self.ports_in_use = {}
+        self.rebuilt = []
+        self.sound = None
+
+    def can_reconnect(self, tunnel):
+        return True
+
+    def rebuild_tunnel(self, tunnel):
+        self.rebuilt.append(tunnel.local_port)
+
+
+def test_checker_marks_dead_and_rebuilds(monkeypatch):
+    launcher = FakeLauncher()
+    good, good_port = serve(b'RFB 003.008\n', close=False)
+    bad, bad_port = serve(b'')
+    for port, name in [(good_port, 'Kastblue'), (bad_port, 'Kastred')]:
+        tunnel = SSHTunnel(port, 'shimmy', 'user', 5901, session_name=name)
+        tunnel.ready = True
+        launcher.ports_in_use[port] = tunnel
+    monkeypatch.setattr(SSHTunnel, 'is_alive', lambda self: True)
+
+    checker = healthcheck.HealthChecker(launcher, timeout=1, max_failures=2)
+    checker.check()
+    assert checker.health['Kastblue'].state == 'ok'
+    assert checker.health['Kastred'].state == 'degraded'
+    assert launcher.rebuilt == []
+    checker.check()
+    assert checker.health['Kastred'].state == 'dead'
+    assert launcher.rebuilt == [bad_port]
+    assert len(checker.health['Kastblue'].samples) == 2
+    good.close()
+    bad.close()
+
+
+def test_soundplay_checked_only_while_running(monkeypatch):
+    launcher = FakeLauncher()
+    server, port = serve(b'', close=False)
+    tunnel = SSHTunnel(port, 'shimmy', 'user', 9798, session_name='soundplay')
+    tunnel.ready = True
+    launcher.ports_in_use[port] = tunnel
+    monkeypatch.setattr(SSHTunnel, 'is_alive', lambda self: True)
+
+    checker = healthcheck.HealthChecker(launcher, timeout=1)
+    checker.check()
+    assert 'soundplay' not in checker.health
+
+    class Sound(object):
+        proc = subprocess.Popen(['sleep', '30'])
+    launcher.sound = Sound()
+    checker.check()
+    assert checker.health['soundplay'].checks == 1
+
+    Sound.proc.kill()
+    Sound.proc.wait()
+    checker.check()
+    assert checker.health['soundplay'].checks == 1
+    server.close()
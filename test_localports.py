@@ -0,0 +1,93 @@
+import socket
+import threading
+
+import pytest
+
+import localports
+
+
+@pytest.fixture
+def listener():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_native_backend():
+    assert localports.native_backend() in ['proc', 'socket']
+
+
+@pytest.mark.parametrize("backend", ['proc', 'socket'])
+def test_port_in_use(backend, listener):
+    if backend == 'proc' and localports.native_backend() != 'proc':
+        pytest.skip('/proc/net/tcp not available')
+    assert localports.port_in_use(listener, backend) is True
+    assert localports.port_in_use(free_port(), backend) is False
+
+
+def test_benchmark(listener):
+    results = localports.benchmark(['socket'], [listener, free_port()])
+    per_probe, found = results['socket']
+    assert found == 1
+    assert per_probe > 0
+
+
+def test_allocator_skips_busy_and_reserved(listener):
+    allocator = localports.PortAllocator(lambda ports: {listener},
+                                         start=listener, count=10)
+    first = allocator.reserve(3)
+    assert listener not in first
+    assert len(first) == 3
+    second = allocator.reserve(3)
+    assert set(first).isdisjoint(second)
+    allocator.release(first[0])
+    assert allocator.reserve(1) == [first[0]]
+
+
+def test_allocator_parallel_reserve():
+    calls = []
+    def in_use(ports):
+        calls.append(ports)
+        return set()
+    allocator = localports.PortAllocator(in_use, start=20000, count=100)
+
+    batch = allocator.reserve(7)
+    assert len(batch) == 7
+    assert len(calls) == 1
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.extend(allocator.reserve(2)))
+               for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 20
+    assert len(set(results + batch)) == 27
+
+
+def test_wait_for_port_ready(listener):
+    assert localports.port_accepts(listener) is True
+    assert localports.wait_for_port(listener, timeout=1) < 0.5
+
+
+def test_wait_for_port_aborts_on_check():
+    def check():
+        raise RuntimeError('ssh exited')
+    with pytest.raises(RuntimeError):
+        localports.wait_for_port(free_port(), timeout=5, check=check)
+
+
+def test_wait_for_port_timeout():
+    with pytest.raises(TimeoutError):
+        localports.wait_for_port(free_port(), timeout=0.1)
@@ -0,0 +1,88 @@
+import gzip
+import random
+
+import loganalytics
+
+
+RUN = '''{t0} UT - DEBUG: 
+***** PROGRAM STARTED *****
+Command: lick_vnc_launcher.py {account}
+{t0} UT - INFO: Opening SSH tunnel for user@shimmy.ucolick.org:5901 on local port 5901.
+{t0} UT - DEBUG: ssh command: {ms}ms
+{t0} UT - DEBUG: Startup task 'ssh key' finished in {key}s
+{t1} UT - INFO: Opening VNCviewer for 'Kastblue'
+{t1} UT - INFO: Startup timing:
+  Step         |   Start | Duration
+  ssh key      |   0.01s |    {key}s (failed)
+  All viewers up after {up}s
+{t1} UT - WARNING: SSH tunnel for 'Kastblue' on port 5901 dropped (ssh exited with 255)
+{t1} UT - INFO:   SSH tunnel for 'Kastblue' on port 5901 recovered after 2.5s down
+{t1} UT - INFO: EXITING APP
+'''
+
+
+def test_histogram_percentiles():
+    histogram = loganalytics.Histogram()
+    values = [random.uniform(0.01, 10) for i in range(10000)]
+    for value in values:
+        histogram.add(value)
+    values.sort()
+    for p in [50, 90, 99]:
+        exact = values[int(p / 100 * len(values)) - 1]
+        assert abs(histogram.percentile(p) - exact) / exact < 0.03
+    assert histogram.max == values[-1]
+    assert len(histogram.buckets) < 400
+
+
+def test_runs_and_percentiles_across_files(tmp_path):
+    #night one was rotated and uploaded (gzip), night two is a plain file
+    (tmp_path / 'lick-remote-log-utc-20261016.txt.1').write_text(
+        RUN.format(t0='2026-10-16 04:00:00,000', t1='2026-10-16 04:00:03,000',
+                   account='shane', ms=100, key=1.0, up=3.0))
+    with gzip.open(tmp_path / 'lick-remote-log-utc-20261016.txt.gz', 'wt') as FO:
+        FO.write(RUN.format(t0='2026-10-16 05:00:00,000', t1='2026-10-16 05:00:05,000',
+                            account='shane', ms=300, key=2.0, up=5.0))
+    (tmp_path / 'lick-remote-log-utc-20261017.txt').write_text(
+        RUN.format(t0='2026-10-17 04:00:00,000', t1='2026-10-17 04:00:02,000',
+                   account='nickel', ms=50, key=0.5, up=2.0))
+
+    filenames = loganalytics.log_files([str(tmp_path)])
+    assert [f.rsplit('/', 1)[1] for f in filenames] == [
+        'lick-remote-log-utc-20261016.txt.1', 'lick-remote-log-utc-20261016.txt.gz',
+        'lick-remote-log-utc-20261017.txt']
+
+    runs = []
+    analyzer = loganalytics.LogAnalyzer(on_run=runs.append)
+    analyzer.read(filenames)
+    assert [run.telescope for run in runs] == ['shane', 'shane', 'nickel']
+    summary = runs[0].summary()
+    assert summary['startup'] == 3.0 and summary['duration'] == 3.0
+    assert summary['tunnel_opens'] == 1 and summary['reconnects'] == 1
+    assert summary['failures'] == 1 and summary['viewer_starts'] == 1
+    kinds = [kind for when, kind, detail in runs[0].events]
+    assert kinds == ['start', 'tunnel open', 'viewer start', 'startup done',
+                     'failure', 'tunnel drop', 'reconnect', 'exit']
+
+    rows = {(r['group'], r['metric']): r for r in analyzer.rows()}
+    up = rows[('shane', 'startup: viewers up')]
+    assert up['count'] == 2 and up['max'] == 5.0
+    assert abs(up['p50'] - 3.0) < 0.06
+    assert rows[('shane', 'ssh command')]['max'] == 0.3
+    assert rows[('nickel', 'startup: ssh key')]['count'] == 1
+    assert rows[('shane', 'tunnel downtime')]['count'] == 2
+
+
+def test_json_lines(tmp_path):
+    logfile = tmp_path / 'lick-remote-log-utc-20261017.jsonl'
+    logfile.write_text(
+        '{"time": "2026-10-17T04:00:00.000Z", "level": "DEBUG", "message": '
+        '"JSON log: x.jsonl\\nCommand: lick_vnc_launcher.py apf"}\n'
+        '{"time": "2026-10-17T04:00:00.250Z", "level": "DEBUG", "message": '
+        '"ssh key: 250.0ms", "phase": "ssh key", "duration": 0.25}\n'
+        'not json\n')
+    analyzer = loganalytics.LogAnalyzer(by='night')
+    analyzer.read([str(logfile)])
+    assert analyzer.runs == 1
+    row = analyzer.rows()[0]
+    assert (row['group'], row['metric'], row['count']) == ('2026-10-16', 'ssh key', 1)
+    assert row['max'] == 0.25
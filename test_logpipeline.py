@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+import time
+
+import logpipeline
+
+
+def make_pipeline(tmp_path, name):
+    log = logging.getLogger(name)
+    log.setLevel(logging.DEBUG)
+    pipeline = logpipeline.LogPipeline(log, directory=str(tmp_path),
+                                       prefix='test-log', max_bytes=2000, backups=2)
+    pipeline.start()
+    return log, pipeline
+
+
+def test_text_and_json_lines(tmp_path):
+    log, pipeline = make_pipeline(tmp_path, 'test_logpipeline.json')
+    pipeline.configure(json_lines=True)
+    log.info('Opening SSH tunnel', extra={'session': 'Kastred', 'port': 5901})
+    log.debug('ssh key: 12.5ms', extra={'phase': 'ssh key', 'duration': 0.0125})
+    pipeline.stop()
+
+    date = logpipeline.utc_date()
+    text = (tmp_path / f'test-log-{date}.txt').read_text()
+    assert 'UT - INFO: Opening SSH tunnel' in text
+    assert pipeline.filename == str(tmp_path / f'test-log-{date}.txt')
+
+    lines = (tmp_path / f'test-log-{date}.jsonl').read_text().splitlines()
+    entries = [json.loads(line) for line in lines]
+    assert entries[0]['session'] == 'Kastred' and entries[0]['port'] == 5901
+    assert entries[0]['level'] == 'INFO' and 'phase' not in entries[0]
+    assert entries[1]['phase'] == 'ssh key' and entries[1]['duration'] == 0.0125
+
+
+def test_size_rotation_keeps_backups(tmp_path):
+    log, pipeline = make_pipeline(tmp_path, 'test_logpipeline.size')
+    for i in range(200):
+        log.debug(f'line {i} ' + 'x' * 40)
+    pipeline.stop()
+
+    names = sorted(os.listdir(tmp_path))
+    date = logpipeline.utc_date()
+    assert names == [f'test-log-{date}.txt', f'test-log-{date}.txt.1',
+                     f'test-log-{date}.txt.2']
+    assert all(os.path.getsize(tmp_path / name) <= 2000 for name in names)
+    assert 'line 199 ' in (tmp_path / f'test-log-{date}.txt').read_text()
+
+
+def test_new_file_at_midnight(tmp_path):
+    log, pipeline = make_pipeline(tmp_path, 'test_logpipeline.midnight')
+    #pretend the file was opened yesterday
+    pipeline.text_handler.date = '20000101'
+    log.info('after midnight')
+    pipeline.stop()
+    text = (tmp_path / f'test-log-{logpipeline.utc_date()}.txt').read_text()
+    assert 'after midnight' in text
+
+
+def test_full_queue_drops_instead_of_blocking(tmp_path):
+    log = logging.getLogger('test_logpipeline.full')
+    log.setLevel(logging.DEBUG)
+    log.propagate = False
+    pipeline = logpipeline.LogPipeline(log, directory=str(tmp_path),
+                                       prefix='test-log', queue_size=5)
+    #writer thread not started: the queue fills up
+    log.addHandler(pipeline.handler)
+    start = time.perf_counter()
+    for i in range(50):
+        log.debug(f'line {i}')
+    assert time.perf_counter() - start < 1
+    assert pipeline.handler.dropped == 45
+    log.removeHandler(pipeline.handler)
+    pipeline.text_handler.close()
@@ -0,0 +1,90 @@
+import gzip
+import os
+
+import pytest
+
+import logupload
+import sshtransport
+
+
+class LocalTransport(object):
+    '''Appends to files in a directory instead of on a server.'''
+    def __init__(self, directory):
+        self.directory = directory
+        self.fail = False
+        self.chunks = 0
+
+    def append(self, data, destination, timeout=10):
+        if self.fail:
+            raise sshtransport.TransportTimeout('upload timed out')
+        with open(os.path.join(self.directory, destination), 'ab') as FO:
+            for chunk in sshtransport.chunks(data):
+                FO.write(chunk)
+                self.chunks += 1
+
+
+@pytest.fixture
+def setup(tmp_path):
+    (tmp_path / 'remote').mkdir()
+    logfile = tmp_path / 'log.txt'
+    uploader = logupload.LogUploader(statefile=str(tmp_path / 'state.json'))
+    return logfile, uploader, LocalTransport(str(tmp_path / 'remote'))
+
+
+def remote_text(tmp_path):
+    return gzip.decompress((tmp_path / 'remote' / 'log.txt.gz').read_bytes()).decode()
+
+
+def test_sends_only_new_lines(tmp_path, setup):
+    logfile, uploader, transport = setup
+    logfile.write_text('first line\n' * 100)
+    result = uploader.upload(str(logfile), transport)
+    assert result.raw == 1100 and result.compressed < result.raw
+    assert 'gzip' in str(result)
+
+    with open(logfile, 'a') as FO:
+        FO.write('second line\n')
+    result = uploader.upload(str(logfile), transport)
+    assert result.raw == len('second line\n')
+    assert remote_text(tmp_path) == 'first line\n' * 100 + 'second line\n'
+
+    result = uploader.upload(str(logfile), transport)
+    assert result.raw == 0 and 'nothing new' in str(result)
+
+
+def test_failed_upload_is_resent(tmp_path, setup):
+    logfile, uploader, transport = setup
+    logfile.write_text('a\n')
+    uploader.upload(str(logfile), transport)
+    with open(logfile, 'a') as FO:
+        FO.write('b\n')
+    transport.fail = True
+    with pytest.raises(sshtransport.TransportTimeout):
+        uploader.upload(str(logfile), transport)
+    transport.fail = False
+    uploader.upload(str(logfile), transport)
+    assert remote_text(tmp_path) == 'a\nb\n'
+
+
+def test_rest_of_rotated_log_is_sent(tmp_path, setup):
+    logfile, uploader, transport = setup
+    logfile.write_text('old 1\n')
+    uploader.upload(str(logfile), transport)
+    with open(logfile, 'a') as FO:
+        FO.write('old 2\n')
+    os.rename(logfile, f'{logfile}.1')
+    logfile.write_text('new 1\n')
+    uploader.upload(str(logfile), transport)
+    assert remote_text(tmp_path) == 'old 1\nold 2\nnew 1\n'
+
+
+def test_large_log_is_streamed_in_chunks(tmp_path, setup):
+    logfile, uploader, transport = setup
+    lines = ''.join(f'line {i} {os.urandom(20).hex()}\n' for i in range(5000))
+    logfile.write_text(lines)
+    uploader.chunk_size = 16 * 1024
+    result = uploader.upload(str(logfile), transport)
+    assert result.raw == len(lines)
+    assert transport.chunks > 1
+    assert result.compressed == (tmp_path / 'remote' / 'log.txt.gz').stat().st_size
+    assert remote_text(tmp_path) == lines
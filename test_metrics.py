@@ -0,0 +1,84 @@
+import logging
+import subprocess
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import healthcheck
+import metrics
+import supervisor
+import taskgraph
+from lick_vnc_launcher import LickVncLauncher, SSHTunnel
+
+
+@pytest.fixture
+def lvl():
+    lvl = LickVncLauncher()
+    lvl.log = logging.getLogger('KRO')
+    lvl.config = {}
+    lvl.start_time = time.perf_counter()
+    lvl.tel, lvl.instrument, lvl.vncserver = 'shane', 'kast', 'shimmy.ucolick.org'
+    procs = [subprocess.Popen(['sleep', '30']), subprocess.Popen(['true'])]
+    procs[1].wait()
+    lvl.ports_in_use = {5901: SSHTunnel(5901, 'shimmy', 'user', 5901, 'Kastblue',
+                                        procs[0], mode='master'),
+                        5902: SSHTunnel(5902, 'shimmy', 'user', 5902, 'Kastred',
+                                        procs[1], mode='master')}
+    lvl.vnc_processes = [procs[0]]
+    yield lvl
+    procs[0].kill()
+    procs[0].wait()
+
+
+def test_collect(lvl):
+    lvl.tunnel_supervisor = supervisor.TunnelSupervisor(lvl)
+    stats = lvl.tunnel_supervisor.session_stats('Kastred')
+    stats.drops, stats.reconnects, stats.downtime = 2, 1, 3.5
+    lvl.health_checker = healthcheck.HealthChecker(lvl)
+    health = lvl.health_checker.session_health('Kastblue')
+    health.state, health.latency, health.checks = 'ok', 0.012, 4
+    lvl.viewer_supervisor = supervisor.ViewerSupervisor(lvl)
+    lvl.viewer_supervisor.track('Kastblue', lvl.vnc_processes[0], 'localhost', 5901)
+    graph = taskgraph.TaskGraph()
+    graph.add('ssh key', lambda: None)
+    graph.add('viewers', lambda: None, deps=['ssh key'])
+    graph.run(t0=lvl.start_time)
+    lvl.startup_graph = graph
+
+    text = metrics.collect(lvl, version='0.92')
+    lines = text.splitlines()
+    assert 'lick_launcher_info{version="0.92",telescope="shane",instrument="kast",' \
+           'server="shimmy.ucolick.org"} 1' in lines
+    assert 'lick_tunnel_up{port="5901",session="Kastblue",mode="master"} 1' in lines
+    assert 'lick_tunnel_up{port="5902",session="Kastred",mode="master"} 0' in lines
+    assert 'lick_tunnel_reconnects_total{session="Kastred"} 1' in lines
+    assert 'lick_tunnel_downtime_seconds_total{session="Kastred"} 3.5' in lines
+    assert 'lick_probe_latency_seconds{session="Kastblue"} 0.012' in lines
+    assert 'lick_session_health{session="Kastblue",state="ok"} 1' in lines
+    assert 'lick_viewer_running{session="Kastblue",port="5901"} 1' in lines
+    assert 'lick_viewer_processes 1' in lines
+    assert any(l.startswith('lick_startup_phase_seconds{phase="ssh key",failed="false"}')
+               for l in lines)
+    assert any(l.startswith('lick_startup_viewers_up_seconds ') for l in lines)
+    assert lines.count('# TYPE lick_tunnel_up gauge') == 1
+    #the samples of each metric are together
+    names = [l.split('{')[0].split(' ')[0] for l in lines if not l.startswith('#')]
+    for name in set(names):
+        first = names.index(name)
+        assert names[first:first + names.count(name)] == [name] * names.count(name)
+
+
+def test_server(lvl):
+    server = metrics.MetricsServer(lvl, 0)
+    server.start()
+    try:
+        url = f'http://127.0.0.1:{server.port}'
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert b'lick_tunnel_up{port="5901"' in response.read()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/other', timeout=5)
+    finally:
+        server.stop()
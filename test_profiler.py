@@ -0,0 +1,81 @@
+import json
+import subprocess
+import threading
+
+import pytest
+
+import profiler
+
+
+class Launcher(object):
+
+    def __init__(self):
+        self.profiler = profiler.Profiler()
+
+    @profiler.profiled('ssh command', detail=lambda cmd: cmd)
+    def do_ssh_cmd(self, cmd):
+        subprocess.run(['true'])
+        if cmd == 'fail':
+            self.profiler.fail('exit status 1')
+        if cmd == 'raise':
+            raise RuntimeError('no route')
+        return cmd
+
+
+def test_spans_count_subprocesses_and_failures():
+    launcher = Launcher()
+    launcher.do_ssh_cmd('whoami')
+    launcher.do_ssh_cmd('fail')
+    with pytest.raises(RuntimeError):
+        launcher.do_ssh_cmd('raise')
+
+    spans = list(launcher.profiler.spans)
+    assert [s.detail for s in spans] == ['whoami', 'fail', 'raise']
+    assert [s.subprocesses for s in spans] == [1, 1, 1]
+    assert spans[0].error is None
+    assert spans[1].error == 'exit status 1'
+    assert spans[2].error == 'RuntimeError: no route'
+
+    lines = launcher.profiler.summary()
+    assert 'Phase' in lines[0]
+    assert lines[1].split('|')[1].strip() == '3'
+    assert lines[1].split('|')[4].strip() == '3'
+    assert 'exit status 1' in lines[1]
+
+
+def test_nested_spans_on_threads():
+    launcher = Launcher()
+
+    @profiler.profiled('tunnels')
+    def tunnels(self):
+        threads = [threading.Thread(target=self.do_ssh_cmd, args=(str(i),))
+                   for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.do_ssh_cmd('main')
+
+    tunnels(launcher)
+    spans = {s.detail or s.name: s for s in launcher.profiler.spans}
+    #only the call on the same thread counts toward the outer span
+    assert spans['tunnels'].subprocesses == 1
+    assert spans['tunnels'].duration >= spans['main'].duration
+    assert len(set(s.thread.name for s in launcher.profiler.spans)) == 4
+
+
+def test_chrome_trace(tmp_path):
+    launcher = Launcher()
+    launcher.do_ssh_cmd('hostname')
+    filename = tmp_path / 'trace.json'
+    launcher.profiler.write_trace(str(filename))
+
+    trace = json.loads(filename.read_text())
+    complete = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+    assert len(complete) == 1
+    event = complete[0]
+    assert event['name'] == 'ssh command'
+    assert event['ts'] >= 0 and event['dur'] > 0
+    assert event['args'] == {'subprocesses': 1, 'detail': 'hostname'}
+    assert any(e['ph'] == 'M' and e['name'] == 'thread_name'
+               for e in trace['traceEvents'])
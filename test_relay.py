@@ -0,0 +1,123 @@
+import logging
+import socket
+import threading
+import time
+
+import pytest
+
+import relay
+
+
+def echo_server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    def echo(conn):
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    def accept():
+        while True:
+            try:
+                conn, addr = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server, server.getsockname()[1]
+
+
+def wait_for(condition, timeout=2):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.mark.parametrize('engine', ['buffered', 'splice'])
+def test_relay_counts_bytes(engine):
+    if engine == 'splice' and relay.best_engine() != 'splice':
+        pytest.skip('os.splice not available')
+    server, port = echo_server()
+    manager = relay.RelayManager(logging.getLogger('KRO'), log_interval=0,
+                                 engine=engine)
+    relay_port = manager.start_relay('Kastblue', port)
+    assert manager.start_relay('Kastblue', port) == relay_port
+
+    payload = b'x' * 1000000
+    sock = socket.create_connection(('127.0.0.1', relay_port))
+    sender = threading.Thread(target=sock.sendall, args=(payload,))
+    sender.start()
+    received = 0
+    while received < len(payload):
+        received += len(sock.recv(65536))
+    sender.join()
+    sock.close()
+
+    stats = manager.relays['Kastblue'].stats
+    assert wait_for(lambda: stats.active == 0)
+    assert stats.connections == 1
+    assert stats.bytes_in == len(payload)
+    assert stats.bytes_out == len(payload)
+    assert 'relay :' in manager.status('Kastblue')
+
+    assert stats.chunks > 0
+
+    manager.stop_relay('Kastblue')
+    assert manager.status('Kastblue') == ''
+    manager.stop()
+    server.close()
+
+
+def test_rate_and_format():
+    stats = relay.RelayStats()
+    stats.sample(100.0)
+    stats.add('in', 5000, 0.0)
+    stats.add('out', 1000, 0.0)
+    assert stats.rate(now=110.0) == (500.0, 100.0)
+    assert stats.rate(now=200.0) == (0.0, 0.0)
+    assert relay.format_bytes(999) == '999 B'
+    assert relay.format_bytes(1500000) == '1.5 MB'
+
+
+def test_stalled_upstream_does_not_block_relay():
+    #a listener that never accepts: once its backlog is full, further
+    # connects hang like those to a dead tunnel endpoint
+    stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled.bind(('127.0.0.1', 0))
+    stalled.listen(0)
+    backlog = []
+    for i in range(8):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(stalled.getsockname())
+        backlog.append(sock)
+    time.sleep(0.1)
+
+    server, port = echo_server()
+    r = relay.Relay('Kastblue', stalled.getsockname()[1], log=logging.getLogger('KRO'))
+    relay_port = r.start()
+    waiting = socket.create_connection(('127.0.0.1', relay_port))
+    assert wait_for(lambda: len(r.pending) == 1)
+
+    #a second connection is relayed while the first is still connecting
+    r.target_port = port
+    start = time.perf_counter()
+    sock = socket.create_connection(('127.0.0.1', relay_port), timeout=1)
+    sock.sendall(b'ping')
+    assert sock.recv(4) == b'ping'
+    assert time.perf_counter() - start < 0.5
+    assert r.stats.connections == 1
+
+    #the stalled connect is given up after the timeout
+    assert wait_for(lambda: len(r.pending) == 0, timeout=relay.CONNECT_TIMEOUT + 2)
+    assert waiting.recv(1) == b''
+    for s in [sock, waiting, stalled, server] + backlog:
+        s.close()
+    r.stop()
@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import socket
+import time
+
+import pytest
+
+from lick_vnc_launcher import (LickVncLauncher, SSHTunnel, VNCSession, diff_sessions,
+                               parse_remote_probe)
+
+
+@pytest.fixture
+def lvl(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lvl = LickVncLauncher()
+    lvl.log = logging.getLogger('KRO')
+    lvl.config = {}
+    return lvl
+
+
+def sessions(*displays):
+    return [VNCSession(display=str(d), desktop=f'kast{d} Kast {d}', user='user')
+            for d in displays]
+
+
+def test_cache_round_trip(lvl):
+    assert lvl.load_session_cache('shimmy.ucolick.org', 'kast') is None
+    lvl.save_session_cache('shimmy.ucolick.org', 'kast', sessions(1, 2))
+    cached = lvl.load_session_cache('shimmy.ucolick.org', 'kast')
+    assert [(s.name, s.display) for s in cached] == [('Kast1', '1'), ('Kast2', '2')]
+    assert lvl.load_session_cache('noir.ucolick.org', 'nickel') is None
+
+
+def test_cache_expires(lvl):
+    lvl.save_session_cache('shimmy.ucolick.org', 'kast', sessions(1))
+    cachefile = lvl.session_cache_file('shimmy.ucolick.org', 'kast')
+    cache = json.loads(cachefile.read_text())
+    cache['time'] = time.time() - 100
+    cachefile.write_text(json.dumps(cache))
+    lvl.config['session_cache_ttl'] = 50
+    assert lvl.load_session_cache('shimmy.ucolick.org', 'kast') is None
+    lvl.config['session_cache_ttl'] = 0
+    assert lvl.load_session_cache('shimmy.ucolick.org', 'kast') is None
+
+
+def test_diff_sessions():
+    old = sessions(1, 2, 3)
+    new = sessions(1, 2, 4)
+    new[1].display = '7'
+    added, removed, changed = diff_sessions(old, new)
+    assert [s.name for s in added] == ['Kast4']
+    assert [s.name for s in removed] == ['Kast3']
+    assert [(s.name, s.display) for s in changed] == [('Kast2', '7')]
+
+
+def test_parse_remote_probe():
+    marker = '==KRO:'
+    data = '\n'.join([f'{marker}whoami', 'user',
+                      f'{marker}hostname', 'shimmy',
+                      f'{marker}vncstatus', '#display - desktop',
+                      '1 - kast1 Kast blue', '2 - kast2 Kast red',
+                      f'{marker}soundplay',
+                      'tcp   0   0 0.0.0.0:9798   0.0.0.0:*   LISTEN'])
+    probe = parse_remote_probe(data, marker)
+    assert probe['whoami'] == 'user'
+    assert probe['hostname'] == 'shimmy'
+    assert probe['soundplay'] is True
+    assert probe['vncstatus'].split('\n')[1] == '1 - kast1 Kast blue'
+
+
+def test_parse_remote_probe_partial():
+    marker = '==KRO:'
+    probe = parse_remote_probe(f'{marker}whoami\nuser\n{marker}soundplay\n', marker)
+    assert probe['whoami'] == 'user'
+    assert probe['hostname'] is None
+    assert probe['vncstatus'] is None
+    assert probe['soundplay'] is False
+
+
+def test_sessions_from_probe(lvl):
+    lvl.remote_probe = {'server': 'shimmy', 'instrument': 'kast',
+                        'vncstatus': '#display - desktop\n1 - kast1 Kast blue',
+                        'whoami': 'user', 'hostname': 'shimmy', 'soundplay': True}
+    found = lvl.get_vnc_sessions('shimmy', 'kast', 'user', 'shane')
+    assert [s.name for s in found] == ['Kastblue']
+    assert lvl.take_probe_vncstatus('shimmy', 'kast') is None
+
+
+def test_probe_remote_without_soundplay(lvl, tmp_path, monkeypatch, caplog):
+    #an "ssh" that runs the probe locally, and a netstat where only a port
+    # containing 9798 listens (soundplay itself is down)
+    tools = tmp_path / 'bin'
+    tools.mkdir()
+    (tools / 'ssh').write_text('#!/bin/sh\nfor last; do true; done\nexec sh -c "$last"\n')
+    (tools / 'netstat').write_text('#!/bin/sh\n'
+                                 'echo "tcp 0 0 0.0.0.0:19798 0.0.0.0:* LISTEN"\n'
+                                 'echo "tcp 0 0 127.0.0.1:5901 0.0.0.0:* LISTEN"\n')
+    for name in ['ssh', 'netstat']:
+        (tools / name).chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tools}{os.pathsep}{os.environ['PATH']}")
+    failures = []
+    monkeypatch.setattr(lvl, 'profile_failure', failures.append)
+
+    with caplog.at_level(logging.DEBUG, logger='KRO'):
+        probe = lvl.probe_remote('shimmy', 'user')
+    assert probe['soundplay'] is False
+    assert probe['hostname']
+    assert failures == []
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+
+
+def test_ssh_forward_command(lvl):
+    tunnels = [SSHTunnel(15901 + i, 'shimmy', 'user', 5901 + i) for i in range(2)]
+    single = lvl.ssh_forward_command('shimmy', 'user', tunnels[:1])
+    assert single[:6] == ['ssh', '-l', 'user', '-N', '-T', 'shimmy']
+    assert single[single.index('-L') + 1] == tunnels[0].forwarding
+    assert single[-1] == '-oExitOnForwardFailure=yes'
+    batch = lvl.ssh_forward_command('shimmy', 'user', tunnels)
+    assert batch.count('-L') == 2
+    assert '-oExitOnForwardFailure=yes' not in batch
+
+
+def test_port_check_without_tools(lvl):
+    #neither a native backend nor any of the shell tools
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+    assert lvl.is_local_port_in_use(port)
+    server.close()
+    assert not lvl.is_local_port_in_use(port)
+
+
+def test_log_upload_without_log_file(lvl, caplog):
+    lvl.log = logging.getLogger('KRO.nofile')
+    lvl.log_pipeline = None
+    with caplog.at_level(logging.INFO, logger='KRO.nofile'):
+        lvl.upload_log_now()
+    assert 'No log file to upload' in caplog.text
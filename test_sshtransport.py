@@ -0,0 +1,163 @@
+import os
+import socket
+import subprocess
+import threading
+
+import pytest
+
+import sshtransport
+
+
+#set KRO_TEST_SSHD=account@host (key login, e.g. $USER@localhost) to run the
+# backend tests against a real sshd, and KRO_TEST_SSH_KEY for a key file
+SSHD = os.environ.get('KRO_TEST_SSHD', None)
+KEY = os.environ.get('KRO_TEST_SSH_KEY', None)
+
+
+@pytest.fixture(params=sshtransport.BACKENDS)
+def transport(request):
+    if SSHD is None:
+        pytest.skip('KRO_TEST_SSHD not set')
+    if request.param == 'paramiko':
+        pytest.importorskip('paramiko')
+    account, server = SSHD.split('@')
+    options = ['-oBatchMode=yes', '-oStrictHostKeyChecking=no']
+    if KEY:
+        options += ['-i', KEY]
+    transport = sshtransport.create_transport(request.param, server, account,
+                                              options=lambda: options,
+                                              key_filename=KEY)
+    yield transport
+    transport.close()
+
+
+def echo_server():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(4)
+
+    def serve():
+        while True:
+            try:
+                conn, addr = server.accept()
+            except OSError:
+                return
+            with conn:
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    conn.sendall(data)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def test_run_exit_status_and_streams(transport):
+    result = transport.run('echo out; echo err 1>&2; exit 3')
+    assert result.status == 3
+    assert result.text == 'out'
+    assert b'err' in result.stderr
+    assert transport.run('true').status == 0
+
+
+def test_run_timeout(transport):
+    #a command that prints nothing and does not exit
+    with pytest.raises(sshtransport.TransportTimeout):
+        transport.run('sleep 30', timeout=0.5)
+
+
+def test_forward_to_echo_server(transport):
+    if not hasattr(transport, 'forward'):
+        pytest.skip('the launcher runs ssh -L itself for openssh')
+    server = echo_server()
+    local = socket.socket()
+    local.bind(('127.0.0.1', 0))
+    local_port = local.getsockname()[1]
+    local.close()
+
+    forward = transport.forward(local_port, server.getsockname()[1], '127.0.0.1')
+    try:
+        payload = os.urandom(300000)
+        for i in range(50):
+            try:
+                sock = socket.create_connection(('127.0.0.1', local_port), timeout=5)
+                break
+            except OSError:
+                threading.Event().wait(0.1)
+        with sock:
+            sock.sendall(payload)
+            sock.shutdown(socket.SHUT_WR)
+            received = b''
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                received += data
+        assert received == payload
+        assert forward.poll() is None
+    finally:
+        forward.kill()
+        server.close()
+
+
+def test_upload(transport, tmp_path):
+    source = tmp_path / 'kro-upload.txt'
+    source.write_text('uploaded\n')
+    destination = f'/tmp/kro-upload-{os.getpid()}.txt'
+    transport.upload(str(source), destination)
+    try:
+        assert transport.run(f'cat {destination}').text == 'uploaded'
+    finally:
+        transport.run(f'rm -f {destination}')
+
+
+def test_openssh_keeps_stderr_out_of_output(tmp_path, monkeypatch):
+    #an "ssh" that runs the command locally, warning on stderr like ssh does
+    fake = tmp_path / 'ssh'
+    fake.write_text('#!/bin/sh\n'
+                    'echo "Warning: Permanently added host" 1>&2\n'
+                    'for last; do true; done\n'
+                    'exec sh -c "$last"\n')
+    fake.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+    transport = sshtransport.OpenSSHTransport('host', 'user')
+    result = transport.run('echo kastblue; exit 2')
+    assert result.status == 2
+    assert result.text == 'kastblue'
+    assert b'Warning' in result.stderr
+    with pytest.raises(sshtransport.TransportTimeout):
+        transport.run('exec sleep 5', timeout=0.2)
+
+    #append streams stdin to the remote command
+    monkeypatch.chdir(tmp_path)
+    transport.append(b'one\n', 'remote.log')
+    transport.append(b'two\n', 'remote.log')
+    assert (tmp_path / 'remote.log').read_bytes() == b'one\ntwo\n'
+
+
+class IdleTransport(object):
+    '''A connected ParamikoTransport as far as the listener can tell.'''
+    def alive(self):
+        return True
+
+
+def test_paramiko_forward_port_reopens_after_close():
+    local = socket.socket()
+    local.bind(('127.0.0.1', 0))
+    local_port = local.getsockname()[1]
+    local.close()
+
+    for attempt in range(2):
+        forward = sshtransport.ParamikoForward(IdleTransport(), local_port,
+                                               'localhost', 5901)
+        assert forward.poll() is None, forward.stderr_lines
+        with pytest.raises(subprocess.TimeoutExpired):
+            forward.wait(timeout=0.1)
+        forward.kill()
+        assert forward.wait(timeout=5) == -9
+        assert not forward.thread.is_alive()
+        #nothing listens on the port any more
+        with pytest.raises(OSError):
+            socket.create_connection(('127.0.0.1', local_port), timeout=1)
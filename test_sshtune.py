@@ -0,0 +1,55 @@
+import os
+import shutil
+
+import yaml
+
+import sshtune
+
+
+def test_choose_best_prefers_cheaper_when_close():
+    results = [('aes128-gcm@openssh.com', False, {'vnc': 100.0, 'cpu': 0.004}),
+               ('aes128-gcm@openssh.com', True,  {'vnc': 40.0,  'cpu': 0.020}),
+               ('chacha20-poly1305@openssh.com', False, {'vnc': 98.0, 'cpu': 0.002})]
+    assert sshtune.choose_best(results) == ('chacha20-poly1305@openssh.com', False)
+    assert sshtune.choose_best([]) is None
+
+
+def test_save_tuning_keeps_comments(tmp_path):
+    filename = tmp_path / 'config.yaml'
+    shutil.copy('lick_vnc_config.yaml', filename)
+    sshtune.save_tuning(filename, 'shimmy.ucolick.org', 'aes128-ctr', False)
+    sshtune.save_tuning(filename, 'localhost', 'aes128-gcm@openssh.com', True)
+    sshtune.save_tuning(filename, 'shimmy.ucolick.org', 'aes128-ctr', True)
+
+    text = open(filename).read()
+    assert '## This is the command to invoke' in text
+    config = yaml.safe_load(text)
+    assert config['ssh_tuning'] == {
+        'shimmy.ucolick.org': {'cipher': 'aes128-ctr', 'compression': True},
+        'localhost': {'cipher': 'aes128-gcm@openssh.com', 'compression': True}}
+    assert config['window_size'] == [1280, 800]
+
+
+def test_save_tuning_block_style(tmp_path):
+    filename = tmp_path / 'config.yaml'
+    filename.write_text("# local settings\nnosound: True\n")
+    sshtune.save_tuning(filename, 'localhost', 'aes128-ctr', False)
+    config = yaml.safe_load(filename.read_text())
+    assert config == {'nosound': True,
+                      'ssh_tuning': {'localhost': {'cipher': 'aes128-ctr',
+                                                   'compression': False}}}
+
+
+def test_trial_through_cat(tmp_path, monkeypatch):
+    #an "ssh" that runs cat locally stands in for the server
+    fake = tmp_path / 'ssh'
+    fake.write_text('#!/bin/sh\nexec cat\n')
+    fake.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+    payloads = {kind: sshtune.make_payload(kind, 200000) for kind in sshtune.PAYLOADS}
+    result = sshtune.trial('localhost', 'user', 'aes128-ctr', False, payloads)
+    assert result['vnc'] > 0 and result['text'] > 0
+    assert result['latency'] > 0 and result['cpu'] >= 0
+    assert sshtune.cipher_options('aes128-ctr', False) == \
+        ['-oCiphers=aes128-ctr', '-oCompression=no']
@@ -0,0 +1,137 @@
+import logging
+import subprocess
+import threading
+
+import supervisor
+from lick_vnc_launcher import SSHTunnel
+
+
+class FakeLauncher(object):
+    '''Just enough of LickVncLauncher for the supervisor.'''
+    def __init__(self, fail=0):
+        self.log = logging.getLogger('KRO')
+        self.tunnel_lock = threading.Lock()
+        self.ports_in_use = {}
+        self.fail = fail
+        self.restarts = []
+        self.vnc_threads = []
+        self.vnc_processes = []
+        self.launched = []
+        self.viewer_supervisor = None
+
+    def can_reconnect(self, tunnel):
+        return True
+
+    def restart_tunnels(self, tunnels):
+        self.restarts.append([t.local_port for t in tunnels])
+        if self.fail > 0:
+            self.fail -= 1
+            raise RuntimeError('link down')
+        proc = subprocess.Popen(['sleep', '30'])
+        for t in tunnels:
+            t.proc = proc
+
+    def find_tunnel(self, session_name):
+        for port, tunnel in self.ports_in_use.items():
+            if tunnel.session_name == session_name:
+                return port
+
+    def launch_vncviewer(self, vncserver, port, geometry=None, session_name=None):
+        proc = subprocess.Popen(['sleep', '30'])
+        self.launched.append((vncserver, port))
+        self.viewer_supervisor.track(session_name, proc, vncserver, port, geometry)
+        return proc
+
+
+def dead_proc(code=0):
+    proc = subprocess.Popen(['sh', '-c', f'exit {code}'])
+    proc.wait()
+    return proc
+
+
+def test_reconnects_batch_together():
+    launcher = FakeLauncher()
+    proc = dead_proc()
+    for port, name in [(5901, 'Kastblue'), (5902, 'Kastred')]:
+        launcher.ports_in_use[port] = SSHTunnel(port, 'shimmy', 'user', port,
+                                                session_name=name, proc=proc,
+                                                mode='batch')
+    sup = supervisor.TunnelSupervisor(launcher)
+    sup.check()
+    assert launcher.restarts == [[5901, 5902]]
+    assert all(t.is_alive() for t in launcher.ports_in_use.values())
+    assert sup.stats['Kastblue'].reconnects == 1
+    assert sup.stats['Kastred'].drops == 1
+    sup.check()
+    assert len(launcher.restarts) == 1
+    for t in launcher.ports_in_use.values():
+        t.proc.kill()
+
+
+def test_backoff_after_failure():
+    launcher = FakeLauncher(fail=1)
+    launcher.ports_in_use[5901] = SSHTunnel(5901, 'shimmy', 'user', 5901,
+                                            session_name='Kastblue',
+                                            proc=dead_proc())
+    sup = supervisor.TunnelSupervisor(launcher, backoff_start=10)
+    sup.check()
+    stats = sup.stats['Kastblue']
+    assert stats.reconnects == 0
+    assert stats.backoff == 20
+    #next attempt waits for the backoff
+    sup.check()
+    assert len(launcher.restarts) == 1
+    stats.next_attempt = 0
+    sup.check()
+    assert stats.reconnects == 1
+    assert stats.down_since is None
+    assert 'Kastblue' in sup.report()[0]
+    launcher.ports_in_use[5901].proc.kill()
+
+
+def test_viewer_crash_relaunches_on_same_port():
+    launcher = FakeLauncher()
+    sup = supervisor.ViewerSupervisor(launcher, min_uptime=0)
+    launcher.viewer_supervisor = sup
+    sup.track('Kastblue', dead_proc(1), 'shimmy', 5901)
+    sup.track('Kastred', dead_proc(0), 'shimmy', 5902)
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join()
+    launcher.vnc_threads.append(thread)
+    sup.check()
+    assert launcher.launched == [('shimmy', 5901)]
+    assert launcher.vnc_threads == []
+    assert sup.is_running('Kastblue')
+    assert sup.viewers['Kastblue'].restarts == 1
+    assert sup.viewers['Kastblue'].exits[0][0] == 1
+    assert sup.viewers['Kastred'].state == 'closed'
+    sup.viewers['Kastblue'].proc.kill()
+
+
+def test_viewer_not_relaunched_after_tunnel_closed():
+    launcher = FakeLauncher()
+    sup = supervisor.ViewerSupervisor(launcher, min_uptime=0)
+    launcher.viewer_supervisor = sup
+    sup.track('Kastblue', dead_proc(1), 'localhost', 17901)
+    sup.check()
+    assert launcher.launched == []
+    assert sup.viewers['Kastblue'].state == 'closed'
+
+
+def test_viewer_restart_relaunches_running_viewer():
+    launcher = FakeLauncher()
+    sup = supervisor.ViewerSupervisor(launcher, min_uptime=0)
+    launcher.viewer_supervisor = sup
+    old = subprocess.Popen(['sleep', '30'])
+    sup.track('Kastblue', old, 'shimmy', 5901)
+    assert sup.restart('Kastblue')
+    assert old.poll() is not None
+    assert launcher.launched == [('shimmy', 5901)]
+    assert sup.is_running('Kastblue')
+    assert sup.viewers['Kastblue'].restarts == 1
+    #the terminated viewer is not counted as a crash
+    sup.check()
+    assert sup.viewers['Kastblue'].exits == []
+    assert not sup.restart('Kastred')
+    sup.viewers['Kastblue'].proc.kill()
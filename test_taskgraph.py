@@ -0,0 +1,41 @@
+import threading
+import time
+
+import taskgraph
+
+
+def test_dependencies_run_in_order():
+    order = []
+    graph = taskgraph.TaskGraph()
+    graph.add('a', lambda: order.append('a'))
+    graph.add('b', lambda: order.append('b'), deps=['a'])
+    graph.add('c', lambda: order.append('c'), deps=['b'])
+    graph.run()
+    assert order == ['a', 'b', 'c']
+    for task in graph.tasks.values():
+        assert task.duration is not None
+
+
+def test_independent_tasks_run_concurrently():
+    barrier = threading.Barrier(3, timeout=2)
+    graph = taskgraph.TaskGraph()
+    for name in ['x', 'y', 'z']:
+        graph.add(name, barrier.wait)
+    start = time.perf_counter()
+    graph.run()
+    assert graph.errors == {}
+    assert time.perf_counter() - start < 1
+
+
+def test_failure_skips_dependents():
+    def fail():
+        raise RuntimeError('no key')
+    graph = taskgraph.TaskGraph()
+    graph.add('key', fail)
+    graph.add('other', lambda: 42)
+    graph.add('sessions', lambda: 1, deps=['key'])
+    graph.add('viewers', lambda: 1, deps=['sessions', 'other'])
+    results = graph.run()
+    assert str(graph.errors['key']) == 'no key'
+    assert graph.skipped == {'sessions', 'viewers'}
+    assert results == {'other': 42}
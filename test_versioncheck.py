@@ -0,0 +1,83 @@
+import http.server
+import threading
+
+import pytest
+
+import versioncheck
+
+
+class Server(object):
+    '''A local server publishing a launcher file with an ETag.'''
+
+    def __init__(self, version='0.93'):
+        self.version = version
+        self.requests = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                etag = f'"{server.version}"'
+                server.requests.append(dict(self.headers))
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = f"__version__ = '{server.version}'\n".encode()
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/lick_vnc_launcher.py'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    for name in ['http_proxy', 'HTTP_PROXY']:
+        monkeypatch.delenv(name, raising=False)
+    server = Server()
+    yield server
+    server.httpd.shutdown()
+
+
+def test_version_tuple():
+    assert versioncheck.version_tuple('0.92') < versioncheck.version_tuple('0.100')
+    assert versioncheck.version_tuple('1.0rc1') == (1, 0)
+    assert versioncheck.parse_version("x\n__version__ = '0.92'\n") == '0.92'
+
+
+def test_cache_ttl_and_revalidation(server, tmp_path):
+    cachefile = str(tmp_path / 'version.json')
+    result = versioncheck.check('0.92', cachefile, ttl=3600, url=server.url)
+    assert (result.status, result.source, result.remote) == ('behind', 'fresh', '0.93')
+
+    #within the ttl no request is made
+    result = versioncheck.check('0.92', cachefile, ttl=3600, url=server.url)
+    assert result.source == 'cache' and len(server.requests) == 1
+
+    #after it the request is conditional and answered with 304
+    result = versioncheck.check('0.93', cachefile, ttl=0, url=server.url)
+    assert (result.status, result.source) == ('current', 'revalidated')
+    assert server.requests[-1]['If-None-Match'] == '"0.93"'
+
+    server.version = '0.94'
+    result = versioncheck.check('0.93', cachefile, ttl=0, url=server.url)
+    assert (result.remote, result.source) == ('0.94', 'fresh')
+
+
+def test_network_errors_use_cache(server, tmp_path):
+    cachefile = str(tmp_path / 'version.json')
+    closed = 'http://127.0.0.1:9/lick_vnc_launcher.py'
+    result = versioncheck.check('0.92', cachefile, ttl=0, url=closed, timeout=1)
+    assert result.status == 'unknown' and result.error
+
+    versioncheck.check('0.92', cachefile, ttl=0, url=server.url)
+    result = versioncheck.check('0.92', cachefile, ttl=0, url=closed, timeout=1)
+    assert (result.status, result.source) == ('behind', 'stale')
+    assert 'checked' in str(result)
@@ -0,0 +1,76 @@
+import logging
+
+import vncprofile
+
+
+def test_profile_args_tigervnc():
+    profile = vncprofile.resolve('slow')
+    args = vncprofile.profile_args(profile, 'tigervnc')
+    assert args == ['-AutoSelect=0', '-PreferredEncoding=Tight', '-QualityLevel=3',
+                    '-CompressLevel=6', '-FullColor=0', '-LowColorLevel=2']
+    static = '-Shared -FullColor -PreferredEncoding=ZRLE -AutoSelect=0'.split()
+    assert vncprofile.strip_args(static, 'tigervnc') == ['-Shared']
+
+
+def test_profile_args_tightvnc():
+    profile = vncprofile.resolve({'encoding': 'Hextile', 'quality': 4})
+    args = vncprofile.profile_args(profile, 'tightvnc')
+    assert args == ['-encodings', 'hextile copyrect', '-quality', '4',
+                    '-compresslevel', '2', '-depth', '24']
+    #TightVNC 1.3 viewers do not take zrle
+    args = vncprofile.profile_args(vncprofile.resolve('lan'), 'tightvnc')
+    assert args[:2] == ['-encodings', 'tight hextile copyrect']
+    args = vncprofile.profile_args(vncprofile.resolve('lan'), 'tigervnc')
+    assert '-PreferredEncoding=ZRLE' in args
+    static = '-shared -truecolor -quality 4 -x11cursor -encodings ZRLE'.split()
+    assert vncprofile.strip_args(static, 'tightvnc') == ['-shared', '-truecolor', '-x11cursor']
+    assert vncprofile.detect_flavour('vncviewer', ' '.join(static)) == 'tightvnc'
+    assert vncprofile.detect_flavour('vncviewer', '-Shared') == 'tigervnc'
+    assert vncprofile.detect_flavour('open', '') is None
+
+
+def test_choose_profile():
+    assert vncprofile.choose_profile(0.002, 50e6) == 'lan'
+    assert vncprofile.choose_profile(0.002, 1e6) == 'broadband'
+    assert vncprofile.choose_profile(0.150, None) == 'slow'
+    assert vncprofile.choose_profile(0.150, 5e4) == 'minimal'
+
+
+class FakeHealth(object):
+    def __init__(self, samples):
+        self.state = 'ok'
+        self.samples = samples
+
+
+class FakeChecker(object):
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.health = {'Kastblue': FakeHealth([0.005])}
+
+
+class FakeLauncher(object):
+    def __init__(self):
+        self.log = logging.getLogger('KRO')
+        self.health_checker = FakeChecker()
+        self.restarts = 0
+
+    def restart_auto_viewers(self):
+        self.restarts += 1
+
+
+def test_link_monitor_steps_down_once_confirmed():
+    launcher = FakeLauncher()
+    monitor = vncprofile.LinkMonitor(launcher, confirm=2, hold=0)
+    monitor.measured(0.005, 50e6)
+    assert monitor.profile == 'lan'
+
+    launcher.health_checker.health['Kastblue'].samples = [0.3] * 5
+    monitor.check()
+    assert monitor.profile == 'lan'
+    monitor.check()
+    assert monitor.profile == 'broadband'
+    assert launcher.restarts == 1
+    monitor.check()
+    monitor.check()
+    assert monitor.profile == 'slow'
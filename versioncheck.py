@@ -0,0 +1,155 @@
+'''
+Check whether a newer launcher is published on GitHub, without slowing
+startup.
+
+The last answer is kept in cache/version.json with the ETag and
+Last-Modified headers of the response.  Within ttl seconds of the last
+check the cached answer is used without touching the network; after that
+the request is conditional (If-None-Match / If-Modified-Since), so an
+unchanged file costs one short 304 response.  Network errors fall back to
+the cached answer.  Only the standard library is used (no requests or
+packaging imports).
+'''
+import json
+import os
+import re
+import time
+import urllib.error
+import urllib.request
+
+
+VERSION_URL = ('https://raw.githubusercontent.com/bpholden/'
+               'lickRemoteObserving/master/lick_vnc_launcher.py')
+VERSION_PATTERN = re.compile(r"__version__ = '(\d[^']*)'")
+
+
+class VersionResult(object):
+    '''An object to contain the outcome of a version check.
+
+    status is 'current', 'ahead', 'behind' or 'unknown'; source is 'cache'
+    (no request made), 'revalidated' (304), 'fresh' (200) or 'stale' (the
+    request failed and an older cached answer is used).
+    '''
+    def __init__(self, local, remote=None, source=None, error=None, checked=None):
+        self.local = local
+        self.remote = remote
+        self.source = source
+        self.error = error
+        self.checked = checked
+
+    @property
+    def status(self):
+        if self.remote is None:
+            return 'unknown'
+        local, remote = version_tuple(self.local), version_tuple(self.remote)
+        if remote == local:
+            return 'current'
+        return 'ahead' if local > remote else 'behind'
+
+    def __str__(self):
+        if self.status == 'unknown':
+            return f'Unable to verify remote version ({self.error})'
+        if self.status == 'current':
+            message = f'Your software is up to date (v{self.local})'
+        elif self.status == 'ahead':
+            message = f'Your software (v{self.local}) is ahead of the released version'
+        else:
+            message = (f'Your local software (v{self.local}) is not the '
+                       f'currently available version (v{self.remote})')
+        if self.source in ['cache', 'stale'] and self.checked:
+            age = (time.time() - self.checked) / 60
+            message += f' [checked {age:.0f} min ago]'
+        return message
+
+
+def version_tuple(version):
+    '''(0, 92) for '0.92'; parts after the numbers are ignored.'''
+    parts = []
+    for part in version.split('.'):
+        match = re.match(r'\d+', part)
+        if match is None:
+            break
+        parts.append(int(match.group()))
+    return tuple(parts)
+
+
+def parse_version(text):
+    match = VERSION_PATTERN.search(text)
+    return match.group(1) if match else None
+
+
+##-------------------------------------------------------------------------
+## On-disk cache of the last answer
+##-------------------------------------------------------------------------
+def load_cache(cachefile):
+    try:
+        with open(cachefile) as FO:
+            cache = json.load(FO)
+        cache['checked'] = float(cache['checked'])
+        return cache
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cache(cachefile, cache):
+    directory = os.path.dirname(cachefile)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f'{cachefile}.tmp'
+    with open(tmp, 'w') as FO:
+        json.dump(cache, FO, indent=1)
+    os.replace(tmp, cachefile)
+
+
+##-------------------------------------------------------------------------
+## Check, revalidating the cache when it is older than ttl
+##-------------------------------------------------------------------------
+def check(local, cachefile='cache/version.json', ttl=21600, timeout=3.0,
+          url=VERSION_URL):
+    '''
+    Return a VersionResult for the local version string.  ttl=0 always
+    asks the server (still conditionally).  Never raises for network or
+    cache errors.
+    '''
+    cache = load_cache(cachefile)
+    if cache is not None and time.time() - cache['checked'] < ttl:
+        return VersionResult(local, cache.get('remote'), 'cache',
+                             checked=cache['checked'])
+
+    request = urllib.request.Request(url)
+    if cache is not None and cache.get('remote'):
+        if cache.get('etag'):
+            request.add_header('If-None-Match', cache['etag'])
+        if cache.get('last_modified'):
+            request.add_header('If-Modified-Since', cache['last_modified'])
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            text = response.read().decode(errors='replace')
+            headers = response.headers
+        remote = parse_version(text)
+        if remote is None:
+            raise ValueError('no __version__ in the published launcher')
+        cache = {'remote': remote, 'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified')}
+        source = 'fresh'
+    except urllib.error.HTTPError as error:
+        if error.code != 304 or cache is None:
+            return stale(local, cache, f'HTTP {error.code}')
+        source = 'revalidated'
+    except Exception as error:
+        return stale(local, cache, str(error) or type(error).__name__)
+
+    cache['checked'] = time.time()
+    try:
+        save_cache(cachefile, cache)
+    except OSError:
+        pass
+    return VersionResult(local, cache['remote'], source, checked=cache['checked'])
+
+
+def stale(local, cache, error):
+    if cache is None:
+        return VersionResult(local, None, None, error)
+    return VersionResult(local, cache.get('remote'), 'stale', error,
+                         checked=cache['checked'])
@@ -0,0 +1,241 @@
+'''
+Per-session VNC viewer profiles.
+
+A profile sets the encoding, JPEG quality (0-9), compression level (0-9)
+and colour depth a viewer asks the server for.  Profiles are chosen per
+session name in the config (vnc_profiles), either by name, as a dict of
+settings, or as 'auto'.  Auto sessions get a profile picked from the link's
+round trip time and bandwidth measured at startup; LinkMonitor keeps
+watching the round trip times from the health checker and moves them to a
+lighter (or richer) profile when the link stays degraded (or recovers).
+
+profile_args() turns a profile into TigerVNC or TightVNC viewer arguments
+(TightVNC gets tight/hextile in place of ZRLE, which it does not know);
+other viewers (macOS Screen Sharing, RealVNC) are left alone.
+'''
+import os
+import statistics
+import threading
+import time
+import traceback
+
+
+#lightest last; auto mode moves along this list
+PROFILES = {
+    'lan':       {'encoding': 'ZRLE',  'quality': 9, 'compress': 1, 'depth': 24},
+    'broadband': {'encoding': 'Tight', 'quality': 6, 'compress': 2, 'depth': 24},
+    'slow':      {'encoding': 'Tight', 'quality': 3, 'compress': 6, 'depth': 16},
+    'minimal':   {'encoding': 'Tight', 'quality': 1, 'compress': 9, 'depth': 8},
+}
+TIERS = ['lan', 'broadband', 'slow', 'minimal']
+
+#(profile, slowest round trip in seconds, least bandwidth in bytes/s)
+THRESHOLDS = [('lan',       0.010, 6e6),
+              ('broadband', 0.100, 6e5),
+              ('slow',      0.400, 1.2e5)]
+
+#viewer arguments each flavour takes for a profile setting
+TIGER_KEYS = ['-preferredencoding', '-qualitylevel', '-compresslevel',
+              '-fullcolor', '-lowcolorlevel', '-autoselect']
+TIGHT_KEYS = ['-encodings', '-quality', '-compresslevel', '-depth']
+
+#encodings TightVNC 1.3 viewers accept in -encodings (no ZRLE), others fall
+# back to tight with hextile
+TIGHT_ENCODINGS = ['tight', 'hextile', 'zlib', 'corre', 'rre', 'raw']
+
+
+##-------------------------------------------------------------------------
+## Resolve a config entry to a profile
+##-------------------------------------------------------------------------
+def resolve(value):
+    '''
+    Return the settings dict for a profile name or a dict of settings (which
+    fill in 'broadband' defaults).  Raises ValueError for unknown names.
+    '''
+    if isinstance(value, dict):
+        profile = dict(PROFILES['broadband'])
+        profile.update(value)
+        return profile
+    if value not in PROFILES:
+        raise ValueError(f"unknown VNC profile '{value}', choose from "
+                         + ', '.join(PROFILES.keys()) + " or auto")
+    return dict(PROFILES[value])
+
+
+def detect_flavour(vncviewer, vncargs=''):
+    '''Guess 'tigervnc', 'tightvnc' or None (unknown viewer) from the config.'''
+    name = os.path.basename(vncviewer or '').lower()
+    args = (vncargs or '').lower()
+    if name == 'open' or 'realvnc' in name or name == 'vnc viewer':
+        return None
+    if 'tight' in name or '-encodings' in args.split() or '-quality' in args.split():
+        return 'tightvnc'
+    if 'vnc' in name:
+        return 'tigervnc'
+    return None
+
+
+##-------------------------------------------------------------------------
+## Map a profile onto viewer arguments
+##-------------------------------------------------------------------------
+def profile_args(profile, flavour):
+    encoding = profile['encoding']
+    quality = int(profile['quality'])
+    compress = int(profile['compress'])
+    depth = int(profile['depth'])
+
+    if flavour == 'tigervnc':
+        args = ['-AutoSelect=0', f'-PreferredEncoding={encoding}',
+                f'-QualityLevel={quality}', f'-CompressLevel={compress}']
+        if depth >= 24:
+            args.append('-FullColor')
+        else:
+            #256 colours for 16 bit and 64 for 8 bit
+            args += ['-FullColor=0', f'-LowColorLevel={2 if depth >= 16 else 1}']
+        return args
+
+    if flavour == 'tightvnc':
+        if encoding.lower() in TIGHT_ENCODINGS:
+            encodings = f'{encoding.lower()} copyrect'
+        else:
+            encodings = 'tight hextile copyrect'
+        return ['-encodings', encodings, '-quality', str(quality),
+                '-compresslevel', str(compress), '-depth', str(depth)]
+
+    return []
+
+
+def strip_args(args, flavour):
+    '''
+    Remove the arguments a profile sets from a list of static vncargs.
+    '''
+    if flavour == 'tigervnc':
+        return [a for a in args
+                if a.lower().lstrip('-').split('=')[0] not in
+                [k.lstrip('-') for k in TIGER_KEYS]]
+    if flavour == 'tightvnc':
+        stripped = []
+        skip = False
+        for a in args:
+            if skip:
+                skip = False
+            elif a.lower() in TIGHT_KEYS:
+                skip = True
+            elif a.lower() != '-bgr233':
+                stripped.append(a)
+        return stripped
+    return list(args)
+
+
+##-------------------------------------------------------------------------
+## Pick a profile from link measurements
+##-------------------------------------------------------------------------
+def choose_profile(rtt, bandwidth=None):
+    '''
+    Return the richest profile whose round trip (seconds) and bandwidth
+    (bytes/s, None if unknown) limits the link meets.
+    '''
+    for name, max_rtt, min_bandwidth in THRESHOLDS:
+        if rtt is not None and rtt > max_rtt:
+            continue
+        if bandwidth is not None and bandwidth < min_bandwidth:
+            continue
+        return name
+    return 'minimal'
+
+
+class LinkMonitor(object):
+    '''
+    Holds the link measurements and the profile of the 'auto' sessions.
+    check() looks at the latest health check round trips and changes the
+    profile one step at a time once the link has been worse (or better)
+    for `confirm` checks in a row, at most once every `hold` seconds.
+    '''
+    def __init__(self, launcher, interval=60.0, confirm=3, hold=600.0):
+        self.launcher = launcher
+        self.log = launcher.log
+        self.interval = interval
+        self.confirm = confirm
+        self.hold = hold
+        self.rtt = None
+        self.bandwidth = None
+        self.profile = None
+        self.pending = None
+        self.pending_count = 0
+        self.changed = 0.0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+
+    def measured(self, rtt, bandwidth):
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.profile = choose_profile(rtt, bandwidth)
+        self.changed = time.time()
+        bw = f'{bandwidth*8/1e6:.1f} Mbit/s' if bandwidth else 'unknown'
+        self.log.info(f"Link round trip {rtt*1000:.0f}ms, bandwidth {bw}: "
+                      f"using VNC profile '{self.profile}' for auto sessions")
+
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stop_event.set()
+
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                self.log.error('Link monitor error, see log for details')
+                self.log.debug(traceback.format_exc())
+
+
+    def recent_rtt(self, samples=5):
+        checker = self.launcher.health_checker
+        if checker is None:
+            return None
+        with checker.lock:
+            latencies = []
+            for name, health in checker.health.items():
+                if name != 'soundplay' and health.state != 'dead':
+                    latencies += list(health.samples)[-samples:]
+        if len(latencies) == 0:
+            return None
+        return statistics.median(latencies)
+
+
+    def check(self):
+        rtt = self.recent_rtt()
+        if rtt is None or self.profile is None:
+            return
+        #bandwidth is only measured at startup, keep it as a ceiling
+        target = choose_profile(rtt, self.bandwidth)
+        current = TIERS.index(self.profile)
+        wanted = TIERS.index(target)
+        if wanted == current:
+            self.pending, self.pending_count = None, 0
+            return
+        step = TIERS[current + (1 if wanted > current else -1)]
+        if step != self.pending:
+            self.pending, self.pending_count = step, 0
+        self.pending_count += 1
+        if self.pending_count < self.confirm or time.time() - self.changed < self.hold:
+            return
+
+        message = (f"Link round trip now {rtt*1000:.0f}ms, switching auto VNC "
+                   f"sessions from '{self.profile}' to '{step}'")
+        if wanted > current:
+            self.log.warning(message)
+        else:
+            self.log.info(message)
+        self.profile = step
+        self.pending, self.pending_count = None, 0
+        self.changed = time.time()
+        self.launcher.restart_auto_viewers()